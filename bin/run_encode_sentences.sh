@@ -3,5 +3,6 @@
 set -exu
 
 chunk=$1
+workers=${2:-1}
 
-python -m kdcovid.encode_sentences --chunk $chunk
\ No newline at end of file
+python -m kdcovid.encode_sentences --chunk $chunk --workers $workers
\ No newline at end of file
@@ -0,0 +1,158 @@
+import time
+
+import numpy as np
+from absl import logging
+
+INDEX_TYPES = ['exact', 'ivf']
+
+
+def index_file(data_dir, index_type):
+    return '%s/all.%s.npz' % (data_dir, index_type)
+
+
+def topk_rows(scores, K):
+    # Returns the top K (scores, column indices) of each row sorted by decreasing score.
+    K = min(K, scores.shape[1])
+    if K == 0:
+        return np.zeros((scores.shape[0], 0), dtype=np.float32), np.zeros((scores.shape[0], 0), dtype=np.int64)
+    part = np.argpartition(-scores, K - 1, axis=1)[:, :K]
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind='stable')
+    return np.take_along_axis(part_scores, order, axis=1), np.take_along_axis(part, order, axis=1)
+
+
+def exact_search(query_vectors, base_vectors, K, block_size=1000000):
+    """Brute force top K inner products, scoring block_size base rows at a time to bound memory."""
+    query_vectors = np.asarray(query_vectors, dtype=np.float32)
+    distances = np.zeros((query_vectors.shape[0], 0), dtype=np.float32)
+    indices = np.zeros((query_vectors.shape[0], 0), dtype=np.int64)
+    for start in range(0, base_vectors.shape[0], block_size):
+        block = np.asarray(base_vectors[start:(start + block_size)], dtype=np.float32)
+        scores = np.concatenate([distances, np.matmul(query_vectors, block.T)], axis=1)
+        ids = np.concatenate([indices, np.broadcast_to(np.arange(start, start + block.shape[0]),
+                                                       (query_vectors.shape[0], block.shape[0]))], axis=1)
+        distances, top = topk_rows(scores, K)
+        indices = np.take_along_axis(ids, top, axis=1)
+    return distances, indices
+
+
+def recall_at_k(approx_indices, exact_indices):
+    """Fraction of the exact top-K neighbors that the approximate search also returned."""
+    found = 0
+    total = 0
+    for approx, exact in zip(approx_indices, exact_indices):
+        exact = set(int(x) for x in exact if x >= 0)
+        found += len(exact.intersection(int(x) for x in approx if x >= 0))
+        total += len(exact)
+    return found / max(total, 1)
+
+
+class IVFIndex(object):
+    """Inverted file index over unit normed vectors.
+
+    The vectors are clustered with spherical k-means into nlist lists. A query is only scored against the
+    vectors in the nprobe lists whose centroids are closest to it, so search cost is roughly
+    nprobe / nlist of a brute force matmul. The vectors themselves are not copied into the index, search
+    gathers the candidate rows from the base matrix it was built on.
+    """
+
+    def __init__(self, centroids, list_offsets, list_ids, nprobe=16):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.nprobe = nprobe
+
+    @property
+    def nlist(self):
+        return self.centroids.shape[0]
+
+    @classmethod
+    def build(cls, vectors, nlist=1024, nprobe=16, num_iters=10, sample_size=256 * 1024, batch_size=100000, seed=0):
+        t = time.time()
+        rng = np.random.RandomState(seed)
+        num_vectors = vectors.shape[0]
+        nlist = min(nlist, num_vectors)
+        sample_ids = np.sort(rng.choice(num_vectors, min(sample_size, num_vectors), replace=False))
+        sample = np.asarray(vectors[sample_ids], dtype=np.float32)
+        centroids = sample[rng.choice(sample.shape[0], nlist, replace=False)].copy()
+        for it in range(num_iters):
+            assignment = cls._assign(sample, centroids, batch_size)
+            counts = np.bincount(assignment, minlength=nlist)
+            empty = counts == 0
+            order = np.argsort(assignment, kind='stable')
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            sums = np.zeros_like(centroids)
+            sums[~empty] = np.add.reduceat(sample[order], starts[~empty], axis=0)
+            sums[empty] = sample[rng.choice(sample.shape[0], int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids = sums / norms
+            logging.info('k-means iteration %s of %s, %s empty lists, %s seconds', it, num_iters, int(empty.sum()),
+                         time.time() - t)
+
+        assignment = np.zeros(num_vectors, dtype=np.int32)
+        for i in range(0, num_vectors, batch_size):
+            assignment[i:(i + batch_size)] = cls._assign(np.asarray(vectors[i:(i + batch_size)], dtype=np.float32),
+                                                         centroids, batch_size)
+        list_ids = np.argsort(assignment, kind='stable').astype(np.int64)
+        list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=nlist), out=list_offsets[1:])
+        logging.info('Built ivf index with %s lists over %s vectors in %s seconds', nlist, num_vectors, time.time() - t)
+        return cls(centroids.astype(np.float32), list_offsets, list_ids, nprobe=nprobe)
+
+    @staticmethod
+    def _assign(vectors, centroids, batch_size):
+        assignment = np.zeros(vectors.shape[0], dtype=np.int32)
+        for i in range(0, vectors.shape[0], batch_size):
+            assignment[i:(i + batch_size)] = np.argmax(np.matmul(vectors[i:(i + batch_size)], centroids.T), axis=1)
+        return assignment
+
+    def candidates(self, query_vector, nprobe=None):
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        probes = np.argpartition(-np.matmul(self.centroids, query_vector), nprobe - 1)[:nprobe]
+        ids = np.concatenate([self.list_ids[self.list_offsets[p]:self.list_offsets[p + 1]] for p in probes])
+        ids.sort()
+        return ids
+
+    def search(self, query_vectors, base_vectors, K, nprobe=None, mask=None):
+        """Approximate top K inner products, shaped like torch.topk. Missing neighbors have index -1.
+
+        Rows that are False in the optional boolean mask are never returned.
+        """
+        query_vectors = np.asarray(query_vectors, dtype=np.float32)
+        distances = np.full((query_vectors.shape[0], K), -np.inf, dtype=np.float32)
+        indices = np.full((query_vectors.shape[0], K), -1, dtype=np.int64)
+        for q in range(query_vectors.shape[0]):
+            ids = self.candidates(query_vectors[q], nprobe)
+            if mask is not None:
+                ids = ids[mask[ids]]
+            scores = np.matmul(np.asarray(base_vectors[ids], dtype=np.float32), query_vectors[q])
+            top_scores, top = topk_rows(scores[None, :], K)
+            distances[q, :top.shape[1]] = top_scores[0]
+            indices[q, :top.shape[1]] = ids[top[0]]
+        return distances, indices
+
+    def save(self, filename):
+        with open(filename, 'wb') as fout:
+            np.savez(fout, index_type='ivf', centroids=self.centroids, list_offsets=self.list_offsets,
+                     list_ids=self.list_ids, nprobe=self.nprobe)
+
+    @classmethod
+    def load(cls, filename, nprobe=None):
+        data = np.load(filename)
+        return cls(data['centroids'], data['list_offsets'], data['list_ids'],
+                   nprobe=nprobe or int(data['nprobe']))
+
+
+def build_index(index_type, vectors, **kwargs):
+    if index_type == 'ivf':
+        return IVFIndex.build(vectors, **kwargs)
+    raise ValueError('Unknown index type %s, expected one of %s' % (index_type, INDEX_TYPES))
+
+
+def load_index(data_dir, index_type, nprobe=None):
+    if index_type == 'exact':
+        return None
+    if index_type == 'ivf':
+        return IVFIndex.load(index_file(data_dir, index_type), nprobe=nprobe)
+    raise ValueError('Unknown index type %s, expected one of %s' % (index_type, INDEX_TYPES))
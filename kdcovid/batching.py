@@ -0,0 +1,129 @@
+import inspect
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+from absl import logging
+
+
+def _group_key(value):
+    # Arrays and tensors are grouped by identity, e.g. the mask of a filter is the same array for every
+    # query without dates. Bound methods compare equal when they bind the same function to the same object.
+    if value is None or isinstance(value, (bool, int, float, str)) or inspect.ismethod(value):
+        return value
+    return id(value)
+
+
+class _Request(object):
+
+    def __init__(self, search, query_vectors, args):
+        self.search = search
+        self.query_vectors = query_vectors
+        self.args = args
+        self.key = (_group_key(search),) + tuple(_group_key(a) for a in args)
+        self.future = Future()
+
+
+class KnnBatcher(object):
+    """Runs concurrent top K searches as batches.
+
+    Callers block in run(search, query_vectors, *args). A worker thread waits up to window seconds after
+    the first pending request, or until max_batch_size query rows are pending, then concatenates the
+    requests with the same search and arguments and runs search(all query vectors, *args) once. Each caller
+    gets its own rows of the (distances, indices) result. Scoring all queries with one matmul reads the
+    sentence vectors once per batch instead of once per query.
+    """
+
+    def __init__(self, window=0.003, max_batch_size=64):
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.pending = deque()
+        self.pending_rows = 0
+        self.condition = threading.Condition()
+        self.closed = False
+        self.num_batches = 0
+        self.num_queries = 0
+        self.thread = threading.Thread(target=self._loop, name='knn_batcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, search, query_vectors, *args):
+        return self.submit(search, query_vectors, *args).result()
+
+    def submit(self, search, query_vectors, *args):
+        request = _Request(search, query_vectors, args)
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('KnnBatcher is closed')
+            self.pending.append(request)
+            self.pending_rows += query_vectors.shape[0]
+            self.condition.notify()
+        return request.future
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+    def stats(self):
+        return {'batches': self.num_batches, 'queries': self.num_queries,
+                'mean_batch_size': self.num_queries / max(self.num_batches, 1)}
+
+    def _next_batch(self):
+        with self.condition:
+            while not self.pending and not self.closed:
+                self.condition.wait()
+            if not self.pending:
+                return None
+            deadline = time.time() + self.window
+            while self.pending_rows < self.max_batch_size and not self.closed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            batch = []
+            rows = 0
+            while self.pending and (not batch or
+                                    rows + self.pending[0].query_vectors.shape[0] <= self.max_batch_size):
+                request = self.pending.popleft()
+                rows += request.query_vectors.shape[0]
+                batch.append(request)
+            self.pending_rows -= rows
+            return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            groups = dict()
+            for request in batch:
+                groups.setdefault(request.key, []).append(request)
+            for requests in groups.values():
+                self._run_group(requests)
+
+    def _run_group(self, requests):
+        # Callers cancelled in between never get to see their result.
+        requests = [r for r in requests if r.future.set_running_or_notify_cancel()]
+        if not requests:
+            return
+        try:
+            if len(requests) == 1:
+                query_vectors = requests[0].query_vectors
+            else:
+                query_vectors = torch.cat([r.query_vectors for r in requests])
+            distances, indices = requests[0].search(query_vectors, *requests[0].args)
+        except Exception as e:
+            logging.exception('Batched search of %s queries failed', len(requests))
+            for r in requests:
+                r.future.set_exception(e)
+            return
+        self.num_batches += 1
+        self.num_queries += query_vectors.shape[0]
+        offsets = np.cumsum([0] + [r.query_vectors.shape[0] for r in requests])
+        for r, start, end in zip(requests, offsets[:-1], offsets[1:]):
+            r.future.set_result((distances[start:end], indices[start:end]))
@@ -0,0 +1,62 @@
+import hashlib
+
+import numpy as np
+
+
+class HashingSent2vecModel(object):
+    """Deterministic stand-in for sent2vec.Sent2vecModel, for benchmarks without the BioSentVec model.
+
+    Like the bigram BioSentVec model, a sentence is the average of the vectors of its unigrams and bigrams.
+    The vector of an n-gram is signed feature hashing: num_probes dimensions picked by a keyed hash of the
+    n-gram are set to +-1. Sentences that share words get similar vectors, so nearest neighbor results are
+    meaningful, and the same sentence always gets the same vector for a given dim and seed.
+    """
+
+    def __init__(self, dim=700, seed=0, num_probes=8, cache_size=1 << 20):
+        self.dim = dim
+        self.seed = seed
+        self.num_probes = num_probes
+        self.key = ('kdcovid%d' % seed).encode('utf-8')
+        # n-gram -> (dims, signs) of the n-grams seen so far, cleared when it grows past cache_size.
+        self.cache_size = cache_size
+        self.gram2features = dict()
+
+    def load_model(self, model_path):
+        # Nothing to load, kept for the Sent2vecModel interface.
+        pass
+
+    def get_emb_size(self):
+        return self.dim
+
+    def _features(self, gram):
+        features = self.gram2features.get(gram)
+        if features is None:
+            digest = hashlib.blake2b(gram.encode('utf-8'), digest_size=4 * self.num_probes, key=self.key).digest()
+            words = np.frombuffer(digest, dtype=np.uint32).astype(np.int64)
+            features = (words >> 1) % self.dim, np.where(words & 1, 1.0, -1.0).astype(np.float32)
+            if len(self.gram2features) >= self.cache_size:
+                self.gram2features.clear()
+            self.gram2features[gram] = features
+        return features
+
+    def embed_sentences(self, sentences, num_threads=1):
+        vectors = np.zeros((len(sentences), self.dim), dtype=np.float32)
+        rows, dims, signs = [], [], []
+        counts = np.zeros(len(sentences), dtype=np.float32)
+        for row, sentence in enumerate(sentences):
+            tokens = sentence.split()
+            grams = tokens + [a + ' ' + b for a, b in zip(tokens[:-1], tokens[1:])]
+            counts[row] = len(grams)
+            for gram in grams:
+                gram_dims, gram_signs = self._features(gram)
+                rows.append(row)
+                dims.append(gram_dims)
+                signs.append(gram_signs)
+        if rows:
+            flat = np.repeat(np.asarray(rows, dtype=np.int64) * self.dim, self.num_probes) + np.concatenate(dims)
+            np.add.at(vectors.reshape(-1), flat, np.concatenate(signs))
+        vectors /= np.maximum(counts, 1)[:, None]
+        return vectors
+
+    def embed_sentence(self, sentence, num_threads=1):
+        return self.embed_sentences([sentence])
@@ -0,0 +1,300 @@
+import json
+import multiprocessing
+import os
+import pickle
+import platform
+import sys
+import time
+import traceback
+
+import numpy as np
+import torch
+from absl import app
+from absl import flags
+from absl import logging
+
+from kdcovid.bench.hashing_encoder import HashingSent2vecModel
+from kdcovid.bench.synthetic import SyntheticCorpus
+from kdcovid.bench.synthetic import write_data_dir
+from kdcovid.bench.synthetic import write_release
+from kdcovid.meta_store import SentenceMetadata
+from kdcovid.meta_store import SentenceMetadataWriter
+from kdcovid.search_tool import SearchTool
+from kdcovid.section_store import load_sections
+from kdcovid.section_store import SectionStoreWriter
+from kdcovid.vector_store import load_info
+
+QUERY_BENCHMARKS = ['startup', 'knn', 'grouping', 'highlight', 'render', 'search']
+PIPELINE = ['setup_corpus', 'encode', 'gather', 'parse_befree']
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string('work_dir', 'bench', 'synthetic data and pipeline outputs are written here')
+flags.DEFINE_integer('num_sentences', 100000, 'size of the synthetic corpus')
+flags.DEFINE_integer('dim', 700, 'sentence vector dimension')
+flags.DEFINE_integer('seed', 0, 'seed of the synthetic corpus and queries')
+flags.DEFINE_list('benchmarks', QUERY_BENCHMARKS, 'benchmarks to run, of %s' % ','.join(QUERY_BENCHMARKS + PIPELINE))
+flags.DEFINE_integer('repeats', 5, 'timed runs of each query benchmark, pipeline stages run once')
+flags.DEFINE_integer('num_queries', 32, 'queries per run')
+flags.DEFINE_integer('K', 100, 'nearest sentences per query')
+flags.DEFINE_integer('Kdocs', 20, 'papers rendered per query')
+flags.DEFINE_integer('pipeline_workers', 1, 'processes used by the pipeline stages')
+flags.DEFINE_string('retrieval_mode', 'sentence', 'SearchTool retrieval mode')
+flags.DEFINE_bool('regenerate', False, 'rewrite the synthetic data even if it exists')
+flags.DEFINE_string('output', None, 'json results file, <work_dir>/results.json by default')
+
+# python -m kdcovid.bench.run --num_sentences 1000000 --benchmarks startup,knn,search --output base.json
+# Everything runs against synthetic data (kdcovid.bench.synthetic) and the hashing stand-in encoder, so
+# results are repeatable for a given configuration. The pipeline stages need the nltk punkt model.
+
+
+def summarize(seconds, items=None):
+    """Statistics of the run times of one benchmark, items processed per run give a throughput."""
+    seconds = np.asarray(seconds, dtype=np.float64)
+    summary = {'repeats': len(seconds), 'mean': float(seconds.mean()), 'median': float(np.median(seconds)),
+               'p90': float(np.percentile(seconds, 90)), 'min': float(seconds.min()), 'max': float(seconds.max())}
+    if items is not None:
+        summary['items'] = items
+        summary['items_per_second'] = items / summary['median'] if summary['median'] > 0 else None
+    return summary
+
+
+def measure(fn, repeats, items=None):
+    seconds = []
+    for _ in range(repeats):
+        t = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - t)
+    return summarize(seconds, items)
+
+
+def _child(fn, sender):
+    try:
+        sender.send((True, fn()))
+    except Exception:
+        sender.send((False, traceback.format_exc()))
+
+
+def run_in_child(fn):
+    """Returns fn() run in a forked process.
+
+    The pipeline modules define absl flags with the same names (workers, out_dir, ...), so each stage imports
+    its module in a process of its own.
+    """
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_child, args=(fn, sender))
+    process.start()
+    sender.close()
+    ok, value = receiver.recv()
+    process.join()
+    if not ok:
+        raise RuntimeError('Pipeline stage failed:\n%s' % value)
+    return value
+
+
+def environment():
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+            'numpy': np.__version__, 'torch': torch.__version__, 'torch_threads': torch.get_num_threads()}
+
+
+class Benchmarks(object):
+
+    def __init__(self, work_dir, num_sentences, dim=700, seed=0, repeats=5, num_queries=32, K=100, Kdocs=20,
+                 workers=1, retrieval_mode='sentence'):
+        self.work_dir = work_dir
+        self.data_dir = '%s/data_%s_%s_%s' % (work_dir, num_sentences, dim, seed)
+        self.pipeline_dir = '%s/pipeline_%s_%s_%s' % (work_dir, num_sentences, dim, seed)
+        self.corpus = SyntheticCorpus(num_sentences, seed)
+        self.model = HashingSent2vecModel(dim, seed)
+        self.seed = seed
+        self.repeats = repeats
+        self.num_queries = num_queries
+        self.K = K
+        self.Kdocs = Kdocs
+        self.workers = workers
+        self.retrieval_mode = retrieval_mode
+        self.results = dict()
+        self._search_tool = None
+        self._queries = None
+        self._nn = None
+
+    def generate(self, regenerate=False):
+        if regenerate or not os.path.exists('%s/all.info.json' % self.data_dir):
+            t = time.perf_counter()
+            write_data_dir(self.data_dir, self.corpus, self.model)
+            self.results['generate'] = summarize([time.perf_counter() - t], load_info(self.data_dir)['shape'][0])
+
+    def search_tool(self):
+        return SearchTool(data_dir=self.data_dir, model=self.model, cache_size=0,
+                          retrieval_mode=self.retrieval_mode)
+
+    @property
+    def tool(self):
+        if self._search_tool is None:
+            self._search_tool = self.search_tool()
+        return self._search_tool
+
+    def queries(self):
+        """Pieces of random corpus sentences, the same for every run with the same seed."""
+        if self._queries is None:
+            meta = SentenceMetadata(self.data_dir)
+            rng = np.random.RandomState(self.seed)
+            self._queries = []
+            for row in rng.randint(len(meta), size=self.num_queries):
+                words = meta.sentence(int(row)).rstrip('.').split()
+                start = rng.randint(max(len(words) - 4, 1))
+                self._queries.append(' '.join(words[start:start + rng.randint(3, 7)]))
+        return self._queries
+
+    def knn(self, query_vecs, queries):
+        query_meta = [('query', idx, 0, q) for idx, q in enumerate(queries)]
+        return self.tool.knn(query_vecs, self.tool.all_vecs, query_meta, self.tool.all_meta, K=self.K,
+                             mask=self.tool.sentence_mask())
+
+    def nearest(self):
+        if self._nn is None:
+            queries = self.queries()
+            self._nn = self.knn(self.tool.embed_queries(queries), queries)
+        return self._nn
+
+    def bench_startup(self):
+        self.results['startup'] = measure(self.search_tool, self.repeats)
+
+    def bench_knn(self):
+        queries = self.queries()
+        query_vecs = self.tool.embed_queries(queries)
+        self.results['embed'] = measure(lambda: self.tool.embed_queries(queries), self.repeats, len(queries))
+        self.results['knn_single'] = measure(
+            lambda: [self.knn(query_vecs[i:i + 1], queries[i:i + 1]) for i in range(len(queries))], self.repeats,
+            len(queries))
+        self.results['knn_batch'] = measure(lambda: self.knn(query_vecs, queries), self.repeats, len(queries))
+
+    def bench_grouping(self):
+        # With Kdocs=0 render_results groups the hits by paper and looks up their sections, but renders none.
+        nn = self.nearest()
+        self.results['grouping'] = measure(lambda: [self.tool.render_results(q, nn[q], Kdocs=0) for q in nn],
+                                           self.repeats, len(nn))
+
+    def bench_highlight(self):
+        cases = []
+        for hits in self.nearest().values():
+            for hit in hits:
+                sha, sec_id = hit['doc_id'], hit['sec_id']
+                sec = self.tool.doc2sec2text[sha][sec_id]
+                start = self.tool.sentence_offset(sha, sec_id, sec, hit)
+                highlights = [[start, start + len(hit['sent_text']), 'Highlight', None]] if start >= 0 else []
+                cases.append((sec, self.tool.span_index.entity_spans(sha, sec_id), highlights))
+        self.results['highlight_texts'] = measure(
+            lambda: [self.tool.highlight_texts(sec, entities, highlights, self.tool.colors, entities_sorted=True)
+                     for sec, entities, highlights in cases], self.repeats, len(cases))
+
+    def bench_render(self):
+        nn = self.nearest()
+        self.results['render'] = measure(lambda: [self.tool.render_results(q, nn[q], Kdocs=self.Kdocs) for q in nn],
+                                         self.repeats, len(nn))
+
+    def bench_search(self):
+        queries = self.queries()
+        self.results['search_single'] = measure(
+            lambda: [self.tool.get_search_results(q, K=self.K, Kdocs=self.Kdocs) for q in queries], self.repeats,
+            len(queries))
+        self.results['search_batch'] = measure(
+            lambda: self.tool.get_search_results_batch(queries, K=self.K, Kdocs=self.Kdocs), self.repeats,
+            len(queries))
+
+    def bench_setup_corpus(self):
+        release_dir = '%s/release' % self.pipeline_dir
+        if not os.path.exists('%s/file-list' % release_dir):
+            write_release(release_dir, self.corpus)
+        self.results['setup_corpus'] = run_in_child(self._setup_corpus)
+
+    def _setup_corpus(self):
+        from kdcovid.setup_corpus import DocumentLoader
+        release_dir = '%s/release' % self.pipeline_dir
+        t = time.perf_counter()
+        loader = DocumentLoader('%s/file-list' % release_dir, '%s/metadata.csv' % release_dir, workers=self.workers,
+                                load=False)
+        writer = SectionStoreWriter(self.pipeline_dir)
+        for cord_id, sections in loader.iter_documents():
+            writer.add(cord_id, sections)
+        writer.close()
+        return summarize([time.perf_counter() - t], len(writer))
+
+    def bench_encode(self):
+        if not os.path.exists('%s/all_sections.index.json' % self.pipeline_dir):
+            self.bench_setup_corpus()
+        self.results['encode'] = run_in_child(self._encode)
+
+    def _encode(self):
+        from kdcovid.encode_sentences import encode_to_file
+        sections = load_sections(self.pipeline_dir)
+        os.makedirs('%s/sent2vec' % self.pipeline_dir, exist_ok=True)
+        t = time.perf_counter()
+        chunk_meta = encode_to_file(sections, '%s/sent2vec/chunk_0.vectors.npy' % self.pipeline_dir, chunk=0,
+                                    chunk_size=len(sections), workers=self.workers, model=self.model)
+        with open('%s/sent2vec/chunk_0.sentences.pkl' % self.pipeline_dir, 'wb') as fout:
+            pickle.dump(chunk_meta, fout)
+        return summarize([time.perf_counter() - t], len(chunk_meta))
+
+    def bench_gather(self):
+        if not os.path.exists('%s/sent2vec/chunk_0.vectors.npy' % self.pipeline_dir):
+            self.bench_encode()
+        self.results['gather'] = run_in_child(self._gather)
+
+    def _gather(self):
+        from kdcovid.gather_sentence_embeddings import chunk_ids
+        from kdcovid.gather_sentence_embeddings import load_all_vectors
+        sent2vec_dir = '%s/sent2vec' % self.pipeline_dir
+        t = time.perf_counter()
+        meta_writer = SentenceMetadataWriter(self.pipeline_dir)
+        all_vecs, _ = load_all_vectors(chunk_ids(sent2vec_dir), self.pipeline_dir, meta_writer,
+                                       sent2vec_dir=sent2vec_dir)
+        meta_writer.close()
+        return summarize([time.perf_counter() - t], all_vecs.shape[0])
+
+    def bench_parse_befree(self):
+        if not os.path.exists('%s/all_sections.index.json' % self.pipeline_dir):
+            self.bench_setup_corpus()
+        self.results['parse_befree'] = run_in_child(self._parse_befree)
+
+    def _parse_befree(self):
+        from kdcovid.parse_befree_output import stream_span_index
+        sections = load_sections(self.pipeline_dir)
+        t = time.perf_counter()
+        with open('%s/disease.befree' % self.data_dir) as disease_output, \
+                open('%s/gene.befree' % self.data_dir) as gene_output:
+            stream_span_index(self.pipeline_dir, sections, disease_output, gene_output, workers=self.workers)
+        return summarize([time.perf_counter() - t], len(sections))
+
+    def run(self, names):
+        for name in names:
+            logging.info('Running benchmark %s', name)
+            getattr(self, 'bench_%s' % name)()
+        return self.results
+
+
+def main(argv):
+    logging.info('Running with args %s', str(argv))
+    benchmarks = Benchmarks(FLAGS.work_dir, FLAGS.num_sentences, FLAGS.dim, FLAGS.seed, FLAGS.repeats,
+                            FLAGS.num_queries, FLAGS.K, FLAGS.Kdocs, FLAGS.pipeline_workers, FLAGS.retrieval_mode)
+    unknown = [name for name in FLAGS.benchmarks if name not in QUERY_BENCHMARKS + PIPELINE]
+    if unknown:
+        raise app.UsageError('Unknown benchmarks %s' % ', '.join(unknown))
+    benchmarks.generate(FLAGS.regenerate)
+    results = benchmarks.run(FLAGS.benchmarks)
+    config = {name: getattr(FLAGS, name) for name in ['num_sentences', 'dim', 'seed', 'repeats', 'num_queries', 'K',
+                                                      'Kdocs', 'pipeline_workers', 'retrieval_mode']}
+    config['benchmarks'] = list(FLAGS.benchmarks)
+    report = {'config': config, 'environment': environment(), 'results': results,
+              'command': ' '.join(sys.argv)}
+    output = FLAGS.output or '%s/results.json' % FLAGS.work_dir
+    with open(output, 'w') as fout:
+        json.dump(report, fout, indent=2, sort_keys=True)
+    for name, result in results.items():
+        logging.info('%-16s median %.4fs p90 %.4fs %s', name, result['median'], result['p90'],
+                     '%.1f items/s' % result['items_per_second'] if result.get('items_per_second') else '')
+    logging.info('Wrote %s', output)
+
+
+if __name__ == '__main__':
+    app.run(main)
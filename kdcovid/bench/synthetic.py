@@ -0,0 +1,236 @@
+import csv
+import json
+import os
+import time
+
+import numpy as np
+from absl import logging
+
+from kdcovid.bench.hashing_encoder import HashingSent2vecModel
+from kdcovid.meta_store import SentenceMetadataWriter
+from kdcovid.section_store import SectionStoreWriter
+from kdcovid.span_index import disease_urls
+from kdcovid.span_index import gene_urls
+from kdcovid.span_index import SpanIndexWriter
+from kdcovid.tokenizer import SentencePreprocessor
+from kdcovid.vector_store import create_vectors
+from kdcovid.vector_store import unit_norm
+from kdcovid.vector_store import write_info
+
+# Synthetic CORD-19 data at any scale, laid out like the real files:
+#   write_data_dir  what SearchTool(data_dir) loads: metadata.csv, the section store, sentence metadata,
+#                   unit normed all.npy and the span index, plus the BeFree output (disease.befree,
+#                   gene.befree) it was built from.
+#   write_release   the json release read by setup_corpus: pdf_json/<sha>.json, pmc_json/<pmcid>.xml.json,
+#                   file-list and metadata.csv.
+# Sections are numbered as setup_corpus numbers them: the title is section 0, then the abstract and body
+# paragraphs. Sentences end in a period followed by a capitalized word, so punkt splits them back exactly.
+
+METADATA_FIELDS = ['cord_uid', 'sha', 'source_x', 'title', 'doi', 'pmcid', 'pubmed_id', 'license', 'abstract',
+                   'publish_time', 'authors', 'journal']
+
+# Entrez ids, several ids joined by | as BeFree writes ambiguous genes.
+GENES = {'ace2': '59272', 'tmprss2': '7113', 'il6': '3569', 'tnf': '7124', 'furin': '5045', 'cd4': '920',
+         'ifng': '3458', 'stat3': '6774', 'hla': '3105|3106', 'ctsl': '1514', 'nfkb1': '4790', 'tlr7': '51284'}
+# MedGen concept ids.
+DISEASES = {'pneumonia': 'C0032285', 'sepsis': 'C0243026', 'fever': 'C0015967', 'asthma': 'C0004096',
+            'diabetes': 'C0011849', 'hypertension': 'C0020538', 'influenza': 'C0021400', 'covid': 'C5203670',
+            'ards': 'C0035222', 'myocarditis': 'C0027059'}
+
+_SYLLABLES = ['ba', 'co', 'di', 'fe', 'ga', 'hi', 'ko', 'lu', 'ma', 'ne', 'po', 'ra', 'si', 'tu', 'vi', 'ze',
+              'an', 'er', 'in', 'os', 'ul', 'tra', 'pro', 'cel', 'vir', 'gen', 'pat', 'mol']
+
+
+class SyntheticDocument(object):
+
+    def __init__(self, cord_uid, metadata, sections, num_abstract, sentences, entities):
+        self.cord_uid = cord_uid
+        self.metadata = metadata
+        # {sec_id: text}, section 0 is the title, 1 to num_abstract the abstract, then the body.
+        self.sections = sections
+        self.num_abstract = num_abstract
+        # (sec_id, sentence number in the section, character offset in the section, text)
+        self.sentences = sentences
+        # (sec_id, sentence number in the document, start, end in the sentence, type, concept id)
+        self.entities = entities
+
+
+class SyntheticCorpus(object):
+    """Deterministic random documents adding up to about num_sentences sentences (titles included).
+
+    Words follow a Zipf distribution over a generated vocabulary. Gene and disease names from GENES and
+    DISEASES are mixed in at entity_rate per word, a covid_rate fraction of the titles mention COVID-19.
+    """
+
+    def __init__(self, num_sentences, seed=0, vocab_size=5000, entity_rate=0.02, covid_rate=0.3):
+        self.num_sentences = num_sentences
+        self.seed = seed
+        self.entity_rate = entity_rate
+        self.covid_rate = covid_rate
+        rng = np.random.RandomState(seed)
+        words = set()
+        while len(words) < vocab_size:
+            words.add(''.join(rng.choice(_SYLLABLES, size=rng.randint(2, 5))))
+        self.vocab = sorted(words)
+        rng.shuffle(self.vocab)
+        probs = 1.0 / np.arange(1, vocab_size + 1) ** 1.1
+        self.word_cdf = np.cumsum(probs / probs.sum())
+        self.entity_names = sorted(GENES) + sorted(DISEASES)
+
+    def _words(self, rng, n):
+        return [self.vocab[i] for i in np.minimum(np.searchsorted(self.word_cdf, rng.random_sample(n)),
+                                                  len(self.vocab) - 1)]
+
+    def _sentence(self, rng, doc_sent_no, sec_id, entities):
+        words = self._words(rng, rng.randint(6, 26))
+        for pos in np.flatnonzero(rng.random_sample(len(words)) < self.entity_rate):
+            words[pos] = self.entity_names[rng.randint(len(self.entity_names))]
+        words[0] = words[0].capitalize()
+        text = ' '.join(words) + '.'
+        offset = 0
+        for word in words:
+            name = word.lower()
+            if name in GENES:
+                entities.append((sec_id, doc_sent_no, offset, offset + len(word), 'gene', GENES[name]))
+            elif name in DISEASES:
+                entities.append((sec_id, doc_sent_no, offset, offset + len(word), 'disease', DISEASES[name]))
+            offset += len(word) + 1
+        return text
+
+    def documents(self):
+        rng = np.random.RandomState(self.seed + 1)
+        total = 0
+        doc_no = 0
+        while total < self.num_sentences:
+            cord_uid = 'syn%07d' % doc_no
+            title = ' '.join(w.capitalize() for w in self._words(rng, rng.randint(5, 12)))
+            if rng.random_sample() < self.covid_rate:
+                title += ' in COVID-19'
+            sections = {0: title}
+            sentences = [(0, 0, 0, title)]
+            entities = []
+            num_abstract = rng.randint(1, 3)
+            for sec_id in range(1, num_abstract + 1 + rng.randint(1, 10)):
+                offset = 0
+                texts = []
+                for sent_no in range(rng.randint(1, 8)):
+                    text = self._sentence(rng, len(sentences), sec_id, entities)
+                    sentences.append((sec_id, sent_no, offset, text))
+                    texts.append(text)
+                    offset += len(text) + 1
+                sections[sec_id] = ' '.join(texts)
+            total += len(sentences)
+            metadata = {'cord_uid': cord_uid, 'sha': '%040x' % (doc_no * 2654435761 + self.seed),
+                        'source_x': 'synthetic', 'title': title, 'doi': '10.0000/syn.%d' % doc_no,
+                        'pmcid': 'PMC%d' % (1000000 + doc_no) if rng.random_sample() < 0.3 else '',
+                        'pubmed_id': str(30000000 + doc_no), 'license': 'cc-by',
+                        'abstract': ' '.join(sections[s] for s in range(1, num_abstract + 1)),
+                        'publish_time': '%d-%02d-%02d' % (rng.randint(2015, 2021), rng.randint(1, 13),
+                                                          rng.randint(1, 29)),
+                        'authors': '; '.join('%s, %s.' % (w.capitalize(), w[0].upper())
+                                             for w in self._words(rng, rng.randint(1, 15))),
+                        'journal': 'Journal of %s' % self._words(rng, 1)[0].capitalize()}
+            yield SyntheticDocument(cord_uid, metadata, sections, num_abstract, sentences, entities)
+            doc_no += 1
+
+
+def befree_line(cord_uid, sec_id, doc_sent_no, start, end, entity_type, cid, mention):
+    """A BeFree output line, parse_befree_output reads the columns 0, 5, 6, 7 and 11."""
+    return '\t'.join([cord_uid, mention, 'TEXT', entity_type.upper(), '0', str(sec_id),
+                      str(doc_sent_no), cid, 'befree', '1.0', mention.lower(), '%d#%d' % (start, end)]) + '\n'
+
+
+def write_data_dir(data_dir, corpus, model=None, batch_size=10000):
+    """Writes everything SearchTool(data_dir, model=model) needs, returns the number of sentences.
+
+    The sentence vectors are model's embeddings of the preprocessed sentences, as encode_sentences computes
+    them, a HashingSent2vecModel by default.
+    """
+    t = time.time()
+    os.makedirs(data_dir, exist_ok=True)
+    model = model or HashingSent2vecModel()
+    preprocessor = SentencePreprocessor()
+    sections = SectionStoreWriter(data_dir)
+    meta = SentenceMetadataWriter(data_dir)
+    spans = SpanIndexWriter(data_dir)
+    raw_file = '%s/all.raw' % data_dir
+    pending = []
+
+    def embed_pending(fout):
+        if pending:
+            fout.write(model.embed_sentences(preprocessor.batch(pending)).astype(np.float32).tobytes())
+            del pending[:]
+
+    with open('%s/metadata.csv' % data_dir, 'w') as meta_csv, open(raw_file, 'wb') as raw, \
+            open('%s/disease.befree' % data_dir, 'w') as disease_out, \
+            open('%s/gene.befree' % data_dir, 'w') as gene_out:
+        writer = csv.DictWriter(meta_csv, fieldnames=METADATA_FIELDS)
+        writer.writeheader()
+        for doc in corpus.documents():
+            writer.writerow(doc.metadata)
+            sections.add(doc.cord_uid, doc.sections)
+            meta.append([[doc.cord_uid, sec_id, sent_no, text] for sec_id, sent_no, _, text in doc.sentences])
+            pending.extend(text for _, _, _, text in doc.sentences)
+            if len(pending) >= batch_size:
+                embed_pending(raw)
+            sent_starts = [offset for _, _, offset, _ in doc.sentences]
+            sec_links = {sec_id: [] for sec_id in doc.sections}
+            sec_sent_starts = {sec_id: [] for sec_id in doc.sections}
+            for sec_id, _, offset, _ in doc.sentences:
+                sec_sent_starts[sec_id].append(offset)
+            for sec_id, doc_sent_no, start, end, entity_type, cid in doc.entities:
+                mention = doc.sections[sec_id][sent_starts[doc_sent_no] + start:sent_starts[doc_sent_no] + end]
+                line = befree_line(doc.cord_uid, sec_id, doc_sent_no, start, end, entity_type, cid, mention)
+                (gene_out if entity_type == 'gene' else disease_out).write(line)
+                url, alt_url = gene_urls(cid, {}) if entity_type == 'gene' else disease_urls(cid)
+                link = {'start': sent_starts[doc_sent_no] + start, 'end': sent_starts[doc_sent_no] + end,
+                        'type': entity_type, 'url': url}
+                if alt_url is not None:
+                    link['alt_url'] = alt_url
+                sec_links[sec_id].append(link)
+            spans.add_document(doc.cord_uid, {sec_id: (sec_links[sec_id], sec_sent_starts[sec_id])
+                                              for sec_id in doc.sections})
+        embed_pending(raw)
+    sections.close()
+    meta.close()
+    spans.close()
+
+    raw = np.memmap(raw_file, dtype=np.float32, mode='r').reshape(-1, model.get_emb_size())
+    vectors = create_vectors(data_dir, raw.shape)
+    for start in range(0, raw.shape[0], 100000):
+        vectors[start:(start + 100000)] = unit_norm(np.array(raw[start:(start + 100000)]))
+    vectors.flush()
+    write_info(data_dir, vectors.shape)
+    del raw
+    os.remove(raw_file)
+    logging.info('Wrote %s documents with %s sentences to %s in %s seconds', len(meta.doc_names), len(meta), data_dir,
+                 time.time() - t)
+    return len(meta)
+
+
+def write_release(release_dir, corpus):
+    """Writes the corpus as json files for setup_corpus, returns the number of documents."""
+    os.makedirs('%s/pdf_json' % release_dir, exist_ok=True)
+    os.makedirs('%s/pmc_json' % release_dir, exist_ok=True)
+    num_docs = 0
+    with open('%s/metadata.csv' % release_dir, 'w') as meta_csv, open('%s/file-list' % release_dir, 'w') as files:
+        writer = csv.DictWriter(meta_csv, fieldnames=METADATA_FIELDS)
+        writer.writeheader()
+        for doc in corpus.documents():
+            writer.writerow(doc.metadata)
+            if doc.metadata['pmcid']:
+                filename = '%s/pmc_json/%s.xml.json' % (release_dir, doc.metadata['pmcid'])
+                paper_id = doc.metadata['pmcid']
+            else:
+                filename = '%s/pdf_json/%s.json' % (release_dir, doc.metadata['sha'])
+                paper_id = doc.metadata['sha']
+            sec_ids = sorted(doc.sections)[1:]
+            paper = {'paper_id': paper_id, 'metadata': {'title': doc.sections[0]},
+                     'abstract': [{'text': doc.sections[s]} for s in sec_ids[:doc.num_abstract]],
+                     'body_text': [{'text': doc.sections[s]} for s in sec_ids[doc.num_abstract:]]}
+            with open(filename, 'w') as fout:
+                json.dump(paper, fout)
+            files.write(filename + '\n')
+            num_docs += 1
+    return num_docs
+
@@ -0,0 +1,58 @@
+import hashlib
+import os
+
+from absl import app
+from absl import flags
+from absl import logging
+
+from kdcovid.section_store import load_sections
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string('old_sections', '2020-04-03/all_sections.pkl', 'all sections pickle of the previous release')
+flags.DEFINE_string('new_sections', '2020-04-10/all_sections.pkl', 'all sections pickle of the new release')
+flags.DEFINE_string('out_file', '2020-04-10/corpus_diff.tsv', 'tab separated cord_uid, status of every changed document')
+
+logging.set_verbosity(logging.INFO)
+
+STATUSES = ['added', 'removed', 'changed', 'unchanged']
+
+
+def document_hash(sections):
+    sha = hashlib.sha1()
+    for sec_id in sorted(sections.keys()):
+        sha.update(('%s\t%s\n' % (sec_id, sections[sec_id])).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def diff_sections(old_sections, new_sections):
+    """Maps every cord_uid in either release to one of STATUSES."""
+    diff = dict()
+    for cord_uid, sections in new_sections.items():
+        if cord_uid not in old_sections:
+            diff[cord_uid] = 'added'
+        elif document_hash(sections) != document_hash(old_sections[cord_uid]):
+            diff[cord_uid] = 'changed'
+        else:
+            diff[cord_uid] = 'unchanged'
+    for cord_uid in old_sections:
+        if cord_uid not in new_sections:
+            diff[cord_uid] = 'removed'
+    return diff
+
+
+def main(argv):
+    logging.info('Running with args %s', str(argv))
+    # Uses the section store next to the pickle path when setup_corpus wrote one.
+    old_sections = load_sections(os.path.dirname(FLAGS.old_sections) or '.', FLAGS.old_sections)
+    new_sections = load_sections(os.path.dirname(FLAGS.new_sections) or '.', FLAGS.new_sections)
+    diff = diff_sections(old_sections, new_sections)
+    with open(FLAGS.out_file, 'w') as fout:
+        for cord_uid, status in sorted(diff.items()):
+            if status != 'unchanged':
+                fout.write('%s\t%s\n' % (cord_uid, status))
+    for status in STATUSES:
+        logging.info('%s documents: %s', status, sum(1 for s in diff.values() if s == status))
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -643,13 +643,22 @@ def main(argv):
                                  gv_prefix='http://kdcovid.nl/', legacy_metadata=False)
         from collections import defaultdict
         results = defaultdict(str)
+        queries, recents, covids, kdocs = [], [], [], []
         for task, questions in task_questions.task2questions.items():
             for q, recent, covid in questions:
-                html_res = search_tool.get_search_results(q, recent, covid)
-                results[q] = html_res
+                queries.append(q)
+                recents.append(recent)
+                covids.append(covid)
+                kdocs.append(20)
 
         for q, recent, covid in task_questions.example_queries:
-            html_res = search_tool.get_search_results(q, recent, covid, Kdocs=5)
+            queries.append(q)
+            recents.append(recent)
+            covids.append(covid)
+            kdocs.append(5)
+
+        html_results = search_tool.get_search_results_batch(queries, recents, covids, Kdocs=kdocs)
+        for q, html_res in zip(queries, html_results):
             results[q] = html_res
 
         with open(FLAGS.out_dir + '/cached_results.pkl', 'wb') as fout:
@@ -0,0 +1,75 @@
+import time
+
+import numpy as np
+import torch
+from absl import logging
+
+from kdcovid.sentence_filters import _sentence_columns
+
+RETRIEVAL_MODES = ['sentence', 'document']
+
+# Queries scored at once in document mode, each needs a float32 score for every sentence.
+QUERY_BATCH_SIZE = 16
+
+
+class DocumentSegments(object):
+    """The rows of all_vecs grouped into one segment per document.
+
+    A document scores as its best sentence. topk takes the max over each segment of the sentence scores and
+    picks the top documents directly, instead of grouping the top K sentences by document.
+    """
+
+    def __init__(self, all_meta, legacy_metadata=False):
+        t = time.time()
+        doc_codes, _, _ = _sentence_columns(all_meta, legacy_metadata)
+        doc_codes = np.asarray(doc_codes)
+        num_runs = 1 + int(np.count_nonzero(np.diff(doc_codes))) if len(doc_codes) else 0
+        # gather_sentence_embeddings writes the sentences of a document next to each other, otherwise the
+        # scores are permuted into document order first.
+        self.order = None
+        if num_runs != len(np.unique(doc_codes)):
+            self.order = np.argsort(doc_codes, kind='stable')
+            doc_codes = doc_codes[self.order]
+        self.starts = np.flatnonzero(np.concatenate([[True], doc_codes[1:] != doc_codes[:-1]])) if len(
+            doc_codes) else np.zeros(0, dtype=np.int64)
+        self.ends = np.append(self.starts[1:], len(doc_codes))
+        logging.info('Built %s document segments over %s sentences in %s seconds', len(self.starts), len(doc_codes),
+                     time.time() - t)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def topk(self, scores, Kdocs, sentences_per_doc=3):
+        """The best sentences_per_doc sentences of each of the Kdocs best documents.
+
+        scores is a (num queries x num sentences) tensor, masked out sentences score -inf. Returns (distances,
+        indices) arrays of num queries x (Kdocs * sentences_per_doc) rows of all_vecs, by document score and
+        then sentence score. Indices are -1 past the documents and sentences that scored.
+        """
+        scores = scores.cpu().numpy()
+        if self.order is not None:
+            scores = scores[:, self.order]
+        num_queries = scores.shape[0]
+        k = min(Kdocs, len(self.starts))
+        distances = np.full((num_queries, Kdocs * sentences_per_doc), -np.inf, dtype=np.float32)
+        indices = np.full((num_queries, Kdocs * sentences_per_doc), -1, dtype=np.int64)
+        if k == 0:
+            return distances, indices
+        doc_scores = np.maximum.reduceat(scores, self.starts, axis=1)
+        doc_values, docs = torch.topk(torch.from_numpy(doc_scores), k, dim=1)
+        doc_values, docs = doc_values.numpy(), docs.numpy()
+        for q in range(num_queries):
+            col = 0
+            for d in docs[q][np.isfinite(doc_values[q])]:
+                segment = scores[q, self.starts[d]:self.ends[d]]
+                n = min(sentences_per_doc, len(segment))
+                best = np.argpartition(-segment, n - 1)[:n]
+                best = best[np.argsort(-segment[best], kind='stable')]
+                best = best[np.isfinite(segment[best])]
+                rows = self.starts[d] + best
+                if self.order is not None:
+                    rows = self.order[rows]
+                distances[q, col:col + len(rows)] = segment[best]
+                indices[q, col:col + len(rows)] = rows
+                col += len(rows)
+        return distances, indices
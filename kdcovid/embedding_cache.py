@@ -0,0 +1,70 @@
+import glob
+import hashlib
+import os
+import time
+import uuid
+
+import numpy as np
+from absl import logging
+
+# Sentence vectors keyed by a hash of the preprocessed sentence text, so re-encoding a new corpus release
+# only runs the model on sentences it has not seen before. The cache is specific to one model, use a
+# separate cache_dir per model file. It is stored as append only segments
+#   <cache_dir>/<segment>.keys.npy     sorted 16 byte blake2b digests of the preprocessed text
+#   <cache_dir>/<segment>.vectors.npy  float32 vectors, in the order of the keys
+# Every segment is memory mapped and looked up with a binary search. Concurrent encode jobs can share a
+# cache_dir since each of them writes its own segments.
+
+KEY_DTYPE = 'S16'
+
+
+def sentence_key(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+
+def sentence_keys(texts):
+    return np.array([sentence_key(t) for t in texts], dtype=KEY_DTYPE)
+
+
+class EmbeddingCache(object):
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.segments = []
+        for keys_file in sorted(glob.glob('%s/*.keys.npy' % cache_dir)):
+            vectors_file = keys_file.replace('.keys.npy', '.vectors.npy')
+            if os.path.exists(vectors_file):
+                self.segments.append((np.load(keys_file, mmap_mode='r'), np.load(vectors_file, mmap_mode='r')))
+        logging.info('Loaded embedding cache %s with %s vectors in %s segments', cache_dir, len(self), len(self.segments))
+
+    def __len__(self):
+        return sum(keys.shape[0] for keys, _ in self.segments)
+
+    def lookup(self, keys, out):
+        """Copies the cached vectors of keys into the matching rows of out, returns a boolean array marking
+        the keys that were found."""
+        found = np.zeros(keys.shape[0], dtype=np.bool_)
+        for segment_keys, segment_vectors in self.segments:
+            if segment_keys.shape[0] == 0:
+                continue
+            todo = np.where(~found)[0]
+            pos = np.minimum(np.searchsorted(segment_keys, keys[todo]), segment_keys.shape[0] - 1)
+            hit = segment_keys[pos] == keys[todo]
+            out[todo[hit]] = segment_vectors[pos[hit]]
+            found[todo[hit]] = True
+        return found
+
+    def add(self, keys, vectors):
+        """Writes keys and their vectors as a new segment."""
+        if keys.shape[0] == 0:
+            return
+        keys, first = np.unique(keys, return_index=True)
+        segment = '%s/%s-%s' % (self.cache_dir, time.strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:12])
+        # The vectors are written first, a segment is only read once its keys file exists.
+        np.save(segment + '.vectors.npy', np.asarray(vectors[first], dtype=np.float32))
+        np.save(segment + '.keys.npy', keys)
+        self.segments.append((np.load(segment + '.keys.npy', mmap_mode='r'),
+                              np.load(segment + '.vectors.npy', mmap_mode='r')))
+        logging.info('Added %s vectors to embedding cache %s', keys.shape[0], self.cache_dir)
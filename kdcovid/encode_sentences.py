@@ -1,6 +1,7 @@
+import multiprocessing
+import os
 import pickle
 import time
-from string import punctuation
 
 import nltk
 import numpy as np
@@ -9,8 +10,11 @@ from absl import app
 from absl import flags
 from absl import logging
 from nltk import sent_tokenize
-from nltk import word_tokenize
-from nltk.corpus import stopwords
+
+from kdcovid.embedding_cache import EmbeddingCache
+from kdcovid.embedding_cache import sentence_keys
+from kdcovid.section_store import load_sections
+from kdcovid.tokenizer import preprocess_sentences
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string('model_file', '2020-04-10/BioSentVec_PubMed_MIMICIII-bigram_d700.bin', 'model path')
@@ -18,9 +22,15 @@ flags.DEFINE_string('out_dir', '2020-04-10/sent2vec/', 'out path')
 flags.DEFINE_integer('chunk', 0, 'which chunk')
 flags.DEFINE_integer('chunk_size', 2500, 'how many files')
 flags.DEFINE_string('all_sections', '2020-04-10/all_sections.pkl', 'all sections pickle file')
+flags.DEFINE_integer('workers', 1, 'number of encoding processes')
+flags.DEFINE_integer('batch_size', 2048, 'sentences per embed_sentences call')
+flags.DEFINE_string('embedding_cache_dir', None, 'reuse the vectors of sentences encoded by earlier runs of the same model')
 
 logging.set_verbosity(logging.INFO)
 
+# Set in the parent before the pool forks, or by _init_worker in each worker otherwise.
+_worker_model = None
+
 
 def load_sents(all_sections, key):
     sents = []
@@ -34,82 +44,169 @@ def load_sents(all_sections, key):
     return sents
 
 
+def load_model(model_path):
+    logging.info('loading model...')
+    model = sent2vec.Sent2vecModel()
+    try:
+        model.load_model(model_path)
+    except Exception as e:
+        print(e)
+    logging.info('model successfully loaded')
+    return model
+
+
+def embed_batch(model, sentences):
+    return model.embed_sentences(preprocess_sentences(sentences)).astype(np.float32)
+
+
+def _init_worker(model_path):
+    global _worker_model
+    if _worker_model is None:
+        _worker_model = load_model(model_path)
+
+
+def _preprocess_worker(sentences):
+    return preprocess_sentences(sentences)
+
+
+def _embed_worker(batch):
+    ids, texts = batch
+    return ids, _worker_model.embed_sentences(texts).astype(np.float32)
+
+
+def chunk_keys(all_sections, chunk=0, chunk_size=2500):
+    sorted_keys = list(all_sections.keys())
+    sorted(sorted_keys)
+    return sorted_keys[(chunk * chunk_size):((chunk + 1) * chunk_size)]
+
+
 def main(argv):
 
     logging.info('Running with args %s', str(argv))
 
     nltk.download('punkt')
-    with open(FLAGS.all_sections, 'rb') as fin:
-        all_sections = pickle.load(fin)
-
-    model_path = FLAGS.model_file
-    chunk = FLAGS.chunk
-    chunk_size = FLAGS.chunk_size
+    # Reads only the documents of this chunk if setup_corpus wrote a section store next to all_sections.
+    all_sections = load_sections(os.path.dirname(FLAGS.all_sections) or '.', FLAGS.all_sections)
 
-    chunk_vecs, chunk_meta = encode(all_sections, model_path, chunk, chunk_size)
-
-    np.save(FLAGS.out_dir + '/chunk_%s.vectors.npy' % FLAGS.chunk, np.vstack(chunk_vecs))
+    cache = EmbeddingCache(FLAGS.embedding_cache_dir) if FLAGS.embedding_cache_dir else None
+    chunk_meta = encode_to_file(all_sections, FLAGS.out_dir + '/chunk_%s.vectors.npy' % FLAGS.chunk,
+                                FLAGS.model_file, FLAGS.chunk, FLAGS.chunk_size, workers=FLAGS.workers,
+                                batch_size=FLAGS.batch_size, cache=cache)
 
     with open(FLAGS.out_dir + '/chunk_%s.sentences.pkl' % FLAGS.chunk, 'wb') as fout:
         pickle.dump(chunk_meta, fout)
 
-def encode(all_sections, model_path=None, chunk=0, chunk_size=2500, model=None):
-    logging.info('loading model...')
-    if model is None:
-        model = sent2vec.Sent2vecModel()
-        try:
-            model.load_model(model_path)
-        except Exception as e:
-            print(e)
-        logging.info('model successfully loaded')
 
-    stop_words = set(stopwords.words('english'))
+def encode_to_file(all_sections, out_file, model_path=None, chunk=0, chunk_size=2500, workers=1, batch_size=2048,
+                   model=None, cache=None):
+    """Encodes the sentences of one chunk of documents straight into a float32 .npy file.
+
+    The sentences are split up front so the output can be preallocated as a memory map, then preprocessed
+    and embedded in batches of batch_size with the model's embed_sentences. With workers > 1 the batches
+    are spread over a process pool. When processes fork, the model loaded here is shared with the workers
+    copy on write, otherwise each worker loads its own copy once from model_path. A model given without a
+    model_path cannot be loaded by the workers, so without fork it is used in this process instead.
+
+    If an EmbeddingCache is given, sentences whose preprocessed text is in the cache reuse the stored
+    vector, every distinct new text is embedded once and then added to the cache.
+    Returns the sentence metadata in row order.
+    """
+    global _worker_model
+    keys = chunk_keys(all_sections, chunk, chunk_size)
+    logging.info('Running on keys %s...', str(keys[0:5]))
 
+    t = time.time()
     chunk_meta = []
-    chunk_vecs = []
+    for k in keys:
+        chunk_meta.extend(load_sents(all_sections, k))
+    logging.info('Split %s documents into %s sentences in %s seconds', len(keys), len(chunk_meta), time.time() - t)
 
-    sorted_keys = list(all_sections.keys())
-    sorted(sorted_keys)
+    if model is None:
+        model = load_model(model_path)
+    vectors = np.lib.format.open_memmap(out_file, mode='w+', dtype=np.float32,
+                                        shape=(len(chunk_meta), model.get_emb_size()))
+    if workers > 1 and model_path is None and multiprocessing.get_start_method() != 'fork':
+        logging.warning('Workers started with %s cannot share the given model, encoding in this process. '
+                        'Pass model_path to encode with %s workers.', multiprocessing.get_start_method(), workers)
+        workers = 1
+    if workers > 1:
+        _worker_model = model
+        pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(model_path,))
+        imap = pool.imap
+    else:
+        pool = None
+        imap = map
+
+    t = time.time()
+    texts = []
+    for batch_texts in imap(_preprocess_worker, [[m[3] for m in chunk_meta[start:(start + batch_size)]]
+                                                 for start in range(0, len(chunk_meta), batch_size)]):
+        texts.extend(batch_texts)
+    logging.info('Preprocessed %s sentences in %s seconds', len(texts), time.time() - t)
+
+    todo = np.arange(len(texts))
+    if cache is not None:
+        text_keys = sentence_keys(texts)
+        found = cache.lookup(text_keys, vectors)
+        missing = np.where(~found)[0]
+        _, first, inverse = np.unique(text_keys[missing], return_index=True, return_inverse=True)
+        todo = missing[first]
+        logging.info('Found %s of %s sentences in the embedding cache, %s distinct sentences left to embed',
+                     int(found.sum()), len(texts), todo.shape[0])
+
+    t = time.time()
+    done = 0
+    batches = [(todo[start:(start + batch_size)], [texts[i] for i in todo[start:(start + batch_size)]])
+               for start in range(0, todo.shape[0], batch_size)]
+    if pool is not None:
+        results = pool.imap_unordered(_embed_worker, batches)
+    else:
+        results = ((ids, model.embed_sentences(batch_texts).astype(np.float32)) for ids, batch_texts in batches)
+    for ids, batch_vectors in results:
+        vectors[ids] = batch_vectors
+        done += batch_vectors.shape[0]
+        logging.info('Embedded %s of %s sentences | %s seconds', done, todo.shape[0], time.time() - t)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if cache is not None:
+        # Sentences repeated within the chunk were only embedded once.
+        vectors[missing] = vectors[todo][inverse.reshape(-1)]
+        cache.add(text_keys[todo], vectors[todo])
+    vectors.flush()
+    logging.info('Done! Processed %s Sentences | %s seconds', len(chunk_meta), time.time() - t)
+    return chunk_meta
 
-    chunk_keys = sorted_keys[(chunk * chunk_size):((chunk + 1) * chunk_size)]
 
-    logging.info('Running on keys %s...', str(chunk_keys[0:5]))
+def encode(all_sections, model_path=None, chunk=0, chunk_size=2500, model=None):
+    if model is None:
+        model = load_model(model_path)
 
-    def preprocess_sentence(text):
-        text = text.replace('/', ' / ')
-        text = text.replace('.-', ' .- ')
-        text = text.replace('.', ' . ')
-        text = text.replace('\'', ' \' ')
-        text = text.lower()
+    chunk_meta = []
+    chunk_vecs = []
 
-        tokens = [token for token in word_tokenize(text) if token not in punctuation and token not in stop_words]
+    keys = chunk_keys(all_sections, chunk, chunk_size)
 
-        return ' '.join(tokens)
+    logging.info('Running on keys %s...', str(keys[0:5]))
 
-    for k_idx, k in enumerate(chunk_keys):
+    for k_idx, k in enumerate(keys):
         s_doc = time.time()
-        logging.info('key %s (%s of %s) ', k, k_idx, len(chunk_keys))
+        logging.info('key %s (%s of %s) ', k, k_idx, len(keys))
         sentences = load_sents(all_sections, k)
 
-        dim = model.get_emb_size()
-        vectors = np.zeros((len(sentences), dim))
-        gt = time.time
-        t = gt()
-        counter = 0
-        for doc_id, sec_id, sentence_id, s in sentences:
-            vectors[counter] = model.embed_sentence(preprocess_sentence(s))
-            logging.log_every_n(logging.INFO, 'Processed %s sentences | %s seconds', 10, sentence_id, str(gt() - t))
-            counter += 1
-        e_t = gt()
-        logging.info('Done! Processed %s Sentences | %s seconds', len(sentences), str(e_t - t))
+        t = time.time()
+        vectors = np.zeros((len(sentences), model.get_emb_size()), dtype=np.float32)
+        if sentences:
+            vectors = embed_batch(model, [s for _, _, _, s in sentences])
+        logging.info('Done! Processed %s Sentences | %s seconds', len(sentences), str(time.time() - t))
         chunk_meta.extend(sentences)
         chunk_vecs.append(vectors)
         e_doc = time.time()
-        logging.info('key %s (%s of %s)... %s seconds ', k, k_idx, len(chunk_keys), e_doc - s_doc)
+        logging.info('key %s (%s of %s)... %s seconds ', k, k_idx, len(keys), e_doc - s_doc)
     return chunk_vecs, chunk_meta
 
 def run_encode():
     app.run(main)
 
 if __name__ == "__main__":
-    run_encode()
\ No newline at end of file
+    run_encode()
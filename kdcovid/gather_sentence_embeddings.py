@@ -1,5 +1,8 @@
 
+import glob
+import os
 import pickle
+import re
 
 from absl import flags
 from absl import app
@@ -7,43 +10,119 @@ from absl import logging
 import time
 import numpy as np
 
+from kdcovid.ann_index import build_index
+from kdcovid.ann_index import exact_search
+from kdcovid.ann_index import index_file
+from kdcovid.ann_index import recall_at_k
+from kdcovid.meta_store import SentenceMetadataWriter
+from kdcovid.vector_store import create_vectors
+from kdcovid.vector_store import QUANTIZED_DTYPES
+from kdcovid.vector_store import save_quantized
+from kdcovid.vector_store import unit_norm
+from kdcovid.vector_store import write_info
+
 FLAGS = flags.FLAGS
 flags.DEFINE_string('sent2vec_dir', '2020-04-10/sent2vec/', 'out path')
-flags.DEFINE_integer('num_chunks', 36, 'how many files')
+flags.DEFINE_integer('num_chunks', None, 'how many files, by default every chunk_N.vectors.npy in sent2vec_dir')
+flags.DEFINE_integer('block_size', 100000, 'rows copied and normalized at a time')
 flags.DEFINE_string('out_dir', '2020-04-10/', 'out path')
+flags.DEFINE_boolean('pickle_meta', False, 'also write the sentence metadata as the legacy all.pkl list')
+flags.DEFINE_string('vector_dtype', 'float32', 'also write a float16 or int8 (per vector scaled) copy of all.npy')
+flags.DEFINE_string('index_type', 'exact', 'approximate nn index to build next to all.npy (exact builds none, or ivf)')
+flags.DEFINE_integer('index_nlist', 4096, 'number of inverted lists in the ivf index')
+flags.DEFINE_integer('index_nprobe', 32, 'default number of lists an ivf query visits')
+flags.DEFINE_integer('index_recall_queries', 100, 'number of corpus sentences used to check the index recall')
+flags.DEFINE_integer('index_recall_k', 100, 'K used to check the index recall')
 
 logging.set_verbosity(logging.INFO)
 
-def load_all_vectors(num_chunks):
-    all_vectors = []
+def chunk_ids(sent2vec_dir, num_chunks=None):
+    if num_chunks is not None:
+        return list(range(num_chunks))
+    found = [re.match(r'chunk_(\d+)\.vectors\.npy$', os.path.basename(f))
+             for f in glob.glob('%s/chunk_*.vectors.npy' % sent2vec_dir)]
+    return sorted(int(m.group(1)) for m in found if m is not None)
+
+
+def load_all_vectors(chunks, out_dir, meta_writer=None, block_size=100000, sent2vec_dir=None):
+    """Copies the chunks into a preallocated all.npy in out_dir, unit norming them block by block.
+
+    The output shape is read from the chunk headers, so at most one block of a chunk is in memory at a
+    time. Metadata rows go to meta_writer as each chunk is copied, or are returned as a list without one.
+    The chunks are read from sent2vec_dir, FLAGS.sent2vec_dir by default.
+    """
+    if sent2vec_dir is None:
+        sent2vec_dir = FLAGS.sent2vec_dir
+    if not chunks:
+        raise ValueError('No chunks to gather, expected files matching %s/chunk_*.vectors.npy' % sent2vec_dir)
+    shapes = [np.load(sent2vec_dir + '/chunk_%s.vectors.npy' % chunk_id, mmap_mode='r').shape
+              for chunk_id in chunks]
+    all_vec = create_vectors(out_dir, (sum(shape[0] for shape in shapes), shapes[0][1]))
+    logging.info('Gathering %s chunks into shape %s' % (len(chunks), str(all_vec.shape)))
     meta_data = []  # (doc_id, section_id, sentence_id, sentence)
-    for chunk_id in range(num_chunks):
+    offset = 0
+    for chunk_id in chunks:
         logging.info('Processing file %s', chunk_id)
         t = time.time()
-        vectors = np.load(FLAGS.sent2vec_dir + '/chunk_%s.vectors.npy' % chunk_id).astype(np.float32)
-        with open(FLAGS.sent2vec_dir + '/chunk_%s.sentences.pkl' % chunk_id, 'rb') as fin:
+        vectors = np.load(sent2vec_dir + '/chunk_%s.vectors.npy' % chunk_id, mmap_mode='r')
+        with open(sent2vec_dir + '/chunk_%s.sentences.pkl' % chunk_id, 'rb') as fin:
             meta = pickle.load(fin)
+        if len(meta) != vectors.shape[0]:
+            raise ValueError('chunk %s has %s vectors but %s sentences' % (chunk_id, vectors.shape[0], len(meta)))
 
-        vector_norms = np.linalg.norm(vectors, axis=1, keepdims=True)
-        vector_norms[vector_norms == 0] = 1.0
-        vectors /= vector_norms
-        all_vectors.append(vectors)
-        meta_data.extend(meta)
+        for start in range(0, vectors.shape[0], block_size):
+            block = unit_norm(np.array(vectors[start:(start + block_size)], dtype=np.float32))
+            all_vec[(offset + start):(offset + start + block.shape[0])] = block
+        offset += vectors.shape[0]
+        if meta_writer is not None:
+            meta_writer.append(meta)
+        else:
+            meta_data.extend(meta)
         e = time.time()
 
         logging.info('Finished processing chunk %s in %s seconds', chunk_id, str(e-t))
-    all_vec = np.concatenate(all_vectors)
-    logging.info('Concatenated shape %s' % str(all_vec.shape))
+    all_vec.flush()
+    write_info(out_dir, all_vec.shape)
     return all_vec, meta_data
 
 
 def main(argv):
     logging.info('Running reduce vecs with args %s', str(argv))
-    logging.info('Running on %s files', str(FLAGS.num_chunks))
-    all_vecs, all_meta = load_all_vectors(FLAGS.num_chunks)
-    np.save('%s/all.npy' % FLAGS.out_dir, all_vecs)
-    with open('%s/all.pkl' % FLAGS.out_dir, 'wb') as fout:
-        pickle.dump(all_meta, fout)
+    if FLAGS.vector_dtype != 'float32' and FLAGS.vector_dtype not in QUANTIZED_DTYPES:
+        raise ValueError('Unknown vector dtype %s, expected float32 or one of %s' % (FLAGS.vector_dtype,
+                                                                                    QUANTIZED_DTYPES))
+    chunks = chunk_ids(FLAGS.sent2vec_dir, FLAGS.num_chunks)
+    logging.info('Running on %s files', len(chunks))
+    if FLAGS.pickle_meta:
+        all_vecs, all_meta = load_all_vectors(chunks, FLAGS.out_dir, block_size=FLAGS.block_size)
+        with open('%s/all.pkl' % FLAGS.out_dir, 'wb') as fout:
+            pickle.dump(all_meta, fout)
+    else:
+        meta_writer = SentenceMetadataWriter(FLAGS.out_dir)
+        all_vecs, _ = load_all_vectors(chunks, FLAGS.out_dir, meta_writer, block_size=FLAGS.block_size)
+        meta_writer.close()
+        logging.info('Wrote metadata for %s sentences', len(meta_writer))
+    if FLAGS.vector_dtype != 'float32':
+        t = time.time()
+        save_quantized(FLAGS.out_dir, all_vecs, FLAGS.vector_dtype)
+        logging.info('Wrote %s vectors in %s seconds', FLAGS.vector_dtype, time.time() - t)
+    if FLAGS.index_type != 'exact':
+        build_ann_index(all_vecs, FLAGS.index_type, FLAGS.out_dir)
+
+
+def build_ann_index(all_vecs, index_type, out_dir):
+    t = time.time()
+    index = build_index(index_type, all_vecs, nlist=FLAGS.index_nlist, nprobe=FLAGS.index_nprobe)
+    index.save(index_file(out_dir, index_type))
+    logging.info('Saved %s index in %s seconds', index_type, time.time() - t)
+
+    # Check the index against exact search, using a sample of the corpus sentences as queries.
+    rng = np.random.RandomState(0)
+    queries = all_vecs[rng.choice(all_vecs.shape[0], min(FLAGS.index_recall_queries, all_vecs.shape[0]), replace=False)]
+    _, exact_indices = exact_search(queries, all_vecs, FLAGS.index_recall_k)
+    _, approx_indices = index.search(queries, all_vecs, FLAGS.index_recall_k)
+    logging.info('%s index recall@%s = %s', index_type, FLAGS.index_recall_k, recall_at_k(approx_indices, exact_indices))
+    return index
 
 
 if __name__ == "__main__":
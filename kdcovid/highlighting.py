@@ -0,0 +1,162 @@
+import re
+from collections import deque
+
+ENTITY_TEMPLATE = """
+                <mark class="entity" style="background: {bg}; padding: 0.15em 0.15em; margin: 0 0.25em; line-height: 1.5; border-radius: 0.15em">
+                    {text}
+                    <span style="font-size: 0.8em; font-weight: bold; line-height: 1.5; border-radius: 0.15em; text-transform: uppercase; vertical-align: middle; margin-right: 0.15rem"><a href="{link}" target="_blank" style="text-decoration: none;  color: black;">{label}</a></span>
+                </mark>
+                """
+
+HIGHLIGHT_TEMPLATE = """
+                <mark class="entity" style="background: {bg}; padding: 0.15em 0.15em; margin: 0 0.25em; line-height: 1.5; border-radius: 0.15em">
+                    {text}
+                    <span style="font-size: 0.8em; font-weight: bold; line-height: 1.5; border-radius: 0.15em; text-transform: uppercase; vertical-align: middle; margin-right: 0.15rem">{label}</span>
+                </mark>
+                """
+
+ENTITY_LABEL = """<i class="fa">&#xf08e;</i>"""
+HIGHLIGHT_LABEL = 'Highlight'
+
+
+def compile_template(template):
+    """Splits template into literal text and field names, so it can be filled with a single join."""
+    parts = re.split(r'\{(bg|text|link|label)\}', template)
+    return [(i % 2 == 1, p) for i, p in enumerate(parts) if p or i % 2 == 1]
+
+
+_ENTITY = compile_template(ENTITY_TEMPLATE)
+_HIGHLIGHT = compile_template(HIGHLIGHT_TEMPLATE)
+
+
+def fill(compiled, values):
+    return ''.join([values[p] if is_field else p for is_field, p in compiled])
+
+
+def entity_string(text, color, label, link):
+    # Chained str.replace also substitutes placeholders that appear inside the values, only take the
+    # single join when none of them can contain one.
+    if not (isinstance(link, str) and '{' not in text and '{' not in color and '{' not in link):
+        return ENTITY_TEMPLATE.replace("{bg}", color).replace("{link}", link).replace("{text}", text).replace(
+            "{label}", label)
+    return fill(_ENTITY, {'bg': color, 'text': text, 'link': link, 'label': label})
+
+
+def highlight_string(text, color, label):
+    if '{' in text or '{' in color:
+        return HIGHLIGHT_TEMPLATE.replace("{bg}", color).replace("{text}", text).replace("{label}", label)
+    return fill(_HIGHLIGHT, {'bg': color, 'text': text, 'label': label})
+
+
+class _Unsupported(Exception):
+    pass
+
+
+class _Rewriter(object):
+    """The text being rewritten: an untouched prefix of the original text followed by pieces.
+
+    Spans are replaced right to left, so each replacement starts at or before the previous one and only
+    touches the prefix and the first pieces. Replacing a span therefore costs its own length, instead of
+    copying the whole text as slicing and concatenating does.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.boundary = len(text)
+        self.pieces = deque()
+        self.pieces_len = 0
+
+    def _take(self, num_chars):
+        taken = []
+        while num_chars > 0:
+            piece = self.pieces.popleft()
+            if len(piece) > num_chars:
+                self.pieces.appendleft(piece[num_chars:])
+                piece = piece[:num_chars]
+            taken.append(piece)
+            num_chars -= len(piece)
+            self.pieces_len -= len(piece)
+        return ''.join(taken)
+
+    def replace(self, start, end, render):
+        if start < 0 or end < start or start > self.boundary or end > self.boundary + self.pieces_len:
+            raise _Unsupported()
+        if end <= self.boundary:
+            region = self.text[start:end]
+            rest = self.text[end:self.boundary]
+            if rest:
+                self.pieces.appendleft(rest)
+                self.pieces_len += len(rest)
+        else:
+            region = self.text[start:self.boundary] + self._take(end - self.boundary)
+        replacement = render(region)
+        self.pieces.appendleft(replacement)
+        self.pieces_len += len(replacement)
+        self.boundary = start
+        return len(replacement) - (end - start)
+
+    def result(self):
+        return self.text[:self.boundary] + ''.join(self.pieces)
+
+
+class _SlicingRewriter(object):
+    """Rewrites the whole text for every span, for the span layouts _Rewriter does not support."""
+
+    def __init__(self, text):
+        self.text = text
+
+    def replace(self, start, end, render):
+        replacement = render(self.text[start:end])
+        self.text = self.text[:start] + replacement + self.text[end:]
+        return len(replacement) - (end - start)
+
+    def result(self):
+        return self.text
+
+
+def _rewrite(rewriter, entities, highlights, colors, entities_sorted=False):
+    # spans = [(start, end, link, type), ...]
+    if entities_sorted:
+        entities = list(entities)
+    else:
+        entities = sorted(entities, key=lambda x: (x[0], x[1]))
+    highlights = [list(h) for h in sorted(highlights, key=lambda x: (x[0], x[1]))]
+
+    def entity(span):
+        s, e, t, link = span
+        return rewriter.replace(s, e, lambda text: entity_string(text, colors[t], ENTITY_LABEL, link))
+
+    def highlight(span):
+        s, e, t, _ = span
+        return rewriter.replace(s, e, lambda text: highlight_string(text, colors[t], HIGHLIGHT_LABEL))
+
+    while entities and highlights:
+        last_e = entities[-1]
+        last_h = highlights[-1]
+        # if e is candidate and is not overlapping
+        if last_e[0] > last_h[1]:
+            entity(entities.pop())
+        elif last_e[1] > last_h[0]:
+            # The highlight grows to cover the html of the entity.
+            last_h[1] += entity(entities.pop())
+        else:  # h goes
+            highlight(highlights.pop())
+    while entities:
+        entity(entities.pop())
+    while highlights:
+        highlight(highlights.pop())
+    return rewriter.result()
+
+
+def highlight_texts(larger_text, entities, highlights, colors, entities_sorted=False):
+    """Wraps the entity and highlight spans of larger_text in their html marks.
+
+    Spans are rendered from the last to the first. A span that overlaps one that is already rendered covers
+    part of its html, a highlight that overlaps an entity grows to cover all of the entity's html. When a
+    span starts inside html that is already rendered, the text is rewritten by slicing instead. Pass
+    entities_sorted if the entities are already sorted by (start, end), e.g. when they come from a SpanIndex.
+    """
+    try:
+        return _rewrite(_Rewriter(larger_text), entities, highlights, colors, entities_sorted)
+    except _Unsupported:
+        return _rewrite(_SlicingRewriter(larger_text), entities, highlights, colors, entities_sorted)
@@ -0,0 +1,114 @@
+import json
+import os
+import pickle
+from array import array
+
+import numpy as np
+
+# Columnar replacement for all.pkl. Every sentence row [doc_id, sec_id, sent_idx, sentence_text] is split into
+#   all.meta.doc_names.json   list of distinct doc ids
+#   all.meta.doc_codes.npy    int32 index into doc_names per sentence
+#   all.meta.sec_ids.npy      int32 section id per sentence
+#   all.meta.sent_ids.npy     int32 sentence index within the section
+#   all.meta.num_words.npy    int32 number of whitespace separated words in the sentence
+#   all.meta.text_offsets.npy int64 byte offsets (num sentences + 1) into
+#   all.meta.text.bin         utf-8 text of all sentences back to back
+# The arrays and the text blob are memory mapped, so rows are only decoded for the hits that are displayed.
+
+
+def meta_file(data_dir, name):
+    return '%s/all.meta.%s' % (data_dir, name)
+
+
+def meta_store_exists(data_dir):
+    return os.path.exists(meta_file(data_dir, 'doc_names.json'))
+
+
+class SentenceMetadata(object):
+    """Read only, list like view of the sentence metadata. Indexing returns [doc_id, sec_id, sent_idx, text]."""
+
+    def __init__(self, data_dir):
+        with open(meta_file(data_dir, 'doc_names.json')) as fin:
+            self.doc_names = json.load(fin)
+        self.doc_codes = np.load(meta_file(data_dir, 'doc_codes.npy'), mmap_mode='r')
+        self.sec_ids = np.load(meta_file(data_dir, 'sec_ids.npy'), mmap_mode='r')
+        self.sent_ids = np.load(meta_file(data_dir, 'sent_ids.npy'), mmap_mode='r')
+        self.text_offsets = np.load(meta_file(data_dir, 'text_offsets.npy'), mmap_mode='r')
+        self.num_words = None
+        if os.path.exists(meta_file(data_dir, 'num_words.npy')):
+            self.num_words = np.load(meta_file(data_dir, 'num_words.npy'), mmap_mode='r')
+        if os.path.getsize(meta_file(data_dir, 'text.bin')) > 0:
+            self.text = np.memmap(meta_file(data_dir, 'text.bin'), dtype=np.uint8, mode='r')
+        else:
+            self.text = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return self.doc_codes.shape[0]
+
+    def doc_id(self, idx):
+        return self.doc_names[self.doc_codes[idx]]
+
+    def sentence(self, idx):
+        return self.text[self.text_offsets[idx]:self.text_offsets[idx + 1]].tobytes().decode('utf-8')
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('sentence index %s out of range' % idx)
+        return [self.doc_id(idx), int(self.sec_ids[idx]), int(self.sent_ids[idx]), self.sentence(idx)]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+class SentenceMetadataWriter(object):
+    """Streams [doc_id, sec_id, sent_idx, text] rows into the columnar format read by SentenceMetadata."""
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.doc2code = dict()
+        self.doc_names = []
+        self.doc_codes = array('i')
+        self.sec_ids = array('i')
+        self.sent_ids = array('i')
+        self.num_words = array('i')
+        self.text_offsets = array('q', [0])
+        self.text_out = open(meta_file(data_dir, 'text.bin'), 'wb')
+
+    def __len__(self):
+        return len(self.doc_codes)
+
+    def append(self, rows):
+        for doc_id, sec_id, sent_idx, text in rows:
+            if doc_id not in self.doc2code:
+                self.doc2code[doc_id] = len(self.doc_names)
+                self.doc_names.append(doc_id)
+            self.doc_codes.append(self.doc2code[doc_id])
+            self.sec_ids.append(sec_id)
+            self.sent_ids.append(sent_idx)
+            self.num_words.append(len(text.split()))
+            encoded = text.encode('utf-8')
+            self.text_out.write(encoded)
+            self.text_offsets.append(self.text_offsets[-1] + len(encoded))
+
+    def close(self):
+        self.text_out.close()
+        np.save(meta_file(self.data_dir, 'doc_codes.npy'), np.frombuffer(self.doc_codes, dtype=np.int32))
+        np.save(meta_file(self.data_dir, 'sec_ids.npy'), np.frombuffer(self.sec_ids, dtype=np.int32))
+        np.save(meta_file(self.data_dir, 'sent_ids.npy'), np.frombuffer(self.sent_ids, dtype=np.int32))
+        np.save(meta_file(self.data_dir, 'num_words.npy'), np.frombuffer(self.num_words, dtype=np.int32))
+        np.save(meta_file(self.data_dir, 'text_offsets.npy'), np.frombuffer(self.text_offsets, dtype=np.int64))
+        # Written last, meta_store_exists keys off of it.
+        with open(meta_file(self.data_dir, 'doc_names.json'), 'w') as fout:
+            json.dump(self.doc_names, fout)
+
+
+def load_metadata(data_dir):
+    if meta_store_exists(data_dir):
+        return SentenceMetadata(data_dir)
+    with open('%s/all.pkl' % data_dir, 'rb') as fin:
+        return pickle.load(fin)
@@ -0,0 +1,177 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds, from a tenth of a millisecond to ten seconds.
+LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0]
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for k, v in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Histogram(object):
+    """Counts of observations per bucket, with their sum, like a prometheus histogram."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = list(buckets)
+        # counts[i] is the number of observations in (buckets[i - 1], buckets[i]], the last one is above all buckets.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[idx] += 1
+            self.sum += value
+            self.count += 1
+
+    def cumulative_counts(self):
+        with self.lock:
+            counts = list(self.counts)
+        total = 0
+        cumulative = []
+        for c in counts:
+            total += c
+            cumulative.append(total)
+        return cumulative
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile, inf if it is above the largest bucket."""
+        cumulative = self.cumulative_counts()
+        if not cumulative[-1]:
+            return None
+        idx = bisect.bisect_left(cumulative, q * cumulative[-1])
+        return self.buckets[idx] if idx < len(self.buckets) else float('inf')
+
+
+class StageTimer(object):
+    """Seconds spent in each stage of one request.
+
+    Stages may nest, the time of a nested stage is not counted in the stage around it, so the stages of a
+    request add up to its total time.
+    """
+
+    def __init__(self):
+        self.seconds = dict()
+        self.stack = []
+
+    @contextmanager
+    def stage(self, name):
+        now = time.perf_counter()
+        if self.stack:
+            parent = self.stack[-1]
+            self.seconds[parent[0]] = self.seconds.get(parent[0], 0.0) + now - parent[1]
+        self.stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            _, start = self.stack.pop()
+            self.seconds[name] = self.seconds.get(name, 0.0) + now - start
+            if self.stack:
+                self.stack[-1][1] = now
+
+
+class MetricsRegistry(object):
+    """Named counters and histograms, each with any number of label values.
+
+    counter(name, **labels) and histogram(name, **labels) return the metric of those label values, creating
+    it on first use. export_text() renders everything in the prometheus text format.
+    """
+
+    def __init__(self):
+        # name -> (type, help, buckets, {sorted label items: metric})
+        self.families = dict()
+        self.lock = threading.Lock()
+
+    def _get(self, kind, name, help, buckets, labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if name not in self.families:
+                self.families[name] = (kind, help, buckets, dict())
+            family_kind, _, family_buckets, children = self.families[name]
+            if family_kind != kind:
+                raise ValueError('%s is a %s, not a %s' % (name, family_kind, kind))
+            if key not in children:
+                children[key] = Counter() if kind == 'counter' else Histogram(family_buckets)
+            return children[key]
+
+    def counter(self, name, help='', **labels):
+        return self._get('counter', name, help, None, labels)
+
+    def histogram(self, name, help='', buckets=LATENCY_BUCKETS, **labels):
+        return self._get('histogram', name, help, buckets, labels)
+
+    @contextmanager
+    def timer(self, name, help='', **labels):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.histogram(name, help, **labels).observe(time.perf_counter() - t)
+
+    def observe_stages(self, name, stage_timer, help='', **labels):
+        for stage, seconds in stage_timer.seconds.items():
+            self.histogram(name, help, stage=stage, **labels).observe(seconds)
+
+    def _sorted_families(self):
+        with self.lock:
+            return [(name, kind, help, sorted(children.items()))
+                    for name, (kind, help, _, children) in sorted(self.families.items())]
+
+    def export_text(self):
+        lines = []
+        for name, kind, help, children in self._sorted_families():
+            if help:
+                lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, metric in children:
+                if kind == 'counter':
+                    lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(metric.value)))
+                    continue
+                for bound, count in zip(metric.buckets + [float('inf')], metric.cumulative_counts()):
+                    lines.append('%s_bucket%s %s' % (name, _format_labels(labels, [('le', _format_value(bound))]),
+                                                     count))
+                lines.append('%s_sum%s %s' % (name, _format_labels(labels), _format_value(metric.sum)))
+                lines.append('%s_count%s %s' % (name, _format_labels(labels), metric.count))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """{name: [(labels, value)]}, value is a count or a dict with count, sum, p50, p90 and p99."""
+        result = dict()
+        for name, kind, _, children in self._sorted_families():
+            result[name] = []
+            for labels, metric in children:
+                if kind == 'counter':
+                    value = metric.value
+                else:
+                    value = {'count': metric.count, 'sum': metric.sum, 'p50': metric.quantile(0.5),
+                             'p90': metric.quantile(0.9), 'p99': metric.quantile(0.99)}
+                result[name].append((dict(labels), value))
+        return result
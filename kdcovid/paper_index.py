@@ -0,0 +1,208 @@
+import csv
+import datetime
+import hashlib
+import os
+import pickle
+import re
+import time
+from collections.abc import Mapping
+
+import numpy as np
+from absl import logging
+from dateutil import parser as dateparser
+
+DEFAULT_DATE = "2019"
+EPOCH = datetime.datetime(1970, 1, 1)
+
+covid_strings = ["covid-19", "covid19", "covid", "sars-cov-2",
+                 "sars-cov2", "sarscov2", "novel coronavirus",
+                 "2019-ncov", "2019ncov"]
+covid_pattern = re.compile('|'.join(covid_strings), re.IGNORECASE)
+
+
+def check_covid(paper):
+    return covid_pattern.search(paper["title"] + " " + paper["abstract"]) is not None
+
+
+def to_epoch(date):
+    """Seconds since 1970 of a datetime or date string, naive datetimes are taken to be UTC."""
+    if isinstance(date, str):
+        date = dateparser.parse(date)
+    if date.tzinfo is not None:
+        date = date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return int((date - EPOCH).total_seconds())
+
+
+def _parse_date(publish_time):
+    try:
+        date = dateparser.parse(publish_time)
+    except:
+        date = dateparser.parse(DEFAULT_DATE)
+    return to_epoch(date)
+
+
+def cache_file(metadata_file):
+    return '%s.index.pkl' % metadata_file
+
+
+def _file_stamp(filename):
+    stat = os.stat(filename)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def _file_hash(filename):
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as fin:
+        for block in iter(lambda: fin.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class StringColumn(object):
+    """Immutable column of strings.
+
+    Columns with few distinct values (journal, license, ...) are stored as codes into a list of interned
+    values, the rest as one utf-8 blob with offsets. Both unpickle as a handful of buffers instead of one
+    python object per cell, and cells are only decoded when they are read.
+    """
+
+    def __init__(self, values):
+        distinct = dict()
+        codes = np.zeros(len(values), dtype=np.int32)
+        for idx, v in enumerate(values):
+            codes[idx] = distinct.setdefault(v, len(distinct))
+        if len(distinct) <= len(values) // 2:
+            self.values = [None] * len(distinct)
+            for v, code in distinct.items():
+                self.values[code] = v
+            self.codes = codes
+            self.blob = None
+            self.offsets = None
+        else:
+            encoded = [v.encode('utf-8') for v in values]
+            self.values = None
+            self.codes = None
+            self.blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+            self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(e) for e in encoded], out=self.offsets[1:])
+
+    def __getitem__(self, idx):
+        if self.codes is not None:
+            return self.values[self.codes[idx]]
+        return self.blob[self.offsets[idx]:self.offsets[idx + 1]].tobytes().decode('utf-8')
+
+
+class PaperRecord(Mapping):
+    """Read only view of one metadata.csv row, along with the derived 'covid' and 'date' fields."""
+
+    def __init__(self, index, row):
+        self.index = index
+        self.row = row
+
+    def __getitem__(self, key):
+        if key == 'covid':
+            return bool(self.index.covid[self.row])
+        if key == 'date':
+            return EPOCH + datetime.timedelta(seconds=int(self.index.dates[self.row]))
+        return self.index.columns[key][self.row]
+
+    def __iter__(self):
+        return iter(list(self.index.column_names) + ['covid', 'date'])
+
+    def __len__(self):
+        return len(self.index.column_names) + 2
+
+
+class PaperIndex(object):
+    """metadata.csv parsed into columns: publish dates as int64 epoch seconds, a covid boolean array and
+    string columns for everything else. Indexing by paper id returns a PaperRecord.
+    """
+
+    def __init__(self, paper_ids, column_names, columns, covid, dates):
+        self.paper_ids = paper_ids
+        self.column_names = column_names
+        self.columns = columns
+        self.covid = covid
+        self.dates = dates
+        self.id2row = {paper_id: row for row, paper_id in enumerate(paper_ids)}
+
+    @classmethod
+    def build(cls, metadata_file, paper_id_field='cord_uid'):
+        rows = dict()
+        with open(metadata_file) as f:
+            reader = csv.DictReader(f, delimiter=',')
+            column_names = reader.fieldnames
+            for paper in reader:
+                rows[paper[paper_id_field]] = paper
+        paper_ids = list(rows.keys())
+        papers = list(rows.values())
+        columns = {name: StringColumn([p[name] or '' for p in papers]) for name in column_names}
+        covid = np.array([check_covid(p) for p in papers], dtype=np.bool_)
+        dates = np.array([_parse_date(p['publish_time']) for p in papers], dtype=np.int64)
+        return cls(paper_ids, column_names, columns, covid, dates)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['id2row']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.id2row = {paper_id: row for row, paper_id in enumerate(self.paper_ids)}
+
+    def __contains__(self, paper_id):
+        return paper_id in self.id2row
+
+    def __getitem__(self, paper_id):
+        return PaperRecord(self, self.id2row[paper_id])
+
+    def __len__(self):
+        return len(self.paper_ids)
+
+    def __iter__(self):
+        return iter(self.paper_ids)
+
+    def rows(self, paper_ids, missing=-1):
+        """Row numbers of paper_ids, with missing for ids that are not in metadata.csv."""
+        return np.array([self.id2row.get(p, missing) for p in paper_ids], dtype=np.int64)
+
+
+def _write_cache(metadata_file, cached):
+    try:
+        with open(cache_file(metadata_file), 'wb') as fout:
+            pickle.dump(cached, fout, protocol=pickle.HIGHEST_PROTOCOL)
+    except IOError as e:
+        logging.warning('Could not write paper index cache %s: %s', cache_file(metadata_file), e)
+
+
+def load_paper_index(metadata_file, paper_id_field='cord_uid', use_cache=True):
+    """Loads the parsed index of metadata_file, rebuilding it when metadata.csv changed.
+
+    The cache is keyed by the size and mtime of metadata.csv. If those changed but the sha1 of the file
+    did not, e.g. after a copy, the cache is still used and rewritten with the new size and mtime.
+    """
+    t = time.time()
+    stamp = _file_stamp(metadata_file)
+    if use_cache and os.path.exists(cache_file(metadata_file)):
+        with open(cache_file(metadata_file), 'rb') as fin:
+            cached = pickle.load(fin)
+        valid = cached['paper_id_field'] == paper_id_field
+        if valid and (cached['size'], cached['mtime']) != (stamp['size'], stamp['mtime']):
+            valid = cached['sha1'] == _file_hash(metadata_file)
+            if valid:
+                # Same content under a new stamp, record it so later loads skip hashing the file.
+                cached.update(stamp)
+                _write_cache(metadata_file, cached)
+        if valid:
+            logging.info('Loaded cached paper index %s in %s seconds', cache_file(metadata_file), time.time() - t)
+            return cached['index']
+        logging.info('Paper index cache %s is stale, rebuilding', cache_file(metadata_file))
+
+    index = PaperIndex.build(metadata_file, paper_id_field)
+    logging.info("Found %d covid papers from %d total" % (int(index.covid.sum()), len(index)))
+    if use_cache:
+        cached = {'paper_id_field': paper_id_field, 'sha1': _file_hash(metadata_file), 'index': index}
+        cached.update(stamp)
+        _write_cache(metadata_file, cached)
+    logging.info('Built paper index in %s seconds', time.time() - t)
+    return index
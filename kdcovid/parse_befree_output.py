@@ -1,77 +1,245 @@
+import itertools
+from multiprocessing import Pool
+
+import numpy as np
+from absl import app
+from absl import flags
+from absl import logging
 from tqdm import tqdm
 import nltk
 
-def parse_befree_output(doc2sec2text, disease_output, gene_output, gene_mapping={}):
+from kdcovid.section_store import load_sections
+from kdcovid.span_index import disease_urls
+from kdcovid.span_index import ENTITY_TYPES
+from kdcovid.span_index import gene_urls
+from kdcovid.span_index import save_span_arrays
+from kdcovid.span_index import UrlPool
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string('data_dir', '2020-04-10', 'directory with the section store or all_sections.pkl, '
+                                              'the span index is written here')
+flags.DEFINE_string('disease_output', None, 'BeFree disease output')
+flags.DEFINE_string('gene_output', None, 'BeFree gene output')
+flags.DEFINE_string('gene_mapping', None, 'optional tab separated entrez gene id, uniprot id file')
+flags.DEFINE_integer('workers', 1, 'processes used to split sections into sentences')
+flags.DEFINE_integer('chunk_size', 100000, 'BeFree lines parsed at a time')
+
+
+_punkt = None
+
+
+def _sentence_tokenizer():
+    global _punkt
+    if _punkt is None:
+        _punkt = nltk.data.load('tokenizers/punkt/english.pickle')
+    return _punkt
+
+
+def section_sentence_starts(section):
+    """Character offset of each sentence of a section, split as sent_tokenize does."""
+    return [span[0] for span in _sentence_tokenizer().span_tokenize(section)]
+
+
+def _document_sentence_starts(item):
+    sha, doc = item
+    return sha, [(sec_num, section_sentence_starts(section)) for sec_num, section in doc.items()]
+
+
+class SentenceTable(object):
+    """Sentence offsets of the whole corpus in flat arrays.
+
+    Documents get codes in the order of doc2sec2text. Sentences are numbered per document over its sections in
+    document order, as BeFree numbers them, the section table is sorted by (document code, sec_id) as in the
+    span index.
+    """
+
+    def __init__(self, doc2sec2text, workers=1):
+        self.doc_names = []
+        starts = []
+        sec_docs, sec_ids, sec_firsts, sec_counts = [], [], [], []
+        doc_firsts, doc_counts = [], []
+        total = 0
+        items = doc2sec2text.items()
+        pool = Pool(workers) if workers > 1 else None
+        results = pool.imap(_document_sentence_starts, items, chunksize=64) if pool else map(
+            _document_sentence_starts, items)
+        for sha, sections in tqdm(results, total=len(doc2sec2text), desc="calculating character offsets"):
+            doc_firsts.append(total)
+            for sec_num, sec_starts in sections:
+                sec_docs.append(len(self.doc_names))
+                sec_ids.append(sec_num)
+                sec_firsts.append(total)
+                sec_counts.append(len(sec_starts))
+                starts.extend(sec_starts)
+                total += len(sec_starts)
+            doc_counts.append(total - doc_firsts[-1])
+            self.doc_names.append(sha)
+        if pool:
+            pool.close()
+            pool.join()
+        self.doc2code = {sha: code for code, sha in enumerate(self.doc_names)}
+        self.starts = np.asarray(starts, dtype=np.int32)
+        self.doc_firsts = np.asarray(doc_firsts, dtype=np.int64)
+        self.doc_counts = np.asarray(doc_counts, dtype=np.int64)
+        sec_docs = np.asarray(sec_docs, dtype=np.int64)
+        sec_ids = np.asarray(sec_ids, dtype=np.int64)
+        order = np.lexsort((sec_ids, sec_docs))
+        self.sec_docs = sec_docs[order]
+        self.sec_ids = sec_ids[order]
+        self.doc_offsets = np.searchsorted(self.sec_docs, np.arange(len(self.doc_names) + 1)).astype(np.int64)
+        counts = np.asarray(sec_counts, dtype=np.int64)[order]
+        self.sent_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        # Sentence starts by section table row, gathered from the document order.
+        firsts = np.asarray(sec_firsts, dtype=np.int64)[order]
+        self.sorted_starts = self.starts[np.repeat(firsts - self.sent_offsets[:-1], counts) +
+                                         np.arange(self.sent_offsets[-1])]
+        self.min_sec_id = int(self.sec_ids.min()) if len(self.sec_ids) else 0
+        self.sec_range = int(self.sec_ids.max()) - self.min_sec_id + 1 if len(self.sec_ids) else 1
+        self.sec_keys = self.sec_docs * self.sec_range + (self.sec_ids - self.min_sec_id)
+
+    def doc_codes(self, shas):
+        """Document codes of an array of shas, -1 for documents that are not in the corpus."""
+        unique, inverse = np.unique(shas, return_inverse=True)
+        return np.asarray([self.doc2code.get(sha, -1) for sha in unique.tolist()], dtype=np.int64)[inverse]
+
+    def section_rows(self, docs, sec_ids):
+        """Section table rows, -1 where the document has no such section."""
+        in_range = (sec_ids >= self.min_sec_id) & (sec_ids < self.min_sec_id + self.sec_range)
+        keys = docs * self.sec_range + (sec_ids - self.min_sec_id)
+        rows = np.minimum(np.searchsorted(self.sec_keys, keys), max(len(self.sec_keys) - 1, 0))
+        found = in_range & (docs >= 0) & (len(self.sec_keys) > 0)
+        found[found] = self.sec_keys[rows[found]] == keys[found]
+        return np.where(found, rows, -1)
+
+    def sentence_starts(self, docs, sent_nos):
+        """Character offsets in their sections of the sentences, -1 where the document has no such sentence."""
+        found = (docs >= 0)
+        found[found] = (sent_nos[found] >= 0) & (sent_nos[found] < self.doc_counts[docs[found]])
+        starts = np.full(len(docs), -1, dtype=np.int64)
+        starts[found] = self.starts[self.doc_firsts[docs[found]] + sent_nos[found]]
+        return starts
+
+
+def read_chunks(lines, chunk_size):
+    """Lists of up to chunk_size nonempty lines."""
+    lines = iter(lines)
+    while True:
+        chunk = list(itertools.islice(lines, chunk_size))
+        if not chunk:
+            return
+        chunk = [l for l in chunk if l.strip()]
+        if chunk:
+            yield chunk
+
+
+class BefreeSpanParser(object):
+    """Parses BeFree output a chunk of lines at a time into typed span columns.
+
+    Each column is converted with numpy, urls are built once per distinct concept id and interned in the url
+    pool of the span index in data_dir.
+    """
+
+    def __init__(self, sentences, data_dir, gene_mapping={}):
+        self.sentences = sentences
+        self.data_dir = data_dir
+        self.gene_mapping = gene_mapping
+        self.urls = UrlPool(data_dir)
+        self.columns = {name: [] for name in ['rows', 'starts', 'ends', 'types', 'urls', 'alt_urls', 'order']}
+        self.num_lines = 0
+        self.num_dropped = 0
+
+    def add_chunk(self, lines, entity_type):
+        rows = [l.strip().split('\t') for l in lines]
+        shas = np.array([r[0] for r in rows])
+        pars = np.array([r[5] for r in rows]).astype(np.int64)
+        sens = np.array([r[6] for r in rows]).astype(np.int64)
+        locs = np.char.partition(np.array([r[11] for r in rows]), '#')
+        sids = locs[:, 0].astype(np.int64)
+        eids = locs[:, 2].astype(np.int64)
+        cids, cid_inverse = np.unique(np.array([r[7] for r in rows]), return_inverse=True)
+        if entity_type == 'gene':
+            cid_urls = [gene_urls(cid, self.gene_mapping) for cid in cids.tolist()]
+        else:
+            cid_urls = [disease_urls(cid) for cid in cids.tolist()]
+        urls = np.asarray([self.urls.url_id(u) for u, _ in cid_urls], dtype=np.int32)[cid_inverse]
+        alt_urls = np.asarray([self.urls.url_id(a) for _, a in cid_urls], dtype=np.int32)[cid_inverse]
+
+        docs = self.sentences.doc_codes(shas)
+        sec_rows = self.sentences.section_rows(docs, pars)
+        sent_starts = self.sentences.sentence_starts(docs, sens)
+        keep = (sec_rows >= 0) & (sent_starts >= 0)
+        self.num_dropped += len(rows) - int(keep.sum())
+        self.columns['rows'].append(sec_rows[keep])
+        self.columns['starts'].append((sent_starts + sids)[keep])
+        self.columns['ends'].append((sent_starts + eids)[keep])
+        self.columns['types'].append(np.full(int(keep.sum()), ENTITY_TYPES.index(entity_type), dtype=np.int8))
+        self.columns['urls'].append(urls[keep])
+        self.columns['alt_urls'].append(alt_urls[keep])
+        self.columns['order'].append(self.num_lines + np.flatnonzero(keep))
+        self.num_lines += len(rows)
+
+    def add_output(self, befree_output, entity_type, chunk_size=100000):
+        for chunk in tqdm(read_chunks(befree_output, chunk_size), desc="parsing %ss" % entity_type):
+            self.add_chunk(chunk, entity_type)
+
+    def save(self):
+        """Writes the span index. Within a section the spans are sorted by (start, end), ties keep the genes
+        first and file order, as SpanIndexWriter does for combined links."""
+        columns = {name: np.concatenate(values) if values else np.zeros(0, dtype=np.int64)
+                   for name, values in self.columns.items()}
+        order = np.lexsort((columns['order'], columns['types'], columns['ends'], columns['starts'], columns['rows']))
+        sentences = self.sentences
+        url_offsets = self.urls.close()
+        save_span_arrays(self.data_dir, sentences.doc_names, {
+            'doc_offsets': sentences.doc_offsets, 'sec_ids': sentences.sec_ids,
+            'span_offsets': np.searchsorted(columns['rows'][order], np.arange(len(sentences.sec_ids) + 1)),
+            'sent_offsets': sentences.sent_offsets, 'url_offsets': url_offsets,
+            'starts': columns['starts'][order], 'ends': columns['ends'][order], 'types': columns['types'][order],
+            'urls': columns['urls'][order], 'alt_urls': columns['alt_urls'][order],
+            'sent_starts': sentences.sorted_starts})
+
+
+def stream_span_index(data_dir, doc2sec2text, disease_output, gene_output, gene_mapping={}, workers=1,
+                      chunk_size=100000):
     '''
 
-    :param doc2sec2text: Data dict
-    :param disease_output: Disease links from BeFree
+    Parses the BeFree output into the span index read by SearchTool, see kdcovid.span_index. Lines for
+    documents, sections or sentences that are not in doc2sec2text are dropped.
+    :param disease_output: Disease links from BeFree, any iterable of lines such as an open file
     :param gene_output: Gene links from BeFree
-    :param gene_mapping: Uniprot gene mappings
-    :return: combined parsed links
+    :param workers: processes used to split sections into sentences
+    :return: the number of dropped lines
     '''
-    # calculate sentence starts
-    sent_start = {}
-    tokenizer = nltk.data.load('tokenizers/punkt/english.pickle')
-    for sha, doc in tqdm(doc2sec2text.items(), desc="calculating character offsets"):
-        sent_start_ids = []
-        for sec_num, section in doc.items():
-            spans = tokenizer.span_tokenize(section)
-            for span in spans:
-                sent_start_ids.append(span[0])
-        sent_start[sha] = sent_start_ids
-    disease_links = {sha: {para_id: [] for para_id in doc} for sha, doc in doc2sec2text.items()}
-
-    for l in tqdm(disease_output, desc="parsing diseases"):
-        line = l.strip().split('\t')
-        sha = line[0]
-        par = int(line[5])
-        sen = int(line[6])
-        cid = line[7]
-        loc = line[11]
-        sid, eid = loc.split('#')
-        sid = int(sid)
-        eid = int(eid)
-        disease_links[sha][par].append({'start': sent_start[sha][sen] + sid,
-                                        'end': sent_start[sha][sen] + eid,
-                                        'type': 'disease',
-                                        'url': 'https://www.ncbi.nlm.nih.gov/medgen/?term={}'.format(cid)})
-
-    gene_links = {sha: {para_id: [] for para_id in doc} for sha, doc in doc2sec2text.items()}
-
-    for l in tqdm(gene_output, desc="parsing genes"):
-        line = l.strip().split('\t')
-        sha = line[0]
-        par = int(line[5])
-        sen = int(line[6])
-        cid = line[7]
-        loc = line[11]
-        sid, eid = loc.split('#')
-        sid = int(sid)
-        eid = int(eid)
-        if '|' in cid:
-            cids = cid.split('|')
-            new_pids = [gene_mapping[cidsi] for cidsi in sorted(cids, key=int) if cidsi in gene_mapping]
-            if len(set(new_pids)) >= 1:
-                url = 'https://www.uniprot.org/uniprot/{}'.format(new_pids[0])
-                alt_url = 'https://www.ncbi.nlm.nih.gov/gene/{}'.format(min([int(v) for v in cids]))
-            else:
-                url = 'https://www.ncbi.nlm.nih.gov/gene/{}'.format(min([int(v) for v in cids]))
-                alt_url = url
-        else:
-            url = 'https://www.uniprot.org/uniprot/{}'.format(
-                gene_mapping[cid]) if cid in gene_mapping else 'https://www.ncbi.nlm.nih.gov/gene/{}'.format(cid)
-            alt_url = 'https://www.ncbi.nlm.nih.gov/gene/{}'.format(cid)
-        gene_links[sha][par].append({'start': sent_start[sha][sen] + sid,
-                                     'end': sent_start[sha][sen] + eid,
-                                     'type': 'gene',
-                                     'url': url,
-                                     'alt_url': alt_url})
-    combinded_links = {sha: {para_id: [] for para_id in doc} for sha, doc in doc2sec2text.items()}
-    for sha, doc in tqdm(doc2sec2text.items(), desc="generating URLs"):
-        for para_id in doc:
-            combinded_links[sha][para_id] += gene_links[sha][para_id] + disease_links[sha][para_id]
-
-
-    return combinded_links
+    sentences = SentenceTable(doc2sec2text, workers)
+    parser = BefreeSpanParser(sentences, data_dir, gene_mapping)
+    parser.add_output(gene_output, 'gene', chunk_size)
+    parser.add_output(disease_output, 'disease', chunk_size)
+    if parser.num_dropped:
+        logging.warning('Dropped %s of %s BeFree lines not matching the corpus', parser.num_dropped,
+                        parser.num_lines)
+    parser.save()
+    return parser.num_dropped
+
+
+def load_gene_mapping(filename):
+    gene_mapping = dict()
+    with open(filename) as fin:
+        for line in fin:
+            fields = line.strip().split('\t')
+            if len(fields) >= 2:
+                gene_mapping[fields[0]] = fields[1]
+    return gene_mapping
+
+
+def main(argv):
+    logging.info('Running with args %s', str(argv))
+    doc2sec2text = load_sections(FLAGS.data_dir)
+    gene_mapping = load_gene_mapping(FLAGS.gene_mapping) if FLAGS.gene_mapping else {}
+    with open(FLAGS.disease_output) as disease_output, open(FLAGS.gene_output) as gene_output:
+        stream_span_index(FLAGS.data_dir, doc2sec2text, disease_output, gene_output, gene_mapping, FLAGS.workers,
+                          FLAGS.chunk_size)
+    logging.info('Wrote span index to %s', FLAGS.data_dir)
+
 
+if __name__ == "__main__":
+    app.run(main)
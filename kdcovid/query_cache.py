@@ -0,0 +1,188 @@
+import hashlib
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from absl import logging
+
+
+def normalize_query(text):
+    return ' '.join(text.lower().split())
+
+
+CORPUS_FILES = ('metadata.csv', 'all.npy', 'all.info.json', 'all.meta.doc_names.json', 'all.pkl', 'all_sections.pkl',
+                'all_sections.index.json', 'combined_links.pickle', 'span_index.doc_names.json', 'all.ivf.npz',
+                'all.float16.npy', 'all.int8.npy', 'all.int8.scales.npy')
+
+
+def corpus_version(data_dir, filenames=CORPUS_FILES, extra_files=(), settings=None):
+    """A string that changes whenever one of the corpus files in data_dir or extra_files is rewritten.
+
+    settings, e.g. the index and retrieval options of a SearchTool, are part of the version too, so results
+    cached under other settings are not served.
+    """
+    def stamp(name, path):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            stamps.append('%s:%s:%s' % (name, stat.st_size, stat.st_mtime))
+
+    stamps = [repr(settings)]
+    for filename in filenames:
+        stamp(filename, '%s/%s' % (data_dir, filename))
+    for path in extra_files:
+        stamp(path, path)
+    return hashlib.sha1('|'.join(stamps).encode('utf-8')).hexdigest()
+
+
+class LRUCache(object):
+    """Thread safe, size bounded LRU cache with an optional time to live per entry.
+
+    If spill_dir is given, evicted entries are pickled there and read back on a later miss, so the
+    in-memory size stays bounded without losing the work that went into them. validate, if given, is
+    called before every lookup, e.g. to clear the cache when the data it was filled from changed.
+    """
+
+    def __init__(self, max_size=256, ttl=None, spill_dir=None, name='cache', validate=None):
+        self.max_size = max_size
+        self.validate = validate
+        self.ttl = ttl
+        self.spill_dir = spill_dir
+        self.name = name
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if spill_dir is not None and not os.path.exists(spill_dir):
+            os.makedirs(spill_dir)
+
+    def _spill_file(self, key):
+        return '%s/%s.%s.pkl' % (self.spill_dir, self.name, hashlib.sha1(repr(key).encode('utf-8')).hexdigest())
+
+    def _expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, key, default=None):
+        if self.validate is not None:
+            self.validate()
+        with self.lock:
+            if key in self.entries:
+                created, value = self.entries[key]
+                if not self._expired(created):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+        entry = self._read_spill(key)
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._insert(key, entry)
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self._insert(key, (time.time(), value))
+
+    def _insert(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            evicted_key, evicted = self.entries.popitem(last=False)
+            self._write_spill(evicted_key, evicted)
+
+    def _write_spill(self, key, entry):
+        if self.spill_dir is None or self._expired(entry[0]):
+            return
+        try:
+            with open(self._spill_file(key), 'wb') as fout:
+                pickle.dump((key, entry), fout, protocol=pickle.HIGHEST_PROTOCOL)
+        except IOError as e:
+            logging.warning('Could not spill %s entry: %s', self.name, e)
+
+    def _read_spill(self, key):
+        if self.spill_dir is None or not os.path.exists(self._spill_file(key)):
+            return None
+        try:
+            with open(self._spill_file(key), 'rb') as fin:
+                spilled_key, entry = pickle.load(fin)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+        if spilled_key != key or self._expired(entry[0]):
+            return None
+        return entry
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            if self.spill_dir is not None:
+                for filename in os.listdir(self.spill_dir):
+                    if filename.startswith(self.name + '.'):
+                        os.remove(os.path.join(self.spill_dir, filename))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+
+class QueryCache(object):
+    """Caches of query embeddings, knn hits and rendered html, all tied to a corpus version.
+
+    Spilled entries go to a per version sub directory of spill_dir, so a restart against a rebuilt corpus
+    never reads results of the old one. Once watch(version_fn) is called, lookups compare version_fn()
+    with the current version at most every check_interval seconds and clear the caches when it changed.
+    """
+
+    def __init__(self, max_size=256, ttl=None, spill_dir=None, version=None, check_interval=1.0):
+        self.spill_dir = spill_dir
+        self.version = version
+        self.version_fn = None
+        self.check_interval = check_interval
+        self.next_check = 0.0
+        self.version_lock = threading.Lock()
+        version_dir = self._version_dir(version)
+        self.embeddings = LRUCache(max_size, ttl, version_dir, name='embeddings', validate=self.check_version)
+        self.knn = LRUCache(max_size, ttl, version_dir, name='knn', validate=self.check_version)
+        self.html = LRUCache(max_size, ttl, version_dir, name='html', validate=self.check_version)
+
+    def _version_dir(self, version):
+        if self.spill_dir is None:
+            return None
+        version_dir = os.path.join(self.spill_dir, str(version))
+        if not os.path.exists(version_dir):
+            os.makedirs(version_dir)
+        return version_dir
+
+    def set_version(self, version):
+        """Drops every cached entry if the corpus version changed."""
+        with self.version_lock:
+            if version != self.version:
+                logging.info('Corpus version changed from %s to %s, clearing query caches', self.version, version)
+                self.clear()
+                self.version = version
+                version_dir = self._version_dir(version)
+                for cache in (self.embeddings, self.knn, self.html):
+                    cache.spill_dir = version_dir
+
+    def watch(self, version_fn):
+        self.version_fn = version_fn
+        self.next_check = time.time() + self.check_interval
+        self.set_version(version_fn())
+
+    def check_version(self):
+        if self.version_fn is None or time.time() < self.next_check:
+            return
+        self.next_check = time.time() + self.check_interval
+        self.set_version(self.version_fn())
+
+    def clear(self):
+        for cache in (self.embeddings, self.knn, self.html):
+            cache.clear()
+
+    def stats(self):
+        return {cache.name: cache.stats() for cache in (self.embeddings, self.knn, self.html)}
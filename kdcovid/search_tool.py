@@ -1,46 +1,117 @@
 import csv
+import functools
 import pickle
+import threading
 import time
-from string import punctuation
 
-import re
 import numpy as np
 import sent2vec
 import torch
 from absl import logging
-from nltk import word_tokenize
 from nltk.corpus import stopwords
 from spacy import displacy
-from dateutil import parser as dateparser
 
-logging.set_verbosity(logging.INFO)
+from kdcovid.ann_index import load_index
+from kdcovid.ann_index import recall_at_k
+from kdcovid.batching import KnnBatcher
+from kdcovid.document_topk import DocumentSegments
+from kdcovid.document_topk import QUERY_BATCH_SIZE
+from kdcovid.document_topk import RETRIEVAL_MODES
+from kdcovid.highlighting import entity_string
+from kdcovid.highlighting import ENTITY_TEMPLATE
+from kdcovid.highlighting import highlight_string
+from kdcovid.highlighting import HIGHLIGHT_TEMPLATE
+from kdcovid.highlighting import highlight_texts
+from kdcovid.meta_store import load_metadata
+from kdcovid.metrics import MetricsRegistry
+from kdcovid.metrics import StageTimer
+from kdcovid.paper_index import load_paper_index
+from kdcovid.paper_index import to_epoch
+from kdcovid.query_cache import corpus_version
+from kdcovid.query_cache import normalize_query
+from kdcovid.query_cache import QueryCache
+from kdcovid.section_store import load_sections
+from kdcovid.sentence_filters import SentenceFilters
+from kdcovid.span_index import span_index_exists
+from kdcovid.span_index import SpanIndex
+from kdcovid.tokenizer import SentencePreprocessor
+from kdcovid.vector_store import load_quantized
+from kdcovid.vector_store import load_vectors
+from kdcovid.vector_store import quantized_topk
+from kdcovid.vector_store import mask_scores
+from kdcovid.vector_store import rerank
+from kdcovid.vector_store import to_numpy
+from kdcovid.vector_store import VectorShards
 
-DEFAULT_DATE = "2019"
+logging.set_verbosity(logging.INFO)
 
-covid_strings = ["covid-19", "covid19", "covid", "sars-cov-2",
-                 "sars-cov2", "sarscov2", "novel coronavirus",
-                 "2019-ncov", "2019ncov"]
-patterns = [re.compile(s, re.IGNORECASE) for s in covid_strings]
+# Stages are preprocess, embed, matmul, topk (all of the search with an ann index or shards) and rerank, timed
+# once per batch of queries, and grouping, section_lookup, entity_lookup and render, timed once per query.
+STAGE_SECONDS = 'kdcovid_search_stage_seconds'
+STAGE_HELP = 'seconds spent in each stage of a search'
+SEARCH_SECONDS = 'kdcovid_search_seconds'
+HITS = 'kdcovid_search_hits_total'
+FILTERED_SENTENCES = 'kdcovid_search_filtered_sentences_total'
+FILTERED_HELP = 'sentences excluded from the results of a query by the short, covid and date filters'
+OUTPUT_BYTES = 'kdcovid_search_output_bytes_total'
 
-def _check_covid(paper):
-  if any(re.search(p, paper["title"] + " " + paper["abstract"])
-         for p in patterns):
-    return True
-  return False
+def _per_query(value, num_queries):
+    if isinstance(value, (list, tuple)):
+        assert len(value) == num_queries, 'expected %s values, got %s' % (num_queries, len(value))
+        return list(value)
+    return [value] * num_queries
 
 class SearchTool(object):
 
     def __init__(self, data_dir='./', use_cached=False, paper_id_field='cord_uid', all_vecs=None, all_meta=None,
                  model=None, metadata_file=None, documents=None, entity_links=None, cached_result_file=None,
-                 gv_prefix="", use_object=True, legacy_metadata=False):
+                 gv_prefix="", use_object=True, legacy_metadata=False, index_type='exact', nprobe=None, ann_index=None,
+                 mmap_vectors=True, vector_dtype='float32', rerank_candidates=300, shard_files=None,
+                 num_threads=None, prefilter=True, cache_size=256, cache_ttl=None, cache_dir=None,
+                 fallback_to_live=False, preload_live=False, span_index=None, retrieval_mode='sentence',
+                 sentences_per_doc=3, batch_window=None, max_batch_size=64, metrics=None):
         t_start = time.time()
+        # Stage latencies and counters of every search, see kdcovid.metrics.
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
         self.cached_results = None
+        self.span_index = None
+        # A model given here is also used by live search instead of loading BioSentVec from data_dir.
+        self.model = model
+        self.sentence_filters = None
+        if retrieval_mode not in RETRIEVAL_MODES:
+            raise ValueError('Unknown retrieval mode %s, expected one of %s' % (retrieval_mode, RETRIEVAL_MODES))
+        # In document mode K is the number of documents and knn returns their sentences_per_doc best sentences.
+        self.retrieval_mode = retrieval_mode
+        self.sentences_per_doc = sentences_per_doc
+        self.document_segments = None
+        # With a batch_window (seconds), concurrent knn calls are scored together, see KnnBatcher.
+        self.knn_batcher = None
+        if batch_window is not None:
+            self.knn_batcher = KnnBatcher(batch_window, max_batch_size)
+        self.data_dir = None
+        self.query_cache = None
+        if cache_size > 0:
+            self.query_cache = QueryCache(cache_size, cache_ttl, cache_dir)
+        self.ann_index = ann_index
+        self.quantized_vecs = None
+        self.rerank_candidates = rerank_candidates
         self.gv_prefix = gv_prefix
         self.use_object = use_object
         self.legacy_metadata = legacy_metadata
+        live_args = dict(paper_id_field=paper_id_field, mmap_vectors=mmap_vectors, vector_dtype=vector_dtype,
+                         shard_files=shard_files, num_threads=num_threads, prefilter=prefilter,
+                         index_type=index_type, nprobe=nprobe)
+        self.fallback_to_live = fallback_to_live
+        self.live_ready = threading.Event()
+        self.live_lock = threading.Lock()
+        self.live_thread = None
+        self.live_error = None
+        self.live_loader = None
         if use_cached:
             with open('%s/cached_results.pkl' % data_dir, 'rb') as fin:
                 self.cached_results = pickle.load(fin)
+            if fallback_to_live:
+                self.live_loader = functools.partial(self.load_live, data_dir, **live_args)
         elif all_vecs is not None:
             self.all_vecs = all_vecs
             self.all_meta = all_meta
@@ -48,202 +119,239 @@ class SearchTool(object):
             t = time.time()
             logging.info('Loading Paper Meta Data...')
             self.paper_id_field = paper_id_field
-            self.paper_index = {}
-            num_covid = 0
-            with open(metadata_file) as f:
-                reader = csv.DictReader(f, delimiter=',')
-                for paper in reader:
-                    self.paper_index[paper[self.paper_id_field]] = paper
-                    self.paper_index[paper[self.paper_id_field]]['covid'] = _check_covid(paper)
-                    try:
-                        self.paper_index[paper[self.paper_id_field]]['date'] = dateparser.parse(paper['publish_time'])
-                    except:
-                        self.paper_index[paper[self.paper_id_field]]['date'] = dateparser.parse(DEFAULT_DATE)
-
-                    try:
-                        num_covid += int(self.paper_index[paper[self.paper_id_field]]['covid'])
-                    except:
-                        pass
-                logging.info("Found %d covid papers from %d total" %
-                             (num_covid, len(self.paper_index)))
+            self.paper_index = load_paper_index(metadata_file, self.paper_id_field)
             logging.info('Loading Paper Meta Data...Done! %s seconds' % (time.time() - t))
             self.doc2sec2text = documents
             self.entity_links = entity_links
+            self.span_index = span_index
+            if prefilter:
+                self.sentence_filters = SentenceFilters(self.all_meta, self.paper_index, self.legacy_metadata)
+            if retrieval_mode == 'document':
+                self.document_segments = DocumentSegments(self.all_meta, self.legacy_metadata)
             if cached_result_file is not None:
                 with open(cached_result_file, 'rb') as fin:
                     self.cached_results = pickle.load(fin)
         else:
-            logging.info('Using data dir %s', data_dir)
-            self.data_dir = data_dir
+            self.load_live(data_dir, **live_args)
 
-            t = time.time()
-            logging.info('Loading Paper Meta Data...')
-            self.paper_id_field = paper_id_field
-            self.paper_index = {}
-            num_covid = 0
-            with open('%s/metadata.csv' % data_dir) as f:
-                reader = csv.DictReader(f, delimiter=',')
-                for paper in reader:
-                    self.paper_index[paper[self.paper_id_field]] = paper
-                    self.paper_index[paper[self.paper_id_field]]['covid'] = _check_covid(paper)
-                    try:
-                        self.paper_index[paper[self.paper_id_field]]['date'] = dateparser.parse(
-                            paper['publish_time'])
-                    except:
-                        self.paper_index[paper[self.paper_id_field]]['date'] = dateparser.parse(DEFAULT_DATE)
-                    try:
-                        num_covid += int(self.paper_index[paper[self.paper_id_field]]['covid'])
-                    except:
-                        pass
-                logging.info("Found %d covid papers from %d total" %
-                             (num_covid, len(self.paper_index)))
-            logging.info('Loading Paper Meta Data...Done! %s seconds' % (time.time() - t))
+        self.colors = {'Highlight': 'linear-gradient(90deg, #aa9cfc, #fc9ce7)', 'disease': '#ffe4b5', 'gene': '#ffa07a'}
+        self.stop_words = set(stopwords.words('english'))
+        self.preprocessor = SentencePreprocessor(self.stop_words)
+        if not use_cached:
+            self.live_ready.set()
+        elif self.live_loader is not None and preload_live:
+            self.start_loading_live()
+        logging.info('Finished setting up constructor in %s seconds' % (time.time() - t_start))
 
-            t = time.time()
-            logging.info('Loading section text...')
-            with open('%s/all_sections.pkl' % data_dir, 'rb') as fin:
-                self.doc2sec2text = pickle.load(fin)
-            logging.info('Loading section text...Done! %s seconds' % (time.time() - t))
+    def load_live(self, data_dir, paper_id_field='cord_uid', mmap_vectors=True, vector_dtype='float32',
+                  shard_files=None, num_threads=None, prefilter=True, index_type='exact', nprobe=None):
+        """Loads everything needed to answer queries that are not in the precomputed results."""
+        logging.info('Using data dir %s', data_dir)
+        self.data_dir = data_dir
+        # Everything besides the corpus files that changes the knn hits or the html of a query.
+        self.cache_settings = dict(paper_id_field=paper_id_field, vector_dtype=vector_dtype, prefilter=prefilter,
+                                   shard_files=list(shard_files or []), index_type=index_type, nprobe=nprobe,
+                                   rerank_candidates=self.rerank_candidates, retrieval_mode=self.retrieval_mode,
+                                   sentences_per_doc=self.sentences_per_doc, legacy_metadata=self.legacy_metadata,
+                                   gv_prefix=self.gv_prefix, use_object=self.use_object)
+        self.refresh_corpus_version()
 
-            t = time.time()
-            logging.info('Loading entity links...')
+        t = time.time()
+        logging.info('Loading Paper Meta Data...')
+        self.paper_id_field = paper_id_field
+        self.paper_index = load_paper_index('%s/metadata.csv' % data_dir, self.paper_id_field)
+        logging.info('Loading Paper Meta Data...Done! %s seconds' % (time.time() - t))
+
+        t = time.time()
+        logging.info('Loading section text...')
+        self.doc2sec2text = load_sections(data_dir)
+        logging.info('Loading section text...Done! %s seconds' % (time.time() - t))
+
+        t = time.time()
+        logging.info('Loading entity links...')
+        if span_index_exists(data_dir):
+            self.span_index = SpanIndex(data_dir)
+            self.entity_links = self.span_index
+        else:
+            logging.warning('No span index in %s, loading all of combined_links.pickle. Convert it with '
+                            'python -m kdcovid.span_index %s to load links per document.', data_dir, data_dir)
             with open('%s/combined_links.pickle' % data_dir, 'rb') as fin:
                 self.entity_links = pickle.load(fin)
-            logging.info('Loading entity links...Done! %s seconds' % (time.time() - t))
+        logging.info('Loading entity links...Done! %s seconds' % (time.time() - t))
 
-            logging.info('Loading sentence vectors...')
-            t = time.time()
-            self.all_vecs = np.load('%s/all.npy' % data_dir)
+        logging.info('Loading sentence vectors...')
+        t = time.time()
+        if shard_files is not None:
+            self.all_vecs = VectorShards(shard_files, num_threads=num_threads)
+            self.all_meta = self.all_vecs.load_metadata()
+        else:
+            self.all_vecs = load_vectors(data_dir, mmap=mmap_vectors)
+            self.all_meta = load_metadata(data_dir)
 
-            with open('%s/all.pkl' % data_dir, 'rb') as fout:
-                self.all_meta = pickle.load(fout)
+        logging.info("%s", self.all_meta[0:5])
+        logging.info('Loading sentence vectors... done! %s seconds' % (time.time() - t))
 
-            logging.info("%s", self.all_meta[0:5])
-            logging.info('Loading sentence vectors... done! %s seconds' % (time.time() - t))
+        if prefilter:
+            self.sentence_filters = SentenceFilters(self.all_meta, self.paper_index, self.legacy_metadata)
+        if self.retrieval_mode == 'document':
+            self.document_segments = DocumentSegments(self.all_meta, self.legacy_metadata)
 
-            logging.info('Unit norming the vectors')
+        if vector_dtype != 'float32':
             t = time.time()
-            norms = np.linalg.norm(self.all_vecs, axis=1, keepdims=True)
-            norms[norms == 0] = 1
-            self.all_vecs /= norms
-            self.all_vecs = torch.from_numpy(self.all_vecs).detach()
-            logging.info('Done unit norming the vectors! %s seconds' % (time.time() - t))
+            logging.info('Loading %s sentence vectors...', vector_dtype)
+            self.quantized_vecs = load_quantized(data_dir, vector_dtype)
+            logging.info('Loading %s sentence vectors...Done! %s seconds' % (vector_dtype, time.time() - t))
 
-            t = time.time()
-            logging.info('Loading BioSentVec Model...')
-            model_path = '%s/BioSentVec_PubMed_MIMICIII-bigram_d700.bin' % data_dir
-            self.model = sent2vec.Sent2vecModel()
-            try:
-                self.model.load_model(model_path)
-            except Exception as e:
-                print(e)
-            logging.info('Loading BioSentVec Model... done! %s seconds' % (time.time() - t))
+        t = time.time()
+        logging.info('Loading %s index...', index_type)
+        self.ann_index = load_index(data_dir, index_type, nprobe=nprobe)
+        logging.info('Loading %s index...Done! %s seconds' % (index_type, time.time() - t))
 
-        self.colors = {'Highlight': 'linear-gradient(90deg, #aa9cfc, #fc9ce7)', 'disease': '#ffe4b5', 'gene': '#ffa07a'}
-        self.stop_words = set(stopwords.words('english'))
-        logging.info('Finished setting up constructor in %s seconds' % (time.time() - t_start))
+        if self.model is not None:
+            return
+        t = time.time()
+        logging.info('Loading BioSentVec Model...')
+        model_path = '%s/BioSentVec_PubMed_MIMICIII-bigram_d700.bin' % data_dir
+        self.model = sent2vec.Sent2vecModel()
+        try:
+            self.model.load_model(model_path)
+        except Exception as e:
+            print(e)
+        logging.info('Loading BioSentVec Model... done! %s seconds' % (time.time() - t))
+
+    def start_loading_live(self):
+        with self.live_lock:
+            if self.live_thread is None:
+                self.live_thread = threading.Thread(target=self._load_live_in_background, name='load_live')
+                self.live_thread.daemon = True
+                self.live_thread.start()
+
+    def _load_live_in_background(self):
+        t = time.time()
+        logging.info('Loading live search in the background...')
+        try:
+            self.live_loader()
+            logging.info('Loading live search in the background...Done! %s seconds' % (time.time() - t))
+        except Exception as e:
+            logging.exception('Loading live search failed')
+            self.live_error = e
+        finally:
+            self.live_ready.set()
+
+    def wait_until_live(self, timeout=None):
+        """Starts loading live search if needed and blocks until it is ready. Returns False on timeout."""
+        if self.live_loader is not None:
+            self.start_loading_live()
+        if not self.live_ready.wait(timeout):
+            return False
+        if self.live_error is not None:
+            raise RuntimeError('Live search failed to load: %s' % self.live_error)
+        return True
 
     def preprocess_sentence(self, text):
-        text = text.replace('/', ' / ')
-        text = text.replace('.-', ' .- ')
-        text = text.replace('.', ' . ')
-        text = text.replace('\'', ' \' ')
-        text = text.lower()
+        return self.preprocessor(text)
+
+    def sentence_mask(self, covid_only=False, start_date=None, end_date=None, num_queries=1):
+        """Mask of the sentences num_queries queries may return, counting what each filter excluded for each."""
+        if self.sentence_filters is None:
+            return None
+        mask, counts = self.sentence_filters.filter(covid_only, start_date, end_date)
+        for reason, count in counts.items():
+            self.metrics.counter(FILTERED_SENTENCES, FILTERED_HELP, reason=reason).inc(count * num_queries)
+        return mask
 
-        tokens = [token for token in word_tokenize(text) if token not in punctuation and token not in self.stop_words]
+    def stage(self, name):
+        return self.metrics.timer(STAGE_SECONDS, STAGE_HELP, stage=name)
 
-        return ' '.join(tokens)
+    def topk(self, query_vectors, base_vectors, K, exact=False, mask=None):
+        if isinstance(base_vectors, VectorShards):
+            with self.stage('topk'):
+                return to_numpy(base_vectors.topk(query_vectors, K, mask=mask))
+        if self.ann_index is not None and not exact:
+            with self.stage('topk'):
+                return self.ann_index.search(query_vectors.numpy(), base_vectors.numpy(), K, mask=mask)
+        if self.quantized_vecs is not None and not exact:
+            # Score the compressed matrix, then rescore the best candidates against the float32 vectors.
+            compressed, scales = self.quantized_vecs
+            with self.stage('topk'):
+                _, candidates = to_numpy(quantized_topk(query_vectors, compressed, scales,
+                                                        max(K, self.rerank_candidates), mask=mask))
+            with self.stage('rerank'):
+                return rerank(query_vectors, candidates, base_vectors.numpy(), K)
+        with self.stage('matmul'):
+            scores = mask_scores(torch.matmul(query_vectors, base_vectors.transpose(1, 0)), mask)
+        with self.stage('topk'):
+            return to_numpy(torch.topk(scores, k=min(K, scores.shape[1]), dim=1))
 
-    def knn(self, query_vectors, base_vectors, query_metadata, base_metadata, batch_size=1000, K=200):
+    def document_topk(self, query_vectors, base_vectors, Kdocs, mask=None):
+        """Top sentences of the Kdocs best documents, always scored exactly against the float32 vectors."""
+        if isinstance(base_vectors, VectorShards):
+            raise ValueError('Document retrieval needs all vectors in one matrix, not shards')
+        distances, indices = [], []
+        for i in range(0, query_vectors.shape[0], QUERY_BATCH_SIZE):
+            with self.stage('matmul'):
+                scores = mask_scores(torch.matmul(query_vectors[i:(i + QUERY_BATCH_SIZE)],
+                                                  base_vectors.transpose(1, 0)), mask)
+            with self.stage('topk'):
+                d, idx = self.document_segments.topk(scores, Kdocs, self.sentences_per_doc)
+            distances.append(d)
+            indices.append(idx)
+            del scores
+        return np.concatenate(distances), np.concatenate(indices)
+
+    def knn(self, query_vectors, base_vectors, query_metadata, base_metadata, batch_size=1000, K=200, exact=False,
+            mask=None):
         t = time.time()
         nn = dict()
         for i in range(0, query_vectors.shape[0], batch_size):
-            topk = torch.topk(torch.matmul(query_vectors[i:(i + batch_size)], base_vectors.transpose(1, 0)), k=K, dim=1)
-            distances, indices = topk[0].cpu().numpy(), topk[1].cpu().numpy()
+            if self.document_segments is not None:
+                search, args = self.document_topk, (base_vectors, K, mask)
+            else:
+                search, args = self.topk, (base_vectors, K, exact, mask)
+            if self.knn_batcher is not None:
+                distances, indices = self.knn_batcher.run(search, query_vectors[i:(i + batch_size)], *args)
+            else:
+                distances, indices = search(query_vectors[i:(i + batch_size)], *args)
             for j in range(distances.shape[0]):
-                qr_key = query_metadata[i][-1]
+                qr_key = query_metadata[i + j][-1]
+                # indices are -1 for masked out rows and when fewer than K candidates were scored.
+                hits = [(distances[j, idx], base_metadata[x]) for idx, x in enumerate(indices[j]) if x >= 0]
+                self.metrics.counter(HITS, 'nearest sentences found by knn').inc(len(hits))
                 if self.legacy_metadata:
-                    nn[qr_key] = [{'doc_id': base_metadata[x][0].replace('.json', ''), 'sent_text': base_metadata[x][1],
-                                   'sent_no': base_metadata[x][2],
-                                   'sec_id': base_metadata[x][3], 'sim': distances[j, idx]} for idx, x in
-                                  enumerate(indices[j])]
+                    nn[qr_key] = [{'doc_id': row[0].replace('.json', ''), 'sent_text': row[1], 'sent_no': row[2],
+                                   'sec_id': row[3], 'sim': sim} for sim, row in hits]
                 else:
-                    nn[qr_key] = [{'doc_id': base_metadata[x][0].replace('.json', ''), 'sent_text': base_metadata[x][3],
-                                   'sent_no': base_metadata[x][2],
-                                   'sec_id': base_metadata[x][1], 'sim': distances[j, idx]} for idx, x in
-                                  enumerate(indices[j])]
-            logging.info('Finished % out of %s in %s', i, query_vectors.shape[0], time.time() - t)
-            del topk
+                    nn[qr_key] = [{'doc_id': row[0].replace('.json', ''), 'sent_text': row[3], 'sent_no': row[2],
+                                   'sec_id': row[1], 'sim': sim} for sim, row in hits]
+            logging.info('Finished %s out of %s in %s', i, query_vectors.shape[0], time.time() - t)
             del distances
             del indices
         logging.info('Done! %s', time.time() - t)
         return nn
 
+    def check_recall(self, user_queries, K=100):
+        """recall@K of the approximate index against exact search for the given queries."""
+        query_vecs = self.embed_queries(user_queries)
+        _, exact_indices = self.topk(query_vecs, self.all_vecs, K, exact=True)
+        _, approx_indices = self.topk(query_vecs, self.all_vecs, K)
+        recall = recall_at_k(approx_indices, exact_indices)
+        logging.info('recall@%s of the approximate index over %s queries: %s', K, len(user_queries), recall)
+        return recall
+
     def get_entity_base(self, color, link):
-        return """
-                <mark class="entity" style="background: {bg}; padding: 0.15em 0.15em; margin: 0 0.25em; line-height: 1.5; border-radius: 0.15em">
-                    {text}
-                    <span style="font-size: 0.8em; font-weight: bold; line-height: 1.5; border-radius: 0.15em; text-transform: uppercase; vertical-align: middle; margin-right: 0.15rem"><a href="{link}" target="_blank" style="text-decoration: none;  color: black;">{label}</a></span>
-                </mark>
-                """.replace("{bg}", color).replace("{link}", link)
+        return ENTITY_TEMPLATE.replace("{bg}", color).replace("{link}", link)
 
     def get_entity_string(self, text, color, label, link):
-        return self.get_entity_base(color, link).replace("{text}", text).replace("{label}", label)
+        return entity_string(text, color, label, link)
 
     def get_highlight_base(self, color):
-        return """
-                <mark class="entity" style="background: {bg}; padding: 0.15em 0.15em; margin: 0 0.25em; line-height: 1.5; border-radius: 0.15em">
-                    {text}
-                    <span style="font-size: 0.8em; font-weight: bold; line-height: 1.5; border-radius: 0.15em; text-transform: uppercase; vertical-align: middle; margin-right: 0.15rem">{label}</span>
-                </mark>
-                """.replace("{bg}", color)
+        return HIGHLIGHT_TEMPLATE.replace("{bg}", color)
 
     def get_highlight_string(self, text, color, label):
-        return self.get_highlight_base(color).replace("{text}", text).replace("{label}", label)
-
-    def highlight_texts(self, larger_text, entities, highlights, colors):
-        # spans = [(start, end, link, type), ...]
-        entities = sorted(entities, key=lambda x: (x[0], x[1]))
-        highlights = sorted(highlights, key=lambda x: (x[0], x[1]))
-        while entities and highlights:
-            last_e = entities[-1]
-            last_h = highlights[-1]
-            # if e is candidate and is not overlapping
-            if last_e[0] > last_h[1]:
-                l = """<i class="fa">&#xf08e;</i>"""
-                s, e, t, link = last_e
-                color = colors[t]
-                rs = self.get_entity_string(larger_text[s:e], color, l, link)
-                larger_text = larger_text[:s] + rs + larger_text[e:]
-                entities.pop()
-            elif last_e[1] > last_h[0]:
-                l = """<i class="fa">&#xf08e;</i>"""
-                s, e, t, link = last_e
-                color = colors[t]
-                rs = self.get_entity_string(larger_text[s:e], color, l, link)
-                larger_text = larger_text[:s] + rs + larger_text[e:]
-                entities.pop()
-                last_h[1] += len(rs) - (e - s)
-            else:  # h goes
-                l = 'Highlight'
-                s, e, t, link = last_h
-                color = colors[t]
-                rs = self.get_highlight_string(larger_text[s:e], color, l)
-                larger_text = larger_text[:s] + rs + larger_text[e:]
-                highlights.pop()
-        while entities:
-            l = """<i class="fa">&#xf08e;</i>"""
-            s, e, t, link = entities.pop()
-            color = colors[t]
-            rs = self.get_entity_string(larger_text[s:e], color, l, link)
-            larger_text = larger_text[:s] + rs + larger_text[e:]
-        while highlights:
-            l = 'Highlight'
-            s, e, t, link = highlights.pop()
-            color = colors[t]
-            rs = self.get_highlight_string(larger_text[s:e], color, l)
-            larger_text = larger_text[:s] + rs + larger_text[e:]
-        return larger_text
+        return highlight_string(text, color, label)
+
+    def highlight_texts(self, larger_text, entities, highlights, colors, entities_sorted=False):
+        return highlight_texts(larger_text, entities, highlights, colors, entities_sorted)
 
     def h(self, larger_text, smaller_texts):
         ents = []
@@ -258,8 +366,17 @@ class SearchTool(object):
         res = displacy.render(ex, style="ent", manual=True, options={"colors": colors}, page=True, jupyter=False)
         return res
 
+    def sentence_offset(self, sha, sec_id, sec, sent):
+        """Offset of the hit sentence in its section text, -1 if it is not found."""
+        if self.span_index is not None:
+            start = self.span_index.sentence_start(sha, sec_id, sent['sent_no'])
+            if start is not None and sec.startswith(sent['sent_text'], start):
+                return start
+        return sec.find(sent['sent_text'])
+
     def format_html(self, sha, title, authors, year_of_publication, link, venue, sentences, sections, section_ids,
-                    user_sent):
+                    user_sent, stage_timer=None):
+        stage_timer = stage_timer if stage_timer is not None else StageTimer()
         try:
             alist = list(csv.reader([authors.strip().replace('[', '').replace(']', '')]))[0]
         except:
@@ -278,24 +395,31 @@ class SearchTool(object):
         for sent, sec, sec_id in zip(sentences, sections, section_ids):
             if sec not in sec2sent:
                 sec2sent[sec_id] = []
-            sec2sent[sec_id].append(sent['sent_text'])
+            sec2sent[sec_id].append(sent)
             secid2sec[sec_id] = sec
         for sec_id, sents in sec2sent.items():
             sec = secid2sec[sec_id]
             entity_spans = []
             highlight_spans = []
             for sent in sents:
-                start_offset = sec.find(sent)
+                start_offset = self.sentence_offset(sha, sec_id, sec, sent)
                 if start_offset >= 0:
-                    end_offset = start_offset + len(sent)
+                    end_offset = start_offset + len(sent['sent_text'])
                     highlight_spans.append([start_offset, end_offset, 'Highlight', None])
+            if self.span_index is not None and sha in self.span_index:
+                # Already sorted by (start, end).
+                with stage_timer.stage('entity_lookup'):
+                    entity_spans = self.span_index.entity_spans(sha, sec_id)
+                s += self.highlight_texts(sec, entity_spans, highlight_spans, self.colors, entities_sorted=True)
+                continue
             # {sha: {para_id: [ {start: int, end: int, url: string} ] } }
-            if sha in self.entity_links:
-                entities = self.entity_links[sha][sec_id]
-                for ent in entities:
-                    entity_spans.append([ent['start'], ent['end'], ent['type'], ent['url']])
-            else:
-                logging.warning('No links found for document %s', sha)
+            with stage_timer.stage('entity_lookup'):
+                if sha in self.entity_links:
+                    entities = self.entity_links[sha][sec_id]
+                    for ent in entities:
+                        entity_spans.append([ent['start'], ent['end'], ent['type'], ent['url']])
+                else:
+                    logging.warning('No links found for document %s', sha)
 
 
             s += self.highlight_texts(sec, entity_spans, highlight_spans, self.colors)
@@ -314,63 +438,209 @@ class SearchTool(object):
         s += "</div>"
         return s
 
-    def get_search_results(self, user_query, sort_by_date=False, covid_only=False, K=100, Kdocs=20):
+    def embed_queries(self, user_queries):
+        vecs = [None] * len(user_queries)
+        if self.query_cache is not None:
+            vecs = [self.query_cache.embeddings.get(normalize_query(q)) for q in user_queries]
+        missing = [idx for idx, v in enumerate(vecs) if v is None]
+        if missing:
+            with self.stage('preprocess'):
+                preprocessed = self.preprocessor.batch([user_queries[idx] for idx in missing])
+            with self.stage('embed'):
+                v = self.model.embed_sentences(preprocessed).astype(np.float32)
+            for row, idx in enumerate(missing):
+                vecs[idx] = v[row]
+                if self.query_cache is not None:
+                    self.query_cache.embeddings.put(normalize_query(user_queries[idx]), v[row])
+        return torch.from_numpy(np.stack(vecs))
+
+    def nearest_sentences(self, user_queries, query_vecs, K=100, covid_only=False, start_date=None, end_date=None):
+        """knn hits of each query under one set of filters, served from the knn cache where possible."""
+        nn = dict()
+        keys = [(normalize_query(q), K, covid_only, start_date, end_date) for q in user_queries]
+        if self.document_segments is not None:
+            keys = [key + ('document', self.sentences_per_doc) for key in keys]
+        if self.query_cache is not None:
+            for q, key in zip(user_queries, keys):
+                hits = self.query_cache.knn.get(key)
+                if hits is not None:
+                    nn[q] = hits
+        missing = [idx for idx, q in enumerate(user_queries) if q not in nn]
+        if missing:
+            rows = torch.tensor(missing, dtype=torch.long)
+            query_meta = [('query', idx, 0, user_queries[idx]) for idx in missing]
+            found = self.knn(query_vecs[rows], self.all_vecs, query_meta, self.all_meta, K=K,
+                             mask=self.sentence_mask(covid_only, start_date, end_date, len(missing)))
+            for idx in missing:
+                nn[user_queries[idx]] = found[user_queries[idx]]
+                if self.query_cache is not None:
+                    self.query_cache.knn.put(keys[idx], found[user_queries[idx]])
+        return nn
+
+    def refresh_corpus_version(self):
+        """Clears the query caches if the corpus files in data_dir changed since they were filled.
+
+        The caches keep checking data_dir on lookups afterwards, so a corpus rewritten under a running
+        SearchTool does not keep serving old entries. The search settings are part of the version, so a
+        cache_dir shared with other settings never serves their spilled results.
+        """
+        if self.query_cache is not None and self.data_dir is not None:
+            self.query_cache.watch(functools.partial(corpus_version, self.data_dir,
+                                                     extra_files=self.cache_settings['shard_files'],
+                                                     settings=sorted(self.cache_settings.items())))
+
+    def cache_stats(self):
+        return self.query_cache.stats() if self.query_cache is not None else {}
+
+    def get_search_results(self, user_query, sort_by_date=False, covid_only=False, K=100, Kdocs=20, start_date=None,
+                           end_date=None):
+        return self.get_search_results_batch([user_query], sort_by_date, covid_only, K, Kdocs, start_date, end_date)[0]
+
+    def get_search_results_batch(self, user_queries, sort_by_date=False, covid_only=False, K=100, Kdocs=20,
+                                 start_date=None, end_date=None):
+        """Search for many queries with a single embedding call and one batched knn per distinct filter.
+
+        sort_by_date, covid_only, Kdocs, start_date and end_date may either be single values applied to every
+        query or lists aligned with user_queries. Returns a list of html strings in the same order as
+        user_queries.
+        """
+        num_queries = len(user_queries)
+        sort_by_date = _per_query(sort_by_date, num_queries)
+        covid_only = _per_query(covid_only, num_queries)
+        Kdocs = _per_query(Kdocs, num_queries)
+        start_date = _per_query(start_date, num_queries)
+        end_date = _per_query(end_date, num_queries)
+        t = time.perf_counter()
+        results = self._get_results(user_queries, sort_by_date, covid_only, K, Kdocs, start_date, end_date)
+        self.metrics.histogram(SEARCH_SECONDS, 'seconds to answer a batch of queries').observe(time.perf_counter() - t)
+        self.metrics.counter(OUTPUT_BYTES, 'bytes of html returned').inc(sum(len(r.encode('utf-8')) for r in results))
+        return results
+
+    def _get_results(self, user_queries, sort_by_date, covid_only, K, Kdocs, start_date, end_date):
+        num_queries = len(user_queries)
+        if self.cached_results is not None and not self.fallback_to_live:
+            logging.info('getting cached search results for %s queries', num_queries)
+            return [self.cached_results[q] for q in user_queries]
+
         if self.cached_results is not None:
-            logging.info('getting search results for %s, K=%s, Kdocs=%s', user_query, K, Kdocs)
-            return self.cached_results[user_query]
-
-        logging.info('getting search results for %s, K=%s, Kdocs=%s', user_query, K, Kdocs)
-        v = self.model.embed_sentence(self.preprocess_sentence(user_query))
-        logging.info('starting embedding sentence %s, K=%s, Kdocs=%s', user_query, K, Kdocs)
-        query_vecs = torch.from_numpy(v.astype(np.float32))
-        logging.info('finished embedding sentence %s, K=%s, Kdocs=%s', user_query, K, Kdocs)
-        query_meta = [('query', 0, 0, user_query)]
-        logging.info('starting nearest neighbors for %s, K=%s, Kdocs=%s', user_query, K, Kdocs)
-        nn = self.knn(query_vecs, self.all_vecs, query_meta, self.all_meta, K=K)
-        logging.info('found nearest neighbors for %s, K=%s, Kdocs=%s', user_query, K, Kdocs)
+            # Serve precomputed results, everything else is answered live once live search is loaded.
+            results = [self.cached_results.get(q) for q in user_queries]
+            missing = [idx for idx in range(num_queries) if results[idx] is None]
+            if missing:
+                logging.info('%s of %s queries are not precomputed, answering them live', len(missing), num_queries)
+                self.wait_until_live()
+                live = self._get_live_results([user_queries[idx] for idx in missing],
+                                              [sort_by_date[idx] for idx in missing],
+                                              [covid_only[idx] for idx in missing], K,
+                                              [Kdocs[idx] for idx in missing],
+                                              [start_date[idx] for idx in missing],
+                                              [end_date[idx] for idx in missing])
+                for idx, res in zip(missing, live):
+                    results[idx] = res
+            return results
+        return self._get_live_results(user_queries, sort_by_date, covid_only, K, Kdocs, start_date, end_date)
+
+    def _get_live_results(self, user_queries, sort_by_date, covid_only, K, Kdocs, start_date, end_date):
+        num_queries = len(user_queries)
+        html_keys = [(normalize_query(q), s, c, K, kd, sd, ed)
+                     for q, s, c, kd, sd, ed in zip(user_queries, sort_by_date, covid_only, Kdocs, start_date, end_date)]
+        results = [None] * num_queries
+        if self.query_cache is not None:
+            results = [self.query_cache.html.get(key) for key in html_keys]
+        missing = [idx for idx in range(num_queries) if results[idx] is None]
+        if not missing:
+            logging.info('served %s queries from the html cache', num_queries)
+            return results
 
+        # knn results are keyed by query text, so duplicates only need to be searched once.
+        unique_queries = list(dict.fromkeys(user_queries[idx] for idx in missing))
+        logging.info('getting search results for %s queries (%s unique), K=%s', len(missing), len(unique_queries), K)
+        t = time.time()
+        query_vecs = self.embed_queries(unique_queries)
+        logging.info('finished embedding %s queries in %s seconds', len(unique_queries), time.time() - t)
+        query_rows = {q: idx for idx, q in enumerate(unique_queries)}
+
+        # Queries sharing the same filters share a mask and are searched together.
+        filters = [(c, s, e) for c, s, e in zip(covid_only, start_date, end_date)]
+        nn = dict()
+        for f in dict.fromkeys(filters[idx] for idx in missing):
+            group = list(dict.fromkeys(user_queries[idx] for idx in missing if filters[idx] == f))
+            rows = torch.tensor([query_rows[q] for q in group], dtype=torch.long)
+            if self.document_segments is not None:
+                # Fetch the documents for the largest Kdocs of the group, render_results cuts each query off.
+                nn[f] = self.nearest_sentences(group, query_vecs[rows],
+                                               max(Kdocs[idx] for idx in missing if filters[idx] == f), *f)
+            else:
+                nn[f] = self.nearest_sentences(group, query_vecs[rows], K, *f)
+        logging.info('found nearest neighbors for %s queries', len(unique_queries))
+        for idx in missing:
+            f = filters[idx]
+            results[idx] = self.render_results(user_queries[idx], nn[f][user_queries[idx]], sort_by_date[idx], f[0],
+                                               Kdocs[idx], f[1], f[2])
+            if self.query_cache is not None:
+                self.query_cache.html.put(html_keys[idx], results[idx])
+        return results
+
+    def render_results(self, user_query, nns, sort_by_date=False, covid_only=False, Kdocs=20, start_date=None,
+                       end_date=None):
         res = ""
-        for sent, nns in nn.items():
-            all_results = {}
+        all_results = {}
+        stage_timer = StageTimer()
+        filtered = {'short': 0, 'covid': 0, 'date': 0}
+        with stage_timer.stage('grouping'):
+            start_date = to_epoch(start_date) if start_date is not None else None
+            end_date = to_epoch(end_date) if end_date is not None else None
             for idx, nnv in enumerate(nns):
                 if len(nnv["sent_text"].split()) < 5:
+                    filtered['short'] += 1
                     continue
                 sha = nnv['doc_id']
                 sha = sha.split(".")[0]
                 if covid_only and not self.paper_index[sha]['covid']:
+                    filtered['covid'] += 1
+                    continue
+                if start_date is not None and to_epoch(self.paper_index[sha]['date']) < start_date:
+                    filtered['date'] += 1
+                    continue
+                if end_date is not None and to_epoch(self.paper_index[sha]['date']) > end_date:
+                    filtered['date'] += 1
                     continue
                 if sha not in all_results:
                     paper_metadata = self.paper_index[sha]
                     score = nnv['sim']
                     sentences = [nnv, ]
-                    sections = [self.doc2sec2text[nnv['doc_id']][nnv['sec_id']]]
-                    section_ids = [nnv['sec_id']]
-                    all_results[sha] = {'paper': paper_metadata, "score": score, "sentences": sentences,
-                                        "sections": sections, 'section_ids': section_ids}
+                    all_results[sha] = {'paper': paper_metadata, "score": score, "sentences": sentences}
                 else:
                     all_results[sha]["sentences"].append(nnv)
-                    all_results[sha]["sections"].append(self.doc2sec2text[nnv['doc_id']][nnv['sec_id']])
-                    all_results[sha]["section_ids"].append(nnv['sec_id'])
             if sort_by_date:
-              all_results_sorted = [(sha, all_results[sha]['paper']['date']) for sha in all_results]
+                all_results_sorted = [(sha, all_results[sha]['paper']['date']) for sha in all_results]
             else:
-              all_results_sorted = [(sha, all_results[sha]['score']) for sha in all_results]
+                all_results_sorted = [(sha, all_results[sha]['score']) for sha in all_results]
             all_results_sorted.sort(reverse=True, key=lambda x: x[1])
-            for sha, _ in all_results_sorted[0:Kdocs]:
-                paper_metadata = all_results[sha]['paper']
-                score = all_results[sha]['score']
-                sentences = all_results[sha]['sentences']
-                sections = all_results[sha]['sections']
-                section_ids = all_results[sha]['section_ids']
-                title = paper_metadata['title']
-                venue = paper_metadata['journal']
-                authors = paper_metadata['authors']
-                year_of_publication = paper_metadata['publish_time']
-                doi = paper_metadata['doi']
-                link = "https://doi.org/{}".format(doi)
-                if len(title.strip()) > 5:
-                    res += self.format_html(sha, title, authors, year_of_publication, link, venue, sentences, sections,
-                                            section_ids, user_query)
+        for sha, _ in all_results_sorted[0:Kdocs]:
+            paper_metadata = all_results[sha]['paper']
+            score = all_results[sha]['score']
+            sentences = all_results[sha]['sentences']
+            # Sections are only read for the papers that are shown.
+            with stage_timer.stage('section_lookup'):
+                sections = [self.doc2sec2text[nnv['doc_id']][nnv['sec_id']] for nnv in sentences]
+            section_ids = [nnv['sec_id'] for nnv in sentences]
+            title = paper_metadata['title']
+            venue = paper_metadata['journal']
+            authors = paper_metadata['authors']
+            year_of_publication = paper_metadata['publish_time']
+            doi = paper_metadata['doi']
+            link = "https://doi.org/{}".format(doi)
+            if len(title.strip()) > 5:
+                with stage_timer.stage('render'):
+                    res += self.format_html(sha, title, authors, year_of_publication, link, venue, sentences,
+                                            sections, section_ids, user_query, stage_timer)
+        self.metrics.observe_stages(STAGE_SECONDS, stage_timer, STAGE_HELP)
+        if self.sentence_filters is None:
+            # Without prefilter the filters are only applied here, to the knn hits. Otherwise sentence_mask
+            # counted them and none of these hits were filtered.
+            for reason, count in filtered.items():
+                self.metrics.counter(FILTERED_SENTENCES, FILTERED_HELP, reason=reason).inc(count)
         return res
 
 
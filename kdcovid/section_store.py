@@ -0,0 +1,100 @@
+import functools
+import json
+import os
+import pickle
+import zlib
+from array import array
+from collections.abc import Mapping
+
+import numpy as np
+
+# Random access replacement for all_sections.pkl ({cord_uid: {sec_id: text}}). Every document is stored as
+# one segment holding the json list of its [sec_id, text] pairs, zlib compressed unless compress is False.
+#   all_sections.offsets.npy  int64 byte offsets (num documents + 1) of the segments in
+#   all_sections.bin          the segments back to back, in the order the documents were written
+#   all_sections.index.json   {"compressed": bool, "keys": [cord_uid, ...]}
+# The offsets and segments are memory mapped, so only the documents that are read get decoded.
+
+
+def section_file(data_dir, name):
+    return '%s/all_sections.%s' % (data_dir, name)
+
+
+def section_store_exists(data_dir):
+    return os.path.exists(section_file(data_dir, 'index.json'))
+
+
+class SectionStore(Mapping):
+    """Read only mapping of cord_uid to {sec_id: text}, decoded per document on access.
+
+    The cache_size most recently read documents are kept decoded, callers should not modify them.
+    """
+
+    def __init__(self, data_dir, cache_size=1024):
+        with open(section_file(data_dir, 'index.json')) as fin:
+            index = json.load(fin)
+        self.compressed = index['compressed']
+        self.doc_names = index['keys']
+        self.key2row = {k: row for row, k in enumerate(self.doc_names)}
+        self.offsets = np.load(section_file(data_dir, 'offsets.npy'), mmap_mode='r')
+        if os.path.getsize(section_file(data_dir, 'bin')) > 0:
+            self.segments = np.memmap(section_file(data_dir, 'bin'), dtype=np.uint8, mode='r')
+        else:
+            self.segments = np.zeros(0, dtype=np.uint8)
+        self.document = functools.lru_cache(maxsize=cache_size)(self._read_document)
+
+    def _read_document(self, key):
+        row = self.key2row[key]
+        segment = self.segments[self.offsets[row]:self.offsets[row + 1]].tobytes()
+        if self.compressed:
+            segment = zlib.decompress(segment)
+        return {sec_id: text for sec_id, text in json.loads(segment.decode('utf-8'))}
+
+    def __getitem__(self, key):
+        return self.document(key)
+
+    def __contains__(self, key):
+        return key in self.key2row
+
+    def __iter__(self):
+        return iter(self.doc_names)
+
+    def __len__(self):
+        return len(self.doc_names)
+
+
+class SectionStoreWriter(object):
+    """Streams (cord_uid, {sec_id: text}) documents into the format read by SectionStore."""
+
+    def __init__(self, data_dir, compress=True):
+        self.data_dir = data_dir
+        self.compress = compress
+        self.doc_names = []
+        self.offsets = array('q', [0])
+        self.out = open(section_file(data_dir, 'bin'), 'wb')
+
+    def __len__(self):
+        return len(self.doc_names)
+
+    def add(self, key, sections):
+        segment = json.dumps([[sec_id, text] for sec_id, text in sections.items()]).encode('utf-8')
+        if self.compress:
+            segment = zlib.compress(segment)
+        self.out.write(segment)
+        self.doc_names.append(key)
+        self.offsets.append(self.offsets[-1] + len(segment))
+
+    def close(self):
+        self.out.close()
+        np.save(section_file(self.data_dir, 'offsets.npy'), np.frombuffer(self.offsets, dtype=np.int64))
+        # Written last, section_store_exists keys off of it.
+        with open(section_file(self.data_dir, 'index.json'), 'w') as fout:
+            json.dump({'compressed': self.compress, 'keys': self.doc_names}, fout)
+
+
+def load_sections(data_dir, pickle_file=None):
+    """The SectionStore in data_dir if there is one, otherwise the all_sections.pkl dict."""
+    if section_store_exists(data_dir):
+        return SectionStore(data_dir)
+    with open(pickle_file or '%s/all_sections.pkl' % data_dir, 'rb') as fin:
+        return pickle.load(fin)
@@ -0,0 +1,71 @@
+import time
+
+import numpy as np
+from absl import logging
+
+from kdcovid.meta_store import SentenceMetadata
+from kdcovid.paper_index import to_epoch
+
+
+def _sentence_columns(all_meta, legacy_metadata=False):
+    # (doc code per sentence, doc ids, words per sentence) for either metadata format.
+    if isinstance(all_meta, SentenceMetadata):
+        num_words = all_meta.num_words
+        if num_words is None:
+            num_words = np.array([len(all_meta.sentence(i).split()) for i in range(len(all_meta))], dtype=np.int32)
+        return np.asarray(all_meta.doc_codes), all_meta.doc_names, np.asarray(num_words)
+    text_field = 1 if legacy_metadata else 3
+    doc2code = dict()
+    doc_codes = np.zeros(len(all_meta), dtype=np.int32)
+    num_words = np.zeros(len(all_meta), dtype=np.int32)
+    for idx, row in enumerate(all_meta):
+        doc_codes[idx] = doc2code.setdefault(row[0], len(doc2code))
+        num_words[idx] = len(row[text_field].split())
+    return doc_codes, list(doc2code.keys()), num_words
+
+
+class SentenceFilters(object):
+    """Per sentence covid flags, publish dates and validity aligned with the rows of all_vecs.
+
+    mask() combines them into a boolean array that knn applies before taking the top K, so filtered
+    sentences never use up slots of the K nearest neighbors. filter() also returns how many sentences each
+    filter removed: short, unknown (paper missing from metadata.csv), covid and date, in that order.
+    """
+
+    def __init__(self, all_meta, paper_index, legacy_metadata=False, min_words=5):
+        t = time.time()
+        doc_codes, doc_names, num_words = _sentence_columns(all_meta, legacy_metadata)
+        rows = paper_index.rows([d.replace('.json', '').split('.')[0] for d in doc_names])
+        known = rows >= 0
+        doc_covid = np.zeros(len(doc_names), dtype=np.bool_)
+        doc_covid[known] = paper_index.covid[rows[known]]
+        doc_dates = np.zeros(len(doc_names), dtype=np.int64)
+        doc_dates[known] = paper_index.dates[rows[known]]
+        self.covid = doc_covid[doc_codes]
+        self.dates = doc_dates[doc_codes]
+        # Short sentences and sentences of papers missing from metadata.csv are never displayed.
+        long_enough = num_words >= min_words
+        self.valid = long_enough & known[doc_codes]
+        self.covid_valid = self.valid & self.covid
+        self.num_short = int(len(long_enough) - long_enough.sum())
+        self.num_unknown = int(long_enough.sum() - self.valid.sum())
+        logging.info('Built sentence filters for %s sentences (%s valid, %s covid) in %s seconds', len(doc_codes),
+                     int(self.valid.sum()), int(self.covid_valid.sum()), time.time() - t)
+
+    def mask(self, covid_only=False, start_date=None, end_date=None):
+        return self.filter(covid_only, start_date, end_date)[0]
+
+    def filter(self, covid_only=False, start_date=None, end_date=None):
+        """(mask, {reason: number of sentences removed})."""
+        mask = self.covid_valid if covid_only else self.valid
+        counts = {'short': self.num_short, 'unknown': self.num_unknown, 'covid': 0, 'date': 0}
+        if covid_only:
+            counts['covid'] = int(self.valid.sum() - self.covid_valid.sum())
+        if start_date is not None or end_date is not None:
+            undated = int(mask.sum())
+            if start_date is not None:
+                mask = mask & (self.dates >= to_epoch(start_date))
+            if end_date is not None:
+                mask = mask & (self.dates <= to_epoch(end_date))
+            counts['date'] = undated - int(mask.sum())
+        return mask, counts
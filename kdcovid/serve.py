@@ -0,0 +1,338 @@
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+
+from absl import app
+from absl import flags
+from absl import logging
+
+from kdcovid.metrics import MetricsRegistry
+from kdcovid.paper_index import to_epoch
+from kdcovid.search_tool import SearchTool
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string('data_dir', '2020-04-10', 'data path')
+flags.DEFINE_string('host', '127.0.0.1', 'address to listen on')
+flags.DEFINE_integer('port', 8080, 'port to listen on')
+flags.DEFINE_string('paper_id', 'cord_uid', 'cord_uid or sha')
+flags.DEFINE_bool('use_cached', False, 'serve cached_results.pkl')
+flags.DEFINE_bool('fallback_to_live', False, 'with use_cached, answer other queries live')
+flags.DEFINE_string('retrieval_mode', 'sentence', 'sentence or document, see SearchTool')
+flags.DEFINE_integer('executor_threads', 4, 'threads running embedding, knn and rendering')
+flags.DEFINE_integer('max_concurrency', 8, 'searches running or queued on the executor at once, others wait')
+flags.DEFINE_float('batch_window', 0.003, 'seconds concurrent knn searches wait to be batched, negative to disable')
+flags.DEFINE_integer('max_batch_size', 64, 'most queries scored in one knn batch')
+flags.DEFINE_float('keep_alive_timeout', 5.0, 'seconds an idle connection is kept open')
+flags.DEFINE_integer('max_body_bytes', 1 << 20, 'largest accepted request body')
+flags.DEFINE_integer('max_queries', 64, 'largest number of queries in one POST /search')
+
+logging.set_verbosity(logging.INFO)
+
+# GET /health  200 while the process is up.
+# GET /ready   200 once the SearchTool is loaded (and live search if it falls back to it), 503 before.
+# GET /metrics request and search stage latencies and counters in the prometheus text format.
+# GET /search?q=...[&sort_by_date=1&covid_only=1&kdocs=20&start_date=...&end_date=...]  the html of one query.
+# POST /search {"queries": [...], "sort_by_date": ..., ...}  {"results": [html, ...]}, options as in
+#     SearchTool.get_search_results_batch, either one value or one per query.
+# With --use_cached, /search answers precomputed queries as soon as they are loaded. Other queries get 404,
+# or with --fallback_to_live 503 until live search is loaded.
+
+SEARCH_OPTIONS = ['sort_by_date', 'covid_only', 'kdocs', 'start_date', 'end_date']
+PATHS = ['/health', '/ready', '/metrics', '/search']
+
+
+class HttpError(Exception):
+
+    def __init__(self, status, message=None):
+        super(HttpError, self).__init__(message or status.phrase)
+        self.status = status
+
+
+def _flag(value):
+    return value.lower() in ('1', 'true', 'yes')
+
+
+def _query_options(params):
+    # Options of GET /search from the query string.
+    options = dict()
+    for name in ['sort_by_date', 'covid_only']:
+        if name in params:
+            options[name] = _flag(params[name][-1])
+    for name in ['start_date', 'end_date']:
+        if name in params:
+            options[name] = params[name][-1]
+    if 'kdocs' in params:
+        try:
+            options['kdocs'] = int(params['kdocs'][-1])
+        except ValueError:
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'kdocs must be an integer')
+    return options
+
+
+def _check_options(options, num_queries):
+    """Raises a 400 HttpError unless the options are valid for get_search_results_batch."""
+    for name, value in options.items():
+        values = value if isinstance(value, list) else [value]
+        if isinstance(value, list) and len(value) != num_queries:
+            raise HttpError(HTTPStatus.BAD_REQUEST, '%s needs one value per query' % name)
+        for v in values:
+            if name in ('sort_by_date', 'covid_only') and not isinstance(v, bool):
+                raise HttpError(HTTPStatus.BAD_REQUEST, '%s must be a boolean' % name)
+            if name == 'kdocs' and (not isinstance(v, int) or isinstance(v, bool) or v < 0):
+                raise HttpError(HTTPStatus.BAD_REQUEST, 'kdocs must be a non negative integer')
+            if name in ('start_date', 'end_date') and v is not None:
+                try:
+                    if not isinstance(v, str):
+                        raise TypeError(v)
+                    to_epoch(v)
+                except (ValueError, OverflowError, TypeError):
+                    raise HttpError(HTTPStatus.BAD_REQUEST, '%s is not a date: %s' % (name, v))
+
+
+class SearchServer(object):
+    """Serves a SearchTool over HTTP/1.1 with asyncio.
+
+    Searches run on a thread pool so the event loop keeps answering health checks and reading requests.
+    At most max_concurrency searches are handed to the pool at once, the others wait for a slot.
+    """
+
+    def __init__(self, load_search_tool, executor_threads=4, max_concurrency=8, keep_alive_timeout=5.0,
+                 max_body_bytes=1 << 20, max_queries=64, metrics=None):
+        self.load_search_tool = load_search_tool
+        # Shared with the SearchTool so /metrics has the search stages too.
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.search_tool = None
+        self.load_error = None
+        self.load_task = None
+        self.executor = ThreadPoolExecutor(max_workers=executor_threads)
+        self.max_concurrency = max_concurrency
+        self.semaphore = None
+        self.keep_alive_timeout = keep_alive_timeout
+        self.max_body_bytes = max_body_bytes
+        self.max_queries = max_queries
+
+    async def load(self):
+        loop = asyncio.get_running_loop()
+        t = time.time()
+        try:
+            self.search_tool = await loop.run_in_executor(self.executor, self.load_search_tool)
+            logging.info('Loaded search tool in %s seconds', time.time() - t)
+        except Exception as e:
+            logging.exception('Loading the search tool failed')
+            self.load_error = e
+
+    def ready(self):
+        if self.search_tool is None:
+            return False
+        if self.search_tool.fallback_to_live:
+            return self.search_tool.live_ready.is_set() and self.search_tool.live_error is None
+        return True
+
+    async def start(self, host, port):
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        server = await asyncio.start_server(self.handle_connection, host, port, limit=64 * 1024)
+        self.load_task = asyncio.ensure_future(self.load())
+        logging.info('Listening on %s', ', '.join(str(s.getsockname()) for s in server.sockets))
+        return server
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.keep_alive_timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self.respond(writer, HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, close=True)
+                    break
+                keep_alive = await self.handle_request(head, reader, writer)
+                if not keep_alive:
+                    break
+        except Exception:
+            logging.exception('Error on connection')
+        finally:
+            writer.close()
+
+    async def handle_request(self, head, reader, writer):
+        """Answers one request, returns whether the connection stays open."""
+        t = time.perf_counter()
+        try:
+            request_line, headers = self.parse_head(head)
+            method, target, version = request_line
+        except HttpError as e:
+            await self.respond(writer, e.status, {'error': str(e)}, close=True)
+            self.observe_request('other', e.status, t)
+            return False
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+        try:
+            body = await self.read_body(headers, reader)
+            status, payload, content_type = await self.route(method, target, body)
+        except HttpError as e:
+            status, payload, content_type = e.status, {'error': str(e)}, None
+            # The body may not have been read, the rest of the stream cannot be trusted.
+            keep_alive = keep_alive and status not in (HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                                                       HTTPStatus.LENGTH_REQUIRED, HTTPStatus.REQUEST_TIMEOUT)
+        except Exception:
+            logging.exception('Error answering %s %s', method, target)
+            status, payload, content_type = HTTPStatus.INTERNAL_SERVER_ERROR, {'error': 'internal error'}, None
+        await self.respond(writer, status, payload, content_type, close=not keep_alive)
+        path = urlsplit(target).path
+        self.observe_request(path if path in PATHS else 'other', status, t)
+        return keep_alive
+
+    def observe_request(self, path, status, start):
+        self.metrics.histogram('kdcovid_http_request_seconds', 'seconds to answer a request',
+                               path=path).observe(time.perf_counter() - start)
+        self.metrics.counter('kdcovid_http_requests_total', 'requests answered', path=path,
+                             status=status.value).inc()
+
+    def parse_head(self, head):
+        lines = head.decode('latin-1').split('\r\n')
+        request_line = lines[0].split()
+        if len(request_line) != 3 or not request_line[2].startswith('HTTP/'):
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'malformed request line')
+        headers = dict()
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise HttpError(HTTPStatus.BAD_REQUEST, 'malformed header')
+            headers[name.strip().lower()] = value.strip()
+        return request_line, headers
+
+    async def read_body(self, headers, reader):
+        if 'transfer-encoding' in headers:
+            raise HttpError(HTTPStatus.LENGTH_REQUIRED, 'chunked bodies are not supported')
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise HttpError(HTTPStatus.LENGTH_REQUIRED, 'bad content-length')
+        if length > self.max_body_bytes:
+            raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        if length <= 0:
+            return b''
+        try:
+            return await asyncio.wait_for(reader.readexactly(length), self.keep_alive_timeout)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            raise HttpError(HTTPStatus.REQUEST_TIMEOUT, 'incomplete body')
+
+    async def route(self, method, target, body):
+        """(status, payload, content type) of a request, payload is json encoded when content type is None."""
+        url = urlsplit(target)
+        if url.path == '/health':
+            return HTTPStatus.OK, {'status': 'ok'}, None
+        if url.path == '/ready':
+            if self.load_error is not None:
+                return HTTPStatus.SERVICE_UNAVAILABLE, {'status': 'failed', 'error': str(self.load_error)}, None
+            if not self.ready():
+                return HTTPStatus.SERVICE_UNAVAILABLE, {'status': 'loading'}, None
+            return HTTPStatus.OK, {'status': 'ready'}, None
+        if url.path == '/metrics':
+            return HTTPStatus.OK, self.metrics.export_text(), 'text/plain; version=0.0.4; charset=utf-8'
+        if url.path != '/search':
+            raise HttpError(HTTPStatus.NOT_FOUND)
+        if method == 'GET':
+            params = parse_qs(url.query)
+            if not params.get('q'):
+                raise HttpError(HTTPStatus.BAD_REQUEST, 'missing q')
+            options = _query_options(params)
+            _check_options(options, 1)
+            results = await self.search([params['q'][-1]], options)
+            return HTTPStatus.OK, results[0], 'text/html; charset=utf-8'
+        if method == 'POST':
+            try:
+                request = json.loads(body.decode('utf-8'))
+            except ValueError:
+                raise HttpError(HTTPStatus.BAD_REQUEST, 'body is not json')
+            queries = request.get('queries') if isinstance(request, dict) else None
+            if not isinstance(queries, list) or not queries or not all(isinstance(q, str) for q in queries):
+                raise HttpError(HTTPStatus.BAD_REQUEST, 'queries must be a nonempty list of strings')
+            if len(queries) > self.max_queries:
+                raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, 'at most %s queries' % self.max_queries)
+            options = {name: request[name] for name in SEARCH_OPTIONS if name in request}
+            _check_options(options, len(queries))
+            return HTTPStatus.OK, {'results': await self.search(queries, options)}, None
+        raise HttpError(HTTPStatus.METHOD_NOT_ALLOWED)
+
+    async def search(self, queries, options):
+        if self.search_tool is None:
+            raise HttpError(HTTPStatus.SERVICE_UNAVAILABLE, 'still loading')
+        self.check_cached(queries)
+        loop = asyncio.get_running_loop()
+        async with self.semaphore:
+            return await loop.run_in_executor(self.executor, self._search, queries, options)
+
+    def check_cached(self, queries):
+        """Raises an HttpError if some queries are not precomputed and cannot be answered live right now."""
+        tool = self.search_tool
+        if tool.cached_results is None or all(q in tool.cached_results for q in queries):
+            return
+        if not tool.fallback_to_live:
+            raise HttpError(HTTPStatus.NOT_FOUND, 'query is not in the cached results')
+        if tool.live_error is not None:
+            raise HttpError(HTTPStatus.SERVICE_UNAVAILABLE, 'live search failed to load')
+        if not tool.live_ready.is_set():
+            raise HttpError(HTTPStatus.SERVICE_UNAVAILABLE, 'query is not in the cached results, live search is '
+                                                            'still loading')
+
+    def _search(self, queries, options):
+        t = time.time()
+        results = self.search_tool.get_search_results_batch(
+            queries, options.get('sort_by_date', False), options.get('covid_only', False),
+            Kdocs=options.get('kdocs', 20), start_date=options.get('start_date'), end_date=options.get('end_date'))
+        logging.info('Answered %s queries in %s seconds', len(queries), time.time() - t)
+        return results
+
+    async def respond(self, writer, status, payload=None, content_type=None, close=False):
+        if content_type is None:
+            body = json.dumps(payload if payload is not None else {'error': status.phrase}).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            body = payload.encode('utf-8')
+        head = ['HTTP/1.1 %d %s' % (status.value, status.phrase), 'Content-Type: %s' % content_type,
+                'Content-Length: %d' % len(body), 'Connection: %s' % ('close' if close else 'keep-alive')]
+        if not close:
+            head.append('Keep-Alive: timeout=%d' % int(self.keep_alive_timeout))
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+
+def main(argv):
+    logging.info('Running serve with arguments: %s', str(argv))
+
+    metrics = MetricsRegistry()
+
+    def load_search_tool():
+        return SearchTool(data_dir=FLAGS.data_dir, use_cached=FLAGS.use_cached, paper_id_field=FLAGS.paper_id,
+                          fallback_to_live=FLAGS.fallback_to_live, preload_live=FLAGS.fallback_to_live,
+                          retrieval_mode=FLAGS.retrieval_mode,
+                          batch_window=FLAGS.batch_window if FLAGS.batch_window >= 0 else None,
+                          max_batch_size=FLAGS.max_batch_size, metrics=metrics)
+
+    server = SearchServer(load_search_tool, FLAGS.executor_threads, FLAGS.max_concurrency, FLAGS.keep_alive_timeout,
+                          FLAGS.max_body_bytes, FLAGS.max_queries, metrics)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    http_server = loop.run_until_complete(server.start(FLAGS.host, FLAGS.port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        http_server.close()
+        loop.run_until_complete(http_server.wait_closed())
+        server.executor.shutdown(wait=False)
+        loop.close()
+
+
+if __name__ == '__main__':
+    app.run(main)
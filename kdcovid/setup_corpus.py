@@ -1,5 +1,7 @@
 import csv
 import json
+import multiprocessing
+import os
 import pickle
 import time
 
@@ -8,17 +10,36 @@ from absl import flags
 from absl import logging
 from nltk import sent_tokenize
 
+from kdcovid.section_store import SectionStoreWriter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 FLAGS = flags.FLAGS
 flags.DEFINE_string('input_file_list', '2020-04-10/file-list', 'data path')
 flags.DEFINE_string('outfile', '2020-04-10/all_sections.pkl', 'out path')
 flags.DEFINE_string('metadata_file', '2020-04-10/metadata.csv', 'list of inputs')
+flags.DEFINE_integer('workers', 1, 'number of processes reading the input files')
+flags.DEFINE_boolean('tokenize', False, 'also sentence tokenize the documents while loading them')
+flags.DEFINE_boolean('pickle_sections', False, 'also write the sections as the legacy all_sections.pkl dict')
+flags.DEFINE_boolean('compress_sections', True, 'zlib compress the documents in the section store')
 
 logging.set_verbosity(logging.INFO)
 
 
 class DocumentLoader(object):
-    def __init__(self, input_file_list, metadata, max_files_processed=None):
+    """Maps the PMC and PDF json files of the CORD-19 release onto cord_uids.
+
+    iter_documents streams (cord_uid, {sec_id: text}) pairs, reading the files of each document in a pool
+    of workers processes. Unless load is False, they are also collected into all_sections on construction.
+    """
+
+    def __init__(self, input_file_list, metadata, max_files_processed=None, workers=1, tokenize=False, load=True):
         self.max_files_processed = max_files_processed
+        self.workers = workers
+        self.tokenize = tokenize
         input_files = []
         self.metadata_file = metadata
         with open(input_file_list) as fin:
@@ -34,7 +55,8 @@ class DocumentLoader(object):
         self.cord_sha_ordering = dict()
         self.all_sections = dict()
         self.load_meta_data()
-        self.load_docs()
+        if load:
+            self.load_docs()
 
     def load_meta_data(self):
         with open(self.metadata_file) as fin:
@@ -72,79 +94,100 @@ class DocumentLoader(object):
 
                     self.cord_sha_ordering[cord_uid] = [s.strip() for s in shas_split]
 
-    def load_docs(self):
-        # Load PMC files.
-        for pmc_file in self.pmc_files:
-            sents, section2text, paper_id = load_sents(pmc_file)
-            # try to get coord id
-            paper_id_no_pmc = paper_id
-            if paper_id_no_pmc in self.pmc2cordid:
-                logging.log_first_n(logging.INFO, 'Found PMC id %s', 10, paper_id_no_pmc)
-                cord_id = self.pmc2cordid[paper_id_no_pmc]
-            else:
-                logging.info('No cord id for PMC id %s', paper_id_no_pmc)
-                continue
+    def document_files(self):
+        """Returns (cord_id, [json files]) in the order the documents used to be added to all_sections.
 
-            if cord_id not in self.cord2docs:
-                self.cord2docs[cord_id] = dict()
+        A document is made of its PMC files if it has any, otherwise of its PDF files in the order of the shas
+        in metadata.csv. Paper ids are taken from the file names, PMC1234.xml.json or <sha>.json.
+        """
+        cord2pmc = dict()
+        for pmc_file in self.pmc_files:
+            paper_id = os.path.basename(pmc_file).split('.')[0]
+            if paper_id in self.pmc2cordid:
+                logging.log_first_n(logging.INFO, 'Found PMC id %s', 10, paper_id)
+                cord_id = self.pmc2cordid[paper_id]
+                if cord_id in cord2pmc:
+                    logging.warning('Two PMIDs for the same cord %s', cord_id)
+                cord2pmc.setdefault(cord_id, []).append(pmc_file)
             else:
-                logging.warning('Two PMIDs for the same cord %s', cord_id)
-
-            self.cord2docs[cord_id][paper_id] = section2text
+                logging.info('No cord id for PMC id %s', paper_id)
 
-            if self.max_files_processed is not None and len(self.cord2docs) > self.max_files_processed:
-                break
-
-        # Load non pmc files.
+        cord2shas = dict()
         for non_pmc_file in self.non_pmc_files:
-            sents, section2text, paper_id = load_sents(non_pmc_file)
-            # try to get coord id
+            paper_id = os.path.basename(non_pmc_file).split('.')[0]
             if paper_id in self.sha2cordid:
                 logging.log_first_n(logging.INFO, 'Found sha id %s', 10, paper_id)
-                cord_id = self.sha2cordid[paper_id]
+                cord2shas.setdefault(self.sha2cordid[paper_id], dict())[paper_id] = non_pmc_file
             else:
                 logging.info('No cord id for sha id %s', paper_id)
+
+        documents = []
+        for cord_id, pmc_files in cord2pmc.items():
+            documents.append((cord_id, pmc_files))
+        for cord_id, sha2file in cord2shas.items():
+            if cord_id in cord2pmc:
                 continue
+            files = []
+            for sha in self.cord_sha_ordering[cord_id]:
+                if sha in sha2file:
+                    files.append(sha2file[sha])
+                else:
+                    logging.warning("Missing sha %s for cord %s", sha, cord_id)
+            documents.append((cord_id, files))
+        if self.max_files_processed is not None:
+            documents = documents[:self.max_files_processed + 1]
+        return documents
 
-            if cord_id not in self.cord2docs:
-                self.cord2docs[cord_id] = dict()
-            self.cord2docs[cord_id][paper_id] = section2text
-
-            if self.max_files_processed is not None and len(self.cord2docs) > self.max_files_processed:
-                break
-
-        # Reduce into a single pickle
-        counter = 0
-        for cord_id, doc2sections in self.cord2docs.items():
-            logging.info('Processing cord_id %s with %s sections (%s of %s)', cord_id, len(doc2sections), counter, len(self.cord2docs))
-            counter += 1
-            last_section_offset = 0
-            for doc_id, doc_sections in doc2sections.items():
-                if 'PMC' in doc_id:
-                    if cord_id not in self.all_sections:
-                        self.all_sections[cord_id] = dict()
-                    for sec_id, sec in doc_sections.items():
-                        self.all_sections[cord_id][sec_id + last_section_offset] = sec
-                    last_section_offset += len(doc_sections)
-            # if we haven't added any PMC files:
-            if cord_id not in self.all_sections:
-                ordered_shas = self.cord_sha_ordering[cord_id]
-                for sha in ordered_shas:
-                    if sha in doc2sections:
-                        doc_sections = doc2sections[sha]
-                        if cord_id not in self.all_sections:
-                            self.all_sections[cord_id] = dict()
-                        for sec_id, sec in doc_sections.items():
-                            self.all_sections[cord_id][sec_id + last_section_offset] = sec
-                        last_section_offset += len(doc_sections)
-                    else:
-                        logging.warning("Missing sha %s for cord %s", sha, cord_id)
+    def iter_documents(self):
+        documents = self.document_files()
+        tasks = [(cord_id, files, self.tokenize) for cord_id, files in documents]
+        if self.workers > 1:
+            pool = multiprocessing.Pool(self.workers)
+            results = pool.imap(load_document, tasks, chunksize=16)
+        else:
+            pool = None
+            results = map(load_document, tasks)
+        for counter, (cord_id, sections) in enumerate(results):
+            logging.info('Processed cord_id %s with %s sections (%s of %s)', cord_id, len(sections), counter,
+                         len(tasks))
+            yield cord_id, sections
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def load_docs(self):
+        for cord_id, sections in self.iter_documents():
+            self.all_sections[cord_id] = sections
+
+
+def load_document(task):
+    """Reads the json files of one document and numbers their sections consecutively."""
+    cord_id, files, tokenize = task
+    sections = dict()
+    last_section_offset = 0
+    for filename in files:
+        _, section2text, _ = load_sents(filename, tokenize=tokenize)
+        for sec_id, sec in section2text.items():
+            sections[sec_id + last_section_offset] = sec
+        last_section_offset += len(section2text)
+    return cord_id, sections
+
+
+def read_json(filename):
+    with open(filename, 'rb') as fin:
+        if orjson is not None:
+            return orjson.loads(fin.read())
+        return json.load(fin)
 
 
-def load_sents(filename):
+def load_sents(filename, tokenize=True):
+    """Returns the sentences, {section id: text} and paper id of a json file.
+
+    Without tokenize the sentences are not split and the returned list is empty.
+    """
     gt = time.time
     logging.info('Loading from filename %s', filename)
-    jobj = json.load(open(filename))
+    jobj = read_json(filename)
 
     paper_id = jobj['paper_id']
     logging.info('paper_id %s', jobj['paper_id'])
@@ -169,12 +212,18 @@ def load_sents(filename):
         abstract = [(x['text'], sect_id + idx) for idx, x in enumerate(jobj['abstract'])]
         for text, sect in abstract:
             section2text[sect] = text
-        abstract_sentences = [(s, section_id) for x, section_id in abstract for sent_idx, s in
-                              enumerate(sent_tokenize(x))]
-        logging.info('Last Section Id in Abstract %s', abstract_sentences[-1][1])
-        sents.extend(abstract_sentences)
-        sect_id = abstract_sentences[-1][1] + 1
-        logging.info('Number of sentences so far %s', len(sents))
+        if tokenize:
+            abstract_sentences = [(s, section_id) for x, section_id in abstract for sent_idx, s in
+                                  enumerate(sent_tokenize(x))]
+            logging.info('Last Section Id in Abstract %s', abstract_sentences[-1][1])
+            sents.extend(abstract_sentences)
+            sect_id = abstract_sentences[-1][1] + 1
+            logging.info('Number of sentences so far %s', len(sents))
+        else:
+            # The body starts after the last abstract paragraph that has a sentence, as it does when tokenizing.
+            nonempty = [section_id for x, section_id in abstract if x.strip()]
+            if nonempty:
+                sect_id = nonempty[-1] + 1
     else:
         logging.info('Missing document abstract - %s', str(filename))
 
@@ -182,13 +231,15 @@ def load_sents(filename):
         texts = [(x['text'], idx + sect_id) for idx, x in enumerate(jobj['body_text'])]
         for text, sect in texts:
             section2text[sect] = text
-        texts_sentences = [(s, section_id) for x, section_id in texts for sent_idx, s in enumerate(sent_tokenize(x))]
-        if texts_sentences:
-            sents.extend(texts_sentences)
-            logging.info('Last Section Id in Body %s', texts_sentences[-1][1])
-            logging.info('Number of sentences so far %s', len(sents))
-        else:
-            logging.warning('No sentences available in body_text....')
+        if tokenize:
+            texts_sentences = [(s, section_id) for x, section_id in texts for sent_idx, s in
+                               enumerate(sent_tokenize(x))]
+            if texts_sentences:
+                sents.extend(texts_sentences)
+                logging.info('Last Section Id in Body %s', texts_sentences[-1][1])
+                logging.info('Number of sentences so far %s', len(sents))
+            else:
+                logging.warning('No sentences available in body_text....')
     e_t = gt()
     logging.info('Finished processing document in %s', e_t - t)
     return sents, section2text, paper_id
@@ -196,11 +247,21 @@ def load_sents(filename):
 
 def setup_corpus(argv):
     logging.info('Running with args %s', str(argv))
-    doc_loader = DocumentLoader(FLAGS.input_file_list, FLAGS.metadata_file)
-    all_section2text = doc_loader.all_sections
+    doc_loader = DocumentLoader(FLAGS.input_file_list, FLAGS.metadata_file, workers=FLAGS.workers,
+                                tokenize=FLAGS.tokenize, load=False)
+    # The section store is written next to outfile, documents are appended as they are loaded.
+    writer = SectionStoreWriter(os.path.dirname(FLAGS.outfile) or '.', compress=FLAGS.compress_sections)
+    all_section2text = dict()
+    for cord_id, sections in doc_loader.iter_documents():
+        writer.add(cord_id, sections)
+        if FLAGS.pickle_sections:
+            all_section2text[cord_id] = sections
+    writer.close()
+    logging.info('Wrote %s documents to the section store', len(writer))
 
-    with open(FLAGS.outfile, 'wb') as fout:
-        pickle.dump(all_section2text, fout)
+    if FLAGS.pickle_sections:
+        with open(FLAGS.outfile, 'wb') as fout:
+            pickle.dump(all_section2text, fout)
 
 
 def run_setup():
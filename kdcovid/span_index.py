@@ -0,0 +1,257 @@
+import functools
+import json
+import os
+import pickle
+import sys
+from array import array
+from collections.abc import Mapping
+
+import numpy as np
+from absl import logging
+
+# Entity spans and sentence offsets of every section, in flat arrays so that rendering a section needs no
+# searching or sorting.
+#   span_index.doc_names.json    list of doc ids (shas / cord_uids)
+#   span_index.doc_offsets.npy   int64 (num docs + 1) offsets into the section table, per doc sorted by sec id
+#   span_index.sec_ids.npy       int32 section id of every section
+#   span_index.span_offsets.npy  int64 (num sections + 1) offsets into the span arrays
+#   span_index.starts.npy        int32 character offsets of the spans in the section text, sorted by
+#   span_index.ends.npy          int32 (start, end) within each section
+#   span_index.types.npy         int8 index into ENTITY_TYPES
+#   span_index.urls.npy          int32 index into the url pool
+#   span_index.alt_urls.npy      int32 index into the url pool, -1 if the span has no alt_url
+#   span_index.url_offsets.npy   int64 (num urls + 1) byte offsets into
+#   span_index.urls.bin          utf-8 urls back to back
+#   span_index.sent_offsets.npy  int64 (num sections + 1) offsets into
+#   span_index.sent_starts.npy   int32 character offset of every sentence of the section, by sentence number
+
+ENTITY_TYPES = ['gene', 'disease']
+
+
+def disease_urls(cid):
+    return 'https://www.ncbi.nlm.nih.gov/medgen/?term={}'.format(cid), None
+
+
+def gene_urls(cid, gene_mapping):
+    if '|' in cid:
+        cids = cid.split('|')
+        new_pids = [gene_mapping[cidsi] for cidsi in sorted(cids, key=int) if cidsi in gene_mapping]
+        if len(set(new_pids)) >= 1:
+            url = 'https://www.uniprot.org/uniprot/{}'.format(new_pids[0])
+            alt_url = 'https://www.ncbi.nlm.nih.gov/gene/{}'.format(min([int(v) for v in cids]))
+        else:
+            url = 'https://www.ncbi.nlm.nih.gov/gene/{}'.format(min([int(v) for v in cids]))
+            alt_url = url
+    else:
+        url = 'https://www.uniprot.org/uniprot/{}'.format(
+            gene_mapping[cid]) if cid in gene_mapping else 'https://www.ncbi.nlm.nih.gov/gene/{}'.format(cid)
+        alt_url = 'https://www.ncbi.nlm.nih.gov/gene/{}'.format(cid)
+    return url, alt_url
+
+
+def span_file(data_dir, name):
+    return '%s/span_index.%s' % (data_dir, name)
+
+
+def span_index_exists(data_dir):
+    return os.path.exists(span_file(data_dir, 'doc_names.json'))
+
+
+class UrlPool(object):
+    """Interns urls, writing each new one to urls.bin. None, a missing alt_url, gets id -1."""
+
+    def __init__(self, data_dir):
+        self.url2id = dict()
+        self.offsets = array('q', [0])
+        self.fout = open(span_file(data_dir, 'urls.bin'), 'wb')
+
+    def url_id(self, url):
+        if url is None:
+            return -1
+        if url not in self.url2id:
+            self.url2id[url] = len(self.url2id)
+            encoded = url.encode('utf-8')
+            self.fout.write(encoded)
+            self.offsets.append(self.offsets[-1] + len(encoded))
+        return self.url2id[url]
+
+    def close(self):
+        """Closes urls.bin, returns the url_offsets."""
+        self.fout.close()
+        return self.offsets
+
+
+class SpanIndexWriter(object):
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.doc_names = []
+        self.doc_offsets = array('q', [0])
+        self.sec_ids = array('i')
+        self.span_offsets = array('q', [0])
+        self.sent_offsets = array('q', [0])
+        self.columns = {name: array(code) for name, code in [('starts', 'i'), ('ends', 'i'), ('types', 'b'),
+                                                                ('urls', 'i'), ('alt_urls', 'i'),
+                                                                ('sent_starts', 'i')]}
+        self.urls = UrlPool(data_dir)
+
+    def __len__(self):
+        return len(self.doc_names)
+
+    def add_section(self, sec_id, starts, ends, types, urls, alt_urls, sent_starts):
+        """Appends a section of the current document, with its spans as parallel sequences."""
+        order = np.lexsort((ends, starts))
+        self.sec_ids.append(sec_id)
+        for name, values in [('starts', starts), ('ends', ends), ('types', types), ('urls', urls),
+                             ('alt_urls', alt_urls)]:
+            self.columns[name].extend(np.asarray(values, dtype=np.int64)[order].tolist())
+        self.columns['sent_starts'].extend(sent_starts)
+        self.span_offsets.append(len(self.columns['starts']))
+        self.sent_offsets.append(len(self.columns['sent_starts']))
+
+    def add_document(self, doc_id, sections):
+        """sections maps sec_id to (list of {'start', 'end', 'type', 'url'[, 'alt_url']} dicts, sentence starts)."""
+        for sec_id in sorted(sections.keys()):
+            links, sent_starts = sections[sec_id]
+            self.add_section(sec_id, [l['start'] for l in links], [l['end'] for l in links],
+                             [ENTITY_TYPES.index(l['type']) for l in links],
+                             [self.urls.url_id(l['url']) for l in links],
+                             [self.urls.url_id(l.get('alt_url')) for l in links], sent_starts)
+        self.end_document(doc_id)
+
+    def end_document(self, doc_id):
+        self.doc_names.append(doc_id)
+        self.doc_offsets.append(len(self.sec_ids))
+
+    def close(self):
+        save_span_arrays(self.data_dir, self.doc_names, {
+            'doc_offsets': self.doc_offsets, 'sec_ids': self.sec_ids, 'span_offsets': self.span_offsets,
+            'sent_offsets': self.sent_offsets, 'url_offsets': self.urls.close(), 'starts': self.columns['starts'],
+            'ends': self.columns['ends'], 'types': self.columns['types'], 'urls': self.columns['urls'],
+            'alt_urls': self.columns['alt_urls'], 'sent_starts': self.columns['sent_starts']})
+
+
+SPAN_DTYPES = {'doc_offsets': np.int64, 'sec_ids': np.int32, 'span_offsets': np.int64, 'sent_offsets': np.int64,
+               'url_offsets': np.int64, 'starts': np.int32, 'ends': np.int32, 'types': np.int8, 'urls': np.int32,
+               'alt_urls': np.int32, 'sent_starts': np.int32}
+
+
+def save_span_arrays(data_dir, doc_names, columns):
+    """Saves the span index arrays (name -> array or buffer, see SPAN_DTYPES), urls.bin must be written."""
+    for name, dtype in SPAN_DTYPES.items():
+        values = columns[name]
+        if isinstance(values, array):
+            values = np.frombuffer(values, dtype=dtype)
+        np.save(span_file(data_dir, '%s.npy' % name), np.asarray(values, dtype=dtype))
+    # Written last, span_index_exists keys off of it.
+    with open(span_file(data_dir, 'doc_names.json'), 'w') as fout:
+        json.dump(doc_names, fout)
+
+
+class SpanIndex(Mapping):
+    """Reads the span index. As a mapping it returns {sec_id: [link dicts]} per doc like combined_links.pickle.
+
+    The spans of the cache_size most recently rendered documents are kept decoded, callers should not modify
+    the lists returned by entity_spans.
+    """
+
+    def __init__(self, data_dir, cache_size=1024):
+        with open(span_file(data_dir, 'doc_names.json')) as fin:
+            self.doc_names = json.load(fin)
+        self.doc2row = {d: row for row, d in enumerate(self.doc_names)}
+        for name in ['doc_offsets', 'sec_ids', 'span_offsets', 'sent_offsets', 'url_offsets', 'starts', 'ends',
+                     'types', 'urls', 'alt_urls', 'sent_starts']:
+            setattr(self, name, np.load(span_file(data_dir, '%s.npy' % name), mmap_mode='r'))
+        if os.path.getsize(span_file(data_dir, 'urls.bin')) > 0:
+            self.url_pool = np.memmap(span_file(data_dir, 'urls.bin'), dtype=np.uint8, mode='r')
+        else:
+            self.url_pool = np.zeros(0, dtype=np.uint8)
+        self.document_spans = functools.lru_cache(maxsize=cache_size)(self._read_spans)
+
+    def url(self, url_id):
+        return self.url_pool[self.url_offsets[url_id]:self.url_offsets[url_id + 1]].tobytes().decode('utf-8')
+
+    def section_row(self, doc_id, sec_id):
+        """Row of the section in the section table, or -1 if it is not in the index."""
+        if doc_id not in self.doc2row:
+            return -1
+        row = self.doc2row[doc_id]
+        first, last = int(self.doc_offsets[row]), int(self.doc_offsets[row + 1])
+        pos = first + int(np.searchsorted(self.sec_ids[first:last], sec_id))
+        if pos < last and self.sec_ids[pos] == sec_id:
+            return pos
+        return -1
+
+    def _read_spans(self, doc_id):
+        row = self.doc2row[doc_id]
+        first_sec, last_sec = int(self.doc_offsets[row]), int(self.doc_offsets[row + 1])
+        span_offsets = self.span_offsets[first_sec:last_sec + 1].tolist()
+        first, last = span_offsets[0], span_offsets[-1]
+        urls = self.urls[first:last].tolist()
+        url_strings = {u: self.url(u) for u in set(urls)}
+        spans = [[s, e, ENTITY_TYPES[t], url_strings[u]] for s, e, t, u in
+                 zip(self.starts[first:last].tolist(), self.ends[first:last].tolist(),
+                     self.types[first:last].tolist(), urls)]
+        return {sec_id: spans[span_offsets[i] - first:span_offsets[i + 1] - first]
+                for i, sec_id in enumerate(self.sec_ids[first_sec:last_sec].tolist())}
+
+    def entity_spans(self, doc_id, sec_id):
+        """[start, end, type, url] of the entities in a section, sorted by (start, end)."""
+        if doc_id not in self.doc2row:
+            return []
+        return self.document_spans(doc_id).get(sec_id, [])
+
+    def sentence_start(self, doc_id, sec_id, sent_no):
+        """Character offset of sentence sent_no in its section, or None if it is not in the index."""
+        row = self.section_row(doc_id, sec_id)
+        if row < 0 or not 0 <= sent_no < self.sent_offsets[row + 1] - self.sent_offsets[row]:
+            return None
+        return int(self.sent_starts[self.sent_offsets[row] + sent_no])
+
+    def links(self, doc_id):
+        row = self.doc2row[doc_id]
+        links = dict()
+        for sec_row in range(int(self.doc_offsets[row]), int(self.doc_offsets[row + 1])):
+            sec_links = []
+            for idx in range(int(self.span_offsets[sec_row]), int(self.span_offsets[sec_row + 1])):
+                link = {'start': int(self.starts[idx]), 'end': int(self.ends[idx]),
+                        'type': ENTITY_TYPES[self.types[idx]], 'url': self.url(self.urls[idx])}
+                if self.alt_urls[idx] >= 0:
+                    link['alt_url'] = self.url(self.alt_urls[idx])
+                sec_links.append(link)
+            links[int(self.sec_ids[sec_row])] = sec_links
+        return links
+
+    def __getitem__(self, doc_id):
+        return self.links(doc_id)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.doc2row
+
+    def __iter__(self):
+        return iter(self.doc_names)
+
+    def __len__(self):
+        return len(self.doc_names)
+
+
+def convert_links(data_dir, combined_links):
+    """Writes combined_links ({sha: {sec_id: [link dicts]}}) as a span index without sentence offsets."""
+    writer = SpanIndexWriter(data_dir)
+    for sha, doc in combined_links.items():
+        writer.add_document(sha, {sec_id: (links, []) for sec_id, links in doc.items()})
+    writer.close()
+
+
+def main(argv):
+    # python -m kdcovid.span_index data_dir: converts data_dir/combined_links.pickle into a span index.
+    data_dir = argv[1]
+    with open('%s/combined_links.pickle' % data_dir, 'rb') as fin:
+        combined_links = pickle.load(fin)
+    convert_links(data_dir, combined_links)
+    logging.info('Wrote span index of %s documents to %s', len(combined_links), data_dir)
+
+
+if __name__ == "__main__":
+    logging.set_verbosity(logging.INFO)
+    main(sys.argv)
@@ -0,0 +1,86 @@
+import re
+from string import punctuation
+
+# Sentence preprocessing shared by the encoder and the query path. It produces the same output as
+#
+#   text = text.replace('/', ' / ').replace('.-', ' .- ').replace('.', ' . ').replace('\'', ' \' ').lower()
+#   ' '.join(t for t in nltk.word_tokenize(text) if t not in punctuation and t not in stop_words)
+#
+# without punkt sentence splitting and with only the NLTKWordTokenizer rules that can fire on such text.
+# After the replacements every period and single quote is a token of its own, which rules out the
+# final period, ellipsis and clitic rules ('s, n't, 'tis, d'ye, ...). The context free padding rules
+# are merged into one pass. The one known difference: NLTK turns a " that starts a punkt sentence after
+# a newline, a tab, ? or ! into `` where this gives ''. tests/test_tokenizer.py checks the equivalence.
+
+_REPLACEMENTS = {'/': ' / ', '.-': '  . - ', '.': ' . ', '\'': ' \' '}
+_REPLACE = re.compile(r"\.-|[/.']")
+
+# Starting quotes.
+_QUOTE_CHARS = (re.compile(r"([«“‘„]|[`]+)"), r" \1 ")
+_START_QUOTE = (re.compile(r"^\""), r"``")
+_BACKTICKS = (re.compile(r"(``)"), r" \1 ")
+_OPEN_QUOTE = (re.compile(r"([ \(\[{<])(\"|\'{2})"), r"\1 `` ")
+# Punctuation, brackets and double dashes.
+_COMMA = (re.compile(r"([:,])([^\d])"), r" \1 \2")
+_FINAL_COMMA = (re.compile(r"([:,])$"), r" \1 ")
+_PAD = (re.compile(r"[;@#$%&\u2012-\u2015?!*\]\[\(\)\{\}\<\>]|--"), r" \g<0> ")
+# Ending quotes.
+_CLOSE_QUOTE_CHARS = (re.compile(r"([»”’])"), r" \1 ")
+_CLOSE_QUOTE = (re.compile(r'"'), " '' ")
+# Contractions, split as e.g. gonna -> gon na.
+_CONTRACTION = (re.compile(r"(?i)\b(can(?=not\b)|gim(?=me\b)|gon(?=na\b)|got(?=ta\b)|lem(?=me\b)|wan(?=na\s))"
+                           r"(not|me|na|ta)"), r" \1 \2 ")
+
+_RULES = [_QUOTE_CHARS, _START_QUOTE, _BACKTICKS, _OPEN_QUOTE, _COMMA, _FINAL_COMMA, _PAD]
+_ENDING_RULES = [_CLOSE_QUOTE_CHARS, _CLOSE_QUOTE, _CONTRACTION]
+
+# Tokens filtered out as punctuation: every substring of string.punctuation, including the empty string.
+PUNCTUATION_TOKENS = frozenset(punctuation[i:j] for i in range(len(punctuation) + 1)
+                               for j in range(i, len(punctuation) + 1))
+
+
+def normalize(text):
+    return _REPLACE.sub(lambda m: _REPLACEMENTS[m.group(0)], text).lower()
+
+
+def tokenize(text):
+    """Word tokens of normalized text."""
+    for regexp, substitution in _RULES:
+        text = regexp.sub(substitution, text)
+    text = ' ' + text + ' '
+    for regexp, substitution in _ENDING_RULES:
+        text = regexp.sub(substitution, text)
+    return text.split()
+
+
+class SentencePreprocessor(object):
+
+    def __init__(self, stop_words=None):
+        if stop_words is None:
+            from nltk.corpus import stopwords
+            stop_words = stopwords.words('english')
+        self.dropped = PUNCTUATION_TOKENS.union(stop_words)
+
+    def __call__(self, text):
+        return ' '.join([t for t in tokenize(normalize(text)) if t not in self.dropped])
+
+    def batch(self, texts):
+        return [self(text) for text in texts]
+
+
+_default = None
+
+
+def default_preprocessor():
+    global _default
+    if _default is None:
+        _default = SentencePreprocessor()
+    return _default
+
+
+def preprocess_sentence(text):
+    return default_preprocessor()(text)
+
+
+def preprocess_sentences(texts):
+    return default_preprocessor().batch(texts)
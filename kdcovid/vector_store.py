@@ -0,0 +1,252 @@
+import json
+import os
+import pickle
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from absl import logging
+
+
+def vectors_file(data_dir):
+    return '%s/all.npy' % data_dir
+
+
+def info_file(data_dir):
+    return '%s/all.info.json' % data_dir
+
+
+def load_info(data_dir):
+    if not os.path.exists(info_file(data_dir)):
+        return None
+    with open(info_file(data_dir)) as fin:
+        return json.load(fin)
+
+
+def write_info(data_dir, shape, dtype='float32', normalized=True, **kwargs):
+    info = {'shape': list(shape), 'dtype': dtype, 'normalized': normalized}
+    info.update(kwargs)
+    with open(info_file(data_dir), 'w') as fout:
+        json.dump(info, fout)
+    return info
+
+
+def unit_norm(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    vectors /= norms
+    return vectors
+
+
+def save_vectors(data_dir, vectors):
+    """Writes unit normed float32 vectors along with an info file marking them as normalized."""
+    np.save(vectors_file(data_dir), vectors)
+    return write_info(data_dir, vectors.shape)
+
+
+def create_vectors(data_dir, shape):
+    """Preallocates all.npy as a writable float32 memory map, call write_info once it is filled."""
+    return np.lib.format.open_memmap(vectors_file(data_dir), mode='w+', dtype=np.float32, shape=shape)
+
+
+def load_vectors(data_dir, mmap=True):
+    """Loads all.npy as a torch tensor.
+
+    If gather_sentence_embeddings marked the vectors as normalized they are memory mapped read only, so
+    every process serving from the same data_dir shares one copy through the page cache. Otherwise the
+    matrix is read into memory and unit normed here.
+    """
+    info = load_info(data_dir)
+    if mmap and info is not None and info['normalized']:
+        logging.info('Memory mapping normalized vectors %s', vectors_file(data_dir))
+        vectors = np.load(vectors_file(data_dir), mmap_mode='r')
+        return as_tensor(vectors)
+    vectors = np.load(vectors_file(data_dir))
+    logging.info('Unit norming the vectors')
+    return torch.from_numpy(unit_norm(vectors)).detach()
+
+
+def as_tensor(vectors):
+    # torch warns that writes to a read-only mmap are undefined, the search path never writes.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)
+        return torch.from_numpy(vectors).detach()
+
+
+# Reduced precision copies of all.npy. float16 halves and int8 quarters the resident size of the matrix that
+# is scanned for every query, the float32 all.npy stays on disk to rescore the best candidates exactly.
+QUANTIZED_DTYPES = ['float16', 'int8']
+
+
+def quantized_file(data_dir, dtype):
+    return '%s/all.%s.npy' % (data_dir, dtype)
+
+
+def scales_file(data_dir, dtype):
+    return '%s/all.%s.scales.npy' % (data_dir, dtype)
+
+
+def quantize(vectors, dtype):
+    """Returns (compressed vectors, per row scales or None) such that vectors ~= compressed * scales."""
+    if dtype == 'float16':
+        return vectors.astype(np.float16), None
+    if dtype == 'int8':
+        scales = np.abs(vectors).max(axis=1, keepdims=True) / 127.0
+        scales[scales == 0] = 1.0
+        return np.round(vectors / scales).astype(np.int8), scales[:, 0].astype(np.float32)
+    raise ValueError('Unknown vector dtype %s, expected one of %s' % (dtype, QUANTIZED_DTYPES))
+
+
+def save_quantized(data_dir, vectors, dtype, block_size=1000000):
+    compressed = np.lib.format.open_memmap(quantized_file(data_dir, dtype), mode='w+', dtype=dtype,
+                                           shape=vectors.shape)
+    scales = None
+    if dtype == 'int8':
+        scales = np.lib.format.open_memmap(scales_file(data_dir, dtype), mode='w+', dtype=np.float32,
+                                           shape=(vectors.shape[0],))
+    for start in range(0, vectors.shape[0], block_size):
+        block, block_scales = quantize(np.asarray(vectors[start:(start + block_size)], dtype=np.float32), dtype)
+        compressed[start:(start + block.shape[0])] = block
+        if scales is not None:
+            scales[start:(start + block.shape[0])] = block_scales
+    compressed.flush()
+    if scales is not None:
+        scales.flush()
+
+
+def load_quantized(data_dir, dtype):
+    compressed = np.load(quantized_file(data_dir, dtype), mmap_mode='r')
+    scales = None
+    if dtype == 'int8':
+        scales = np.load(scales_file(data_dir, dtype), mmap_mode='r')
+    return compressed, scales
+
+
+def mask_scores(scores, mask):
+    """Sets the scores of rows that are False in the boolean numpy mask to -inf."""
+    if mask is not None:
+        scores.masked_fill_(~as_tensor(np.ascontiguousarray(mask)), float('-inf'))
+    return scores
+
+
+def to_numpy(topk):
+    """(distances, indices) numpy arrays of a top K, masked out neighbors get index -1."""
+    distances, indices = topk[0].cpu().numpy(), topk[1].cpu().numpy()
+    indices[np.isneginf(distances)] = -1
+    return distances, indices
+
+
+def blocked_topk(num_rows, score_block, K, block_size=1000000, mask=None):
+    """Top K over num_rows base rows, scored block_size rows at a time by score_block(start, end).
+
+    score_block returns a (num queries x (end - start)) tensor. Only K running candidates per query are
+    kept between blocks, so memory is bounded by the block size rather than the corpus size. Rows that
+    are False in mask score -inf.
+    """
+    values = None
+    indices = None
+    for start in range(0, num_rows, block_size):
+        end = min(start + block_size, num_rows)
+        scores = score_block(start, end)
+        if mask is not None:
+            mask_scores(scores, mask[start:end])
+        block_values, block_indices = torch.topk(scores, k=min(K, end - start), dim=1)
+        block_indices += start
+        if values is not None:
+            block_values = torch.cat([values, block_values], dim=1)
+            block_indices = torch.cat([indices, block_indices], dim=1)
+        values, top = torch.topk(block_values, k=min(K, block_values.shape[1]), dim=1)
+        indices = torch.gather(block_indices, 1, top)
+    return values, indices
+
+
+def quantized_topk(query_vectors, compressed, scales, K, block_size=1000000, mask=None):
+    def score_block(start, end):
+        block = as_tensor(np.asarray(compressed[start:end])).float()
+        scores = torch.matmul(query_vectors, block.transpose(1, 0))
+        if scales is not None:
+            scores *= as_tensor(np.asarray(scales[start:end]))
+        return scores
+    return blocked_topk(compressed.shape[0], score_block, K, block_size, mask=mask)
+
+
+def rerank(query_vectors, candidates, vectors, K):
+    """Exact top K among each query's candidate rows, scored against the float32 vectors."""
+    distances = np.full((query_vectors.shape[0], K), -np.inf, dtype=np.float32)
+    indices = np.full((query_vectors.shape[0], K), -1, dtype=np.int64)
+    for q in range(query_vectors.shape[0]):
+        ids = np.unique(candidates[q][candidates[q] >= 0])
+        rows = as_tensor(np.asarray(vectors[ids], dtype=np.float32))
+        top = torch.topk(torch.matmul(rows, query_vectors[q]), k=min(K, ids.shape[0]))
+        distances[q, :top[0].shape[0]] = top[0].numpy()
+        indices[q, :top[0].shape[0]] = ids[top[1].numpy()]
+    return distances, indices
+
+
+class VectorShards(object):
+    """Sentence vectors split across several .npy files, such as the chunk_%s.vectors.npy files written by
+    encode_sentences, searched shard by shard in a thread pool.
+
+    Each shard is memory mapped, so the corpus does not need to fit in RAM, and rows are unit normed as
+    they are scored unless the shards are already normalized. Every worker computes a top K over its shard
+    and the partial lists are merged into the global top K. Indices are global row numbers in shard order.
+    The pool threads limit torch to one intra-op thread each so that num_threads alone decides how many cores
+    a search uses. This is set per worker thread, torch keeps its thread count everywhere else.
+    """
+
+    def __init__(self, shard_files, num_threads=None, normalized=False, block_size=1000000):
+        self.shard_files = shard_files
+        self.shards = [np.load(f, mmap_mode='r') for f in shard_files]
+        self.offsets = np.zeros(len(self.shards) + 1, dtype=np.int64)
+        np.cumsum([s.shape[0] for s in self.shards], out=self.offsets[1:])
+        self.block_size = block_size
+        self.inv_norms = None
+        if not normalized:
+            self.inv_norms = [self._inv_norms(s) for s in self.shards]
+        self.num_threads = num_threads or os.cpu_count()
+        self.pool = ThreadPoolExecutor(max_workers=self.num_threads, initializer=torch.set_num_threads, initargs=(1,))
+        logging.info('Loaded %s vectors from %s shards, searching with %s threads', self.offsets[-1],
+                     len(self.shards), self.num_threads)
+
+    @property
+    def shape(self):
+        return (int(self.offsets[-1]), self.shards[0].shape[1])
+
+    def _inv_norms(self, shard):
+        inv_norms = np.zeros(shard.shape[0], dtype=np.float32)
+        for start in range(0, shard.shape[0], self.block_size):
+            norms = np.linalg.norm(shard[start:(start + self.block_size)], axis=1)
+            norms[norms == 0] = 1.0
+            inv_norms[start:(start + norms.shape[0])] = 1.0 / norms
+        return inv_norms
+
+    def _shard_topk(self, shard_id, query_vectors, K, mask=None):
+        shard = self.shards[shard_id]
+
+        def score_block(start, end):
+            block = as_tensor(np.asarray(shard[start:end], dtype=np.float32))
+            scores = torch.matmul(query_vectors, block.transpose(1, 0))
+            if self.inv_norms is not None:
+                scores *= as_tensor(self.inv_norms[shard_id][start:end])
+            return scores
+        if mask is not None:
+            mask = mask[self.offsets[shard_id]:self.offsets[shard_id + 1]]
+        values, indices = blocked_topk(shard.shape[0], score_block, K, self.block_size, mask=mask)
+        return values, indices + int(self.offsets[shard_id])
+
+    def topk(self, query_vectors, K, mask=None):
+        partial = list(self.pool.map(lambda shard_id: self._shard_topk(shard_id, query_vectors, K, mask),
+                                     [i for i in range(len(self.shards)) if self.shards[i].shape[0] > 0]))
+        values = torch.cat([p[0] for p in partial], dim=1)
+        indices = torch.cat([p[1] for p in partial], dim=1)
+        values, top = torch.topk(values, k=min(K, values.shape[1]), dim=1)
+        return values, torch.gather(indices, 1, top)
+
+    def load_metadata(self):
+        """Concatenates the chunk_%s.sentences.pkl file next to each chunk_%s.vectors.npy shard."""
+        meta = []
+        for shard_file in self.shard_files:
+            with open(shard_file.replace('.vectors.npy', '.sentences.pkl'), 'rb') as fin:
+                meta.extend(pickle.load(fin))
+        return meta
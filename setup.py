@@ -4,7 +4,7 @@ from distutils.core import setup
 
 setup(name='kdcovid',
       version='0.08',
-      packages=['kdcovid'],
+      packages=['kdcovid', 'kdcovid.bench'],
       install_requires=[
           "nltk",
           "absl-py",
@@ -0,0 +1,92 @@
+import random
+
+import pytest
+
+from kdcovid.highlighting import ENTITY_TEMPLATE
+from kdcovid.highlighting import HIGHLIGHT_TEMPLATE
+from kdcovid.highlighting import highlight_texts
+
+COLORS = {'Highlight': 'linear-gradient(90deg, #aa9cfc, #fc9ce7)', 'disease': '#ffe4b5', 'gene': '#ffa07a'}
+ENTITY_LABEL = """<i class="fa">&#xf08e;</i>"""
+
+
+def reference_highlight_texts(larger_text, entities, highlights, colors):
+    # SearchTool.highlight_texts before kdcovid.highlighting, which rewrote the whole text for every span.
+    def entity_string(text, color, link):
+        return ENTITY_TEMPLATE.replace("{bg}", color).replace("{link}", link).replace("{text}", text).replace(
+            "{label}", ENTITY_LABEL)
+
+    def highlight_string(text, color):
+        return HIGHLIGHT_TEMPLATE.replace("{bg}", color).replace("{text}", text).replace("{label}", 'Highlight')
+
+    entities = sorted(entities, key=lambda x: (x[0], x[1]))
+    highlights = sorted([list(h) for h in highlights], key=lambda x: (x[0], x[1]))
+    while entities and highlights:
+        last_e = entities[-1]
+        last_h = highlights[-1]
+        if last_e[0] > last_h[1]:
+            s, e, t, link = entities.pop()
+            larger_text = larger_text[:s] + entity_string(larger_text[s:e], colors[t], link) + larger_text[e:]
+        elif last_e[1] > last_h[0]:
+            s, e, t, link = entities.pop()
+            rs = entity_string(larger_text[s:e], colors[t], link)
+            larger_text = larger_text[:s] + rs + larger_text[e:]
+            last_h[1] += len(rs) - (e - s)
+        else:
+            s, e, t, _ = highlights.pop()
+            larger_text = larger_text[:s] + highlight_string(larger_text[s:e], colors[t]) + larger_text[e:]
+    while entities:
+        s, e, t, link = entities.pop()
+        larger_text = larger_text[:s] + entity_string(larger_text[s:e], colors[t], link) + larger_text[e:]
+    while highlights:
+        s, e, t, _ = highlights.pop()
+        larger_text = larger_text[:s] + highlight_string(larger_text[s:e], colors[t]) + larger_text[e:]
+    return larger_text
+
+
+def random_layout(rng, overlapping):
+    words = [rng.choice(['ACE2', 'binds', 'the', 'spike', 'IL-6', '{text}', 'cells', 'a']) for _ in range(40)]
+    text = ' '.join(words)
+    n = len(text)
+
+    def span():
+        if overlapping and rng.random() < 0.1:
+            # Negative and out of range offsets, as BeFree offsets that do not match the section give.
+            start = rng.randint(-5, n + 5)
+            return start, start + rng.randint(-2, 10)
+        start = rng.randint(0, n - 1)
+        return start, min(n, start + rng.randint(0, 25))
+
+    entities = []
+    for _ in range(rng.randint(0, 12)):
+        start, end = span()
+        link = rng.choice(['https://www.ncbi.nlm.nih.gov/gene/%d' % rng.randint(1, 99), 'https://x/{link}', None])
+        entities.append([start, end, rng.choice(['gene', 'disease']), link or 'https://x'])
+    highlights = [[start, end, 'Highlight', None] for start, end in (span() for _ in range(rng.randint(0, 3)))]
+    if not overlapping:
+        # Disjoint entities, the layout BeFree produces for one section.
+        entities.sort()
+        kept = []
+        for e in entities:
+            if not kept or e[0] >= kept[-1][1]:
+                kept.append(e)
+        entities = kept
+    return text, entities, highlights
+
+
+@pytest.mark.parametrize('overlapping', [False, True])
+@pytest.mark.parametrize('seed', range(4))
+def test_matches_reference(seed, overlapping):
+    rng = random.Random(seed)
+    for _ in range(500):
+        text, entities, highlights = random_layout(rng, overlapping)
+        expected = reference_highlight_texts(text, [list(e) for e in entities], highlights, COLORS)
+        assert highlight_texts(text, [list(e) for e in entities], [list(h) for h in highlights], COLORS) == expected
+        presorted = sorted([list(e) for e in entities], key=lambda x: (x[0], x[1]))
+        assert highlight_texts(text, presorted, [list(h) for h in highlights], COLORS, entities_sorted=True) == expected
+
+
+def test_highlights_are_not_modified():
+    highlights = [[4, 10, 'Highlight', None]]
+    highlight_texts('the spike protein', [[4, 9, 'gene', 'https://x']], highlights, COLORS)
+    assert highlights == [[4, 10, 'Highlight', None]]
@@ -0,0 +1,132 @@
+import random
+import re
+
+import numpy as np
+import pytest
+
+from kdcovid import parse_befree_output
+from kdcovid.parse_befree_output import section_sentence_starts
+from kdcovid.parse_befree_output import stream_span_index
+from kdcovid.span_index import disease_urls
+from kdcovid.span_index import gene_urls
+from kdcovid.span_index import SPAN_DTYPES
+from kdcovid.span_index import SpanIndex
+from kdcovid.span_index import SpanIndexWriter
+
+GENE_MAPPING = {'123': 'P12345'}
+WORDS = ['ACE2', 'binds', 'the', 'spike', 'protein', 'IL-6', 'levels', 'rose', 'in', 'patients', 'cells']
+
+
+class PeriodTokenizer(object):
+    """Splits after every period, in place of the punkt model, which is not needed to compare the parsers."""
+
+    def span_tokenize(self, text):
+        for m in re.finditer(r'[^.]+\.', text):
+            start = m.start()
+            while text[start] == ' ':
+                start += 1
+            yield start, m.end()
+
+
+@pytest.fixture(autouse=True)
+def period_tokenizer(monkeypatch):
+    monkeypatch.setattr(parse_befree_output, '_punkt', PeriodTokenizer())
+
+
+def reference_span_index(data_dir, doc2sec2text, disease_output, gene_output, gene_mapping):
+    """The BeFree parser before stream_span_index: the combined links of every section, written with
+    SpanIndexWriter. Returns the combined links."""
+    sec_starts = {sha: {sec_id: section_sentence_starts(text) for sec_id, text in doc.items()}
+                  for sha, doc in doc2sec2text.items()}
+    # BeFree numbers the sentences of a document over its sections.
+    doc_starts = {sha: [start for sec_id in doc for start in doc[sec_id]] for sha, doc in sec_starts.items()}
+    combined_links = {sha: {sec_id: [] for sec_id in doc} for sha, doc in doc2sec2text.items()}
+    for entity_type, output in [('gene', gene_output), ('disease', disease_output)]:
+        for l in output:
+            line = l.strip().split('\t')
+            sha, par, sen, cid = line[0], int(line[5]), int(line[6]), line[7]
+            sid, eid = [int(x) for x in line[11].split('#')]
+            url, alt_url = gene_urls(cid, gene_mapping) if entity_type == 'gene' else disease_urls(cid)
+            link = {'start': doc_starts[sha][sen] + sid, 'end': doc_starts[sha][sen] + eid, 'type': entity_type,
+                    'url': url}
+            if alt_url is not None:
+                link['alt_url'] = alt_url
+            combined_links[sha][par].append(link)
+    writer = SpanIndexWriter(data_dir)
+    for sha, doc in combined_links.items():
+        writer.add_document(sha, {sec_id: (links, sec_starts[sha][sec_id]) for sec_id, links in doc.items()})
+    writer.close()
+    return combined_links
+
+
+def befree_line(sha, sec_id, sent_no, cid, start, end):
+    # Only the document, section, sentence, concept id and offset columns are read.
+    return '\t'.join([sha, 'x', 'x', 'x', 'x', str(sec_id), str(sent_no), cid, 'x', 'x', 'x',
+                      '%d#%d' % (start, end)]) + '\n'
+
+
+def make_corpus(seed, num_docs=20):
+    """Sections of random sentences and BeFree lines for random spans within their sentences."""
+    rng = random.Random(seed)
+    doc2sec2text = dict()
+    disease_output, gene_output = [], []
+    for doc_no in range(num_docs):
+        sha = 'doc%04d' % rng.randint(0, 9999)
+        if sha in doc2sec2text:
+            continue
+        doc2sec2text[sha] = dict()
+        for sec_id in rng.sample(range(10), rng.randint(1, 4)):
+            sentences = [' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 10))) + '.'
+                         for _ in range(rng.randint(1, 5))]
+            doc2sec2text[sha][sec_id] = ' '.join(sentences)
+            for sent_no, sentence in enumerate(sentences):
+                for _ in range(rng.randint(0, 3)):
+                    start = rng.randint(0, len(sentence) - 2)
+                    end = rng.randint(start + 1, len(sentence))
+                    if rng.random() < 0.5:
+                        gene_output.append(befree_line(sha, sec_id, sent_no, rng.choice(['123', '77', '123|456']),
+                                                       start, end))
+                    else:
+                        disease_output.append(befree_line(sha, sec_id, sent_no, 'C%07d' % rng.randint(0, 50),
+                                                          start, end))
+    return doc2sec2text, disease_output, gene_output
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_stream_matches_reference(tmp_path, seed):
+    doc2sec2text, disease_output, gene_output = make_corpus(seed)
+    written, streamed = tmp_path / 'written', tmp_path / 'streamed'
+    written.mkdir()
+    streamed.mkdir()
+    reference_span_index(str(written), doc2sec2text, disease_output, gene_output, GENE_MAPPING)
+    unmatched = [befree_line('unknown', 0, 0, 'C1', 0, 3), befree_line(next(iter(doc2sec2text)), 999, 0, 'C1', 0, 3),
+                 befree_line(next(iter(doc2sec2text)), next(iter(next(iter(doc2sec2text.values())))), 99, 'C1', 0, 3)]
+    dropped = stream_span_index(str(streamed), doc2sec2text, iter(disease_output + ['\n'] + unmatched),
+                                iter(gene_output), GENE_MAPPING, chunk_size=7)
+    assert dropped == len(unmatched)
+
+    a, b = SpanIndex(str(written)), SpanIndex(str(streamed))
+    assert a.doc_names == b.doc_names
+    assert all(a[sha] == b[sha] for sha in a)
+    for name in SPAN_DTYPES:
+        if name in ('urls', 'alt_urls', 'url_offsets'):
+            # The url pools may be ordered differently, the links above compare the urls themselves.
+            continue
+        assert np.array_equal(getattr(a, name), getattr(b, name)), name
+
+
+def test_span_index_matches_combined_links(tmp_path):
+    doc2sec2text, disease_output, gene_output = make_corpus(0)
+    combined_links = reference_span_index(str(tmp_path), doc2sec2text, disease_output, gene_output, GENE_MAPPING)
+    index = SpanIndex(str(tmp_path))
+    for sha, doc in combined_links.items():
+        assert index[sha] == {sec_id: sorted(links, key=lambda x: (x['start'], x['end']))
+                              for sec_id, links in doc.items()}
+        for sec_id, links in doc.items():
+            expected = sorted([[l['start'], l['end'], l['type'], l['url']] for l in links], key=lambda x: x[:2])
+            assert [list(span) for span in index.entity_spans(sha, sec_id)] == expected
+    for sha, doc in doc2sec2text.items():
+        for sec_id, text in doc.items():
+            for sent_no, (start, _) in enumerate(PeriodTokenizer().span_tokenize(text)):
+                if sha in combined_links and sec_id in combined_links[sha]:
+                    assert index.sentence_start(sha, sec_id, sent_no) == start
@@ -0,0 +1,127 @@
+import random
+import re
+from string import punctuation
+
+import nltk
+import pytest
+from nltk import word_tokenize
+from nltk.corpus import stopwords
+
+from kdcovid.tokenizer import SentencePreprocessor
+
+STOP_WORDS = stopwords.words('english')
+
+# Fragments that exercise every tokenizer rule: quotes, brackets, dashes, commas and colons next to digits,
+# contractions, unicode quotes and the characters the replacements pad.
+FRAGMENTS = ['covid', 'COVID-19', 'SARS-CoV-2', 'The', 'a', 'of', 'cells', '1,000', '3:4', '12.5', 'x', 'ab',
+             'cannot', 'can not', 'gonna', 'gimme', 'gotta', 'lemme', 'wanna ', 'don\'t', 'it\'s', 'd\'ye', '\'tis',
+             '\'', '"', '``', '\'\'', '.', '.-', '...', '/', ',', ':', ';', '--', '-', '(', ')', '[', ']', '{', '}',
+             '<', '>', '«', '»', '“', '”', '‘', '’', '„', '?', '!', '*', '@', '#', '$', '%', '&', '–', '—',
+             'e.g.', 'i.e.', 'U.S.', ' ', ' ', ' ', '\n', '\t']
+
+# What punkt splits sentences on, and the whitespace between the sentences of an abstract.
+SENTENCE_ENDS = ['.', '?', '!', '."', '...']
+SEPARATORS = [' ', '  ', '\n', '\t', '\n\n']
+
+PARAGRAPHS = [
+    'The spike protein of SARS-CoV-2 binds ACE2. Patients (n = 1,000) were followed for 14 days; 3:4 recovered.',
+    'He said "it\'s not over" -- and it wasn\'t. IL-6/IL-8 levels rose in 12.5% of cases, e.g. in the U.S. cohort...',
+    '“Quoted” text, ‘single’ quotes and «guillemets» gonna cannot wanna go.\tWhy? Nobody knows!',
+    '"Starts with a quote and ends with one." "So does this one." Then none.\n\nA new paragraph.',
+]
+
+# A " that starts a punkt sentence after a newline, a tab, ? or ! is `` in NLTK and '' here, see kdcovid/tokenizer.py.
+KNOWN_DIFFERENCE = ('Cases rose.\n"Masks" help.\t"Distancing" works!"Really"',
+                    "cases rose '' masks '' help '' distancing '' works '' really ''",
+                    "cases rose `` masks '' help `` distancing '' works `` really ''")
+_QUOTE_STARTING_SENTENCE = re.compile(r'[\n\t?!]"')
+
+
+def has_punkt():
+    for resource in ['tokenizers/punkt_tab/english/', 'tokenizers/punkt/english.pickle']:
+        try:
+            nltk.data.find(resource)
+            return True
+        except LookupError:
+            pass
+    return False
+
+
+requires_punkt = pytest.mark.skipif(not has_punkt(), reason='word_tokenize needs the NLTK punkt data')
+
+
+def normalize(text):
+    return text.replace('/', ' / ').replace('.-', ' .- ').replace('.', ' . ').replace('\'', ' \' ').lower()
+
+
+def nltk_preprocess(text, preserve_line=False):
+    # The original pipeline of the encoder and the query path.
+    tokens = word_tokenize(normalize(text), preserve_line=preserve_line)
+    return ' '.join(t for t in tokens if t not in punctuation and t not in STOP_WORDS)
+
+
+def is_known_difference(text, ours, expected):
+    ours, expected = ours.split(), expected.split()
+    return (_QUOTE_STARTING_SENTENCE.search(text) is not None and len(ours) == len(expected) and
+            all(a == b or (a, b) == ('\'\'', '``') for a, b in zip(ours, expected)))
+
+
+def fuzzed_strings(seed, count, max_fragments=12):
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield ''.join(rng.choice(FRAGMENTS) + rng.choice(['', ' ']) for _ in range(rng.randint(0, max_fragments)))
+
+
+def fuzzed_paragraphs(seed, count, max_sentences=5):
+    """Fuzzed strings joined into one to max_sentences sentences."""
+    rng = random.Random(seed)
+    sentences = fuzzed_strings(seed, count * max_sentences)
+    for _ in range(count):
+        yield ''.join(next(sentences) + rng.choice(SENTENCE_ENDS) + rng.choice(SEPARATORS)
+                      for _ in range(rng.randint(1, max_sentences)))
+
+
+@pytest.fixture(scope='module')
+def preprocessor():
+    return SentencePreprocessor()
+
+
+@requires_punkt
+@pytest.mark.parametrize('paragraph', PARAGRAPHS)
+def test_matches_nltk_on_paragraphs(preprocessor, paragraph):
+    assert preprocessor(paragraph) == nltk_preprocess(paragraph)
+
+
+@requires_punkt
+@pytest.mark.parametrize('seed', range(5))
+def test_matches_nltk_on_fuzzed_paragraphs(preprocessor, seed):
+    mismatches = []
+    for s in fuzzed_paragraphs(seed, 1000):
+        ours, expected = preprocessor(s), nltk_preprocess(s)
+        if ours != expected and not is_known_difference(s, ours, expected):
+            mismatches.append(s)
+    assert mismatches == []
+
+
+def test_known_difference(preprocessor):
+    text, ours, _ = KNOWN_DIFFERENCE
+    assert preprocessor(text) == ours
+
+
+@requires_punkt
+def test_known_difference_in_nltk():
+    text, ours, expected = KNOWN_DIFFERENCE
+    assert nltk_preprocess(text) == expected
+    assert is_known_difference(text, ours, expected)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_matches_nltk_word_rules_on_fuzzed_strings(preprocessor, seed):
+    # Without punkt the whole text is one sentence to NLTK, which checks the word rules on their own.
+    mismatches = [s for s in fuzzed_paragraphs(seed, 1000) if preprocessor(s) != nltk_preprocess(s, True)]
+    assert mismatches == []
+
+
+def test_batch_matches_single(preprocessor):
+    sentences = list(fuzzed_paragraphs(10, 100))
+    assert preprocessor.batch(sentences) == [preprocessor(s) for s in sentences]